@@ -0,0 +1,10 @@
+"""
+Benchmarks for the storefront and admin, run as modules from the repo root:
+
+- seed: synthetic categories, products and GridFS images
+- stand_in: the in-memory MongoDB of `--memory` runs and the tests
+- micro: per-document serialization and read model work
+- load: fixed-concurrency load on the storefront routes, checked against
+  the committed baseline.json
+- concurrency, serialization, streaming: focused comparisons
+"""
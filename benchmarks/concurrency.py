@@ -0,0 +1,65 @@
+"""
+Concurrency benchmark for the public storefront routes.
+
+Runs N concurrent clients against the category and product routers in-process
+(no network hop) and reports throughput for each concurrency level. Point
+MONGO_CONNECTION_URL / MONGO_DB at a local mongod with some data in it:
+
+    python -m benchmarks.concurrency --path /products --requests 400
+
+With a blocking driver throughput stays flat as clients are added; with the
+async driver it should scale until the database or the CPU saturates.
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from mongo_engine.Routes.categoryRoutes import router as categoryRouter
+from mongo_engine.Routes.imageRoutes import router as imageRouter
+from mongo_engine.Routes.productRoutes import router as productRouter
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(categoryRouter)
+    app.include_router(productRouter)
+    app.include_router(imageRouter)
+    return app
+
+
+async def run_level(app: FastAPI, path: str, concurrency: int, total: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        remaining = iter(range(total))
+
+        async def worker():
+            for _ in remaining:
+                response = await client.get(path)
+                response.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return total / (time.perf_counter() - started)
+
+
+async def main(path: str, levels, total: int):
+    app = build_app()
+    # Warm up connections and caches before measuring
+    await run_level(app, path, 1, 5)
+    print(f"{'clients':>8} {'req/s':>10}")
+    for concurrency in levels:
+        throughput = await run_level(app, path, concurrency, total)
+        print(f"{concurrency:>8} {throughput:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default="/products")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+    asyncio.run(main(args.path, args.levels, args.requests))
@@ -0,0 +1,246 @@
+"""
+Load driver for the storefront API, with a committed performance baseline.
+
+Seeds a synthetic catalog (see benchmarks.seed), then sends a fixed number
+of requests at a fixed concurrency to each storefront endpoint in-process
+(no network hop), and records p50/p95/p99 latency and throughput, along
+with the micro-benchmarks of benchmarks.micro:
+
+    python -m benchmarks.load --memory
+    python -m benchmarks.load --products 10000 --output results.json
+
+`--memory` runs against the in-memory stand-in of benchmarks.stand_in
+(mongomock and mongomock-motor, from requirements-dev.txt) instead of
+MONGO_CONNECTION_URL / MONGO_DB, so the suite needs no mongod. Without it,
+point MONGO_DB at a scratch database.
+
+The committed baseline.json was recorded with `--memory`. mongomock scans
+every collection and ignores indexes, so that baseline only guards the CPU
+work of the app (serialization, middlewares, the micro-benchmarks), not
+query plans: check index or query changes against a baseline recorded on
+a local mongod, passed with `--baseline`.
+
+With `--check`, the run is compared with the committed baseline and the
+script exits with status 1 when any endpoint or micro-benchmark is slower
+than the baseline by more than `--tolerance`:
+
+    python -m benchmarks.load --memory --check
+
+`--update-baseline` writes the report to the baseline file instead.
+Baselines are machine specific: record them on the machine that checks them.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+from typing import Dict, List
+from urllib.parse import quote
+
+import httpx
+from fastapi import FastAPI
+
+from benchmarks import micro
+from benchmarks.concurrency import build_app
+from benchmarks.seed import clear, seed, use_in_memory_database
+from mongo_engine.db import get_db
+from mongo_engine.read_model import STOREFRONT_COLLECTION, rebuild
+
+BASE_URL = "http://bench"
+DEFAULT_BASELINE = "benchmarks/baseline.json"
+SAMPLE_SIZE = 50
+
+
+def endpoint_paths(db) -> Dict[str, List[str]]:
+    """
+    The requests of each endpoint, cycled through by the workers.
+    """
+    categories = [doc["name"] for doc in db.category.find({"benchmark": True})]
+    products = list(
+        db[STOREFRONT_COLLECTION].find(
+            {}, {"title": 1, "images": {"$slice": 1}}, limit=SAMPLE_SIZE
+        )
+    )
+    # Stored as "/images/<id>" in the read model
+    image_ids = [
+        product["images"][0]["image_src"].rsplit("/", 1)[-1]
+        for product in products
+        if product.get("images")
+    ]
+    # Image URLs are prefixed with base_url, which defaults to BASE_URL from the env
+    base = f"base_url={quote(BASE_URL)}"
+    return {
+        "/products": [
+            f"/products?category_name={quote(name)}&limit=20&{base}"
+            for name in categories
+        ],
+        "/products/{name}": [
+            f"/products/{quote(product['title'])}?{base}" for product in products
+        ],
+        "/bestsellers": [f"/bestsellers?limit=20&{base}"],
+        "/categories": [f"/categories?{base}"],
+        "/images/{id}": [f"/images/{image_id}" for image_id in image_ids],
+    }
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    # Nearest-rank percentile of an ordered sample
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def drive(
+    client: httpx.AsyncClient, paths: List[str], concurrency: int, total: int
+) -> dict:
+    latencies: List[float] = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for index in remaining:
+            started = time.perf_counter()
+            response = await client.get(paths[index % len(paths)])
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+async def run_load(
+    app: FastAPI, endpoints: Dict[str, List[str]], concurrency: int, total: int
+) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url=BASE_URL) as client:
+        results = {}
+        for name, paths in endpoints.items():
+            if not paths:
+                continue
+            # Warm up connections and caches before measuring
+            for path in paths:
+                await client.get(path)
+            results[name] = await drive(client, paths, concurrency, total)
+        return results
+
+
+def compare(report: dict, baseline: dict, tolerance: float, min_delta_ms: float):
+    """
+    Regressions of `report` against `baseline`, as readable lines. Latencies
+    must also be `min_delta_ms` slower, so sub-millisecond noise is ignored.
+    """
+    regressions = []
+
+    def slower(name: str, metric: str, value: float, reference: float) -> None:
+        if value > reference * (1 + tolerance) and value - reference > min_delta_ms:
+            regressions.append(
+                f"{name} {metric}: {value} ms, baseline {reference} ms "
+                f"(+{(value / reference - 1) * 100:.0f}%)"
+            )
+
+    for name, reference in baseline.get("endpoints", {}).items():
+        result = report["endpoints"].get(name)
+        if result is None:
+            regressions.append(f"{name}: not measured")
+            continue
+        if result["errors"]:
+            regressions.append(f"{name}: {result['errors']} failed requests")
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            slower(name, metric, result[metric], reference[metric])
+        if result["throughput_rps"] < reference["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name} throughput: {result['throughput_rps']} req/s, "
+                f"baseline {reference['throughput_rps']} req/s"
+            )
+    for name, reference in baseline.get("micro", {}).items():
+        result = report["micro"].get(name)
+        if result is not None:
+            slower(name, "best_ms", result["best_ms"], reference["best_ms"])
+    return regressions
+
+
+def main(args) -> int:
+    if args.memory:
+        use_in_memory_database()
+    config = {
+        "backend": "memory" if args.memory else "mongod",
+        "categories": args.categories,
+        "products": args.products,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "micro_items": args.micro_items,
+    }
+    db = get_db()
+    seed(db, args.categories, args.products)
+    endpoints = endpoint_paths(db)
+    report = {
+        "config": config,
+        "python": platform.python_version(),
+        "endpoints": asyncio.run(
+            run_load(build_app(), endpoints, args.concurrency, args.requests)
+        ),
+        "micro": micro.run(args.micro_items),
+    }
+    if not args.keep:
+        clear(db)
+        rebuild(db)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+        return 0
+    if not args.check:
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline["config"] != config:
+        print(
+            f"Baseline was recorded with {baseline['config']}, not {config}",
+            file=sys.stderr,
+        )
+        return 2
+    regressions = compare(report, baseline, args.tolerance, args.min_delta_ms)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--memory", action="store_true")
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--micro-items", type=int, default=10000)
+    parser.add_argument("--output", help="Also write the report to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--check", action="store_true", help="Fail when the baseline regresses"
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--min-delta-ms", type=float, default=1.0)
+    parser.add_argument(
+        "--keep", action="store_true", help="Leave the seeded catalog in place"
+    )
+    sys.exit(main(parser.parse_args()))
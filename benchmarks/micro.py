@@ -0,0 +1,119 @@
+"""
+Micro-benchmarks of the storefront's per-document work.
+
+Times, on synthetic documents and without a database:
+- `serialize_doc` and `serialize_list` of the product routes,
+- `build_storefront_doc`, run for every product by the read model,
+- ordering raw products by variant priority in Python, which the read model
+  replaces with an indexed sort on the stored priority.
+
+    python -m benchmarks.micro --items 10000
+
+The results are also part of the `benchmarks.load` report and baseline.
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import time
+from typing import Callable
+
+from bson import ObjectId
+
+from benchmarks.serialization import BASE_URL, ListCursor, storefront_docs
+from mongo_engine.read_model import build_storefront_doc, variant_priority_map
+from mongo_engine.Routes.productRoutes import serialize_doc, serialize_list
+
+CATEGORY = {
+    "_id": ObjectId(),
+    "name": "Chairs",
+    "variants": [
+        {"variant": "Wood", "Priority": 2},
+        {"variant": "Steel", "Priority": 1},
+        {"variant": "Glass", "Priority": 3},
+    ],
+}
+
+
+def raw_products(count: int) -> list:
+    return [
+        {
+            "_id": ObjectId(),
+            "title": f"Benchmark product {index}",
+            "variant": ("Wood", "Steel", "Glass", "Oak")[index % 4],
+            "category": CATEGORY["_id"],
+            "images": [
+                {"id": f"Image{image + 1:02}", "image_src": ObjectId()}
+                for image in range(3)
+            ],
+        }
+        for index in range(count)
+    ]
+
+
+def sort_by_variant_priority(products: list) -> list:
+    priorities = variant_priority_map(CATEGORY)
+    return sorted(
+        products,
+        key=lambda product: (
+            priorities.get((product.get("variant") or "").lower(), 0),
+            product["_id"],
+        ),
+    )
+
+
+def best_ms(run: Callable, prepare: Callable, repeat: int) -> float:
+    """
+    Best time in milliseconds over `repeat` runs; `prepare` builds the input
+    of each run outside of the timing.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        batch = prepare()
+        started = time.perf_counter()
+        run(batch)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def run(items: int = 10000, repeat: int = 5) -> dict:
+    docs = storefront_docs(items)
+    products = raw_products(items)
+    # One loop for every run, so its setup is not part of the timing
+    loop = asyncio.new_event_loop()
+    cases = {
+        "serialize_doc": (
+            lambda batch: [serialize_doc(doc, BASE_URL) for doc in batch],
+            lambda: copy.deepcopy(docs),
+        ),
+        "serialize_list": (
+            lambda batch: loop.run_until_complete(
+                serialize_list(ListCursor(batch), BASE_URL, thumbnails=True)
+            ),
+            lambda: copy.deepcopy(docs),
+        ),
+        "build_storefront_doc": (
+            lambda batch: [build_storefront_doc(doc, CATEGORY) for doc in batch],
+            lambda: products,
+        ),
+        "variant_priority_sort": (sort_by_variant_priority, lambda: products),
+    }
+    results = {}
+    for name, (function, prepare) in cases.items():
+        elapsed = best_ms(function, prepare, repeat)
+        results[name] = {
+            "items": items,
+            "best_ms": round(elapsed, 3),
+            "per_item_us": round(elapsed * 1000 / items, 3),
+        }
+    loop.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.items, args.repeat), indent=2))
@@ -0,0 +1,217 @@
+"""
+Seed a database with synthetic categories, products and GridFS images.
+
+Documents match what the admin writes through `mongo_engine/models/models.py`
+(images are stored the way `ImageField` stores them, with a thumbnail), and
+the storefront read model is rebuilt afterwards. Every seeded document is
+flagged, so a rerun replaces the previous data set without touching real
+data. Use a scratch database on a local mongod:
+
+    python -m benchmarks.seed --categories 10 --products 10000
+
+`benchmarks.load --memory` seeds an in-memory stand-in instead.
+"""
+
+import argparse
+import io
+import random
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from bson import ObjectId
+from gridfs import GridFS
+from PIL import Image as PILImage
+from pymongo.database import Database
+
+from mongo_engine.category_cache import category_cache
+from mongo_engine.db import MONGO_BUCKET_NAME, MONGO_DB, connection, get_db
+from mongo_engine.gridfs_cleanup import delete_images
+from mongo_engine.models.models import Image
+from mongo_engine.read_model import rebuild
+
+SEED_BATCH_SIZE = 5000
+VARIANTS = ["Wood", "Steel", "Glass", "Marble", "Oak", "Walnut"]
+COLORS = ["black", "white", "grey", "brown", "red", "blue", "green"]
+IMAGE_SIZE = (800, 600)
+
+
+def use_in_memory_database() -> None:
+    """
+    Point the shared connection at the in-memory stand-in of
+    benchmarks.stand_in. Its test tools are only imported here.
+    """
+    from benchmarks import stand_in
+
+    client, async_client = stand_in.connect(MONGO_DB or "benchmark")
+    # A single in-memory node, so there are no secondaries to route reads to
+    connection.use_clients(client, async_client, route_reads=False)
+
+
+def render_image(color: str) -> bytes:
+    buffer = io.BytesIO()
+    PILImage.new("RGB", IMAGE_SIZE, color).save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def render_thumbnail(data: bytes, size: dict) -> bytes:
+    with PILImage.open(io.BytesIO(data)) as image:
+        image.thumbnail((size["width"], size["height"]))
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG")
+        return buffer.getvalue()
+
+
+def seed_images(db: Database, count: int) -> List[ObjectId]:
+    """
+    Store `count` images with their thumbnails, with the same file documents
+    as `ImageGridFsProxy.put`.
+    """
+    field = Image._fields["image_src"]
+    fs = GridFS(db, MONGO_BUCKET_NAME)
+    ids = []
+    for index in range(count):
+        color = COLORS[index % len(COLORS)]
+        data = render_image(color)
+        thumbnail_id = fs.put(
+            render_thumbnail(data, field.thumbnail_size),
+            width=field.thumbnail_size["width"],
+            height=field.thumbnail_size["height"],
+            format="JPEG",
+            contentType="image/jpeg",
+            benchmark=True,
+        )
+        ids.append(
+            fs.put(
+                data,
+                filename=f"benchmark-{index}.jpg",
+                contentType="image/jpeg",
+                width=IMAGE_SIZE[0],
+                height=IMAGE_SIZE[1],
+                format="JPEG",
+                thumbnail_id=thumbnail_id,
+                benchmark=True,
+            )
+        )
+    return ids
+
+
+def clear(db: Database) -> None:
+    db.product.delete_many({"benchmark": True})
+    db.category.delete_many({"benchmark": True})
+    files = db[f"{MONGO_BUCKET_NAME}.files"]
+    image_ids = [file["_id"] for file in files.find({"benchmark": True}, {"_id": 1})]
+    delete_images(db, MONGO_BUCKET_NAME, image_ids)
+
+
+def seed(
+    db: Database,
+    categories: int,
+    products: int,
+    images_per_product: int = 3,
+    distinct_images: int = 50,
+    random_seed: int = 0,
+) -> dict:
+    """
+    Replace the seeded data set. Products share a pool of `distinct_images`
+    images, so large catalogs do not need as many GridFS files. The same
+    `random_seed` always produces the same catalog.
+    """
+    rng = random.Random(random_seed)
+    clear(db)
+
+    category_docs = []
+    for index in range(categories):
+        variants = rng.sample(VARIANTS, rng.randint(2, 4))
+        category_docs.append(
+            {
+                "_id": ObjectId(),
+                "name": f"Benchmark category {index}",
+                "name_lower": f"benchmark category {index}",
+                "description": "Synthetic category",
+                "images": [],
+                "variants": [
+                    {"variant": variant, "Priority": priority}
+                    for priority, variant in enumerate(variants, start=1)
+                ],
+                "benchmark": True,
+            }
+        )
+    if category_docs:
+        db.category.insert_many(category_docs)
+
+    image_ids = seed_images(db, distinct_images) if images_per_product else []
+    created_at = datetime(2024, 1, 1)
+    for start in range(0, products, SEED_BATCH_SIZE):
+        batch = []
+        for index in range(start, min(start + SEED_BATCH_SIZE, products)):
+            category = (
+                category_docs[index % len(category_docs)] if category_docs else None
+            )
+            variants = (
+                [v["variant"] for v in category["variants"]] if category else VARIANTS
+            )
+            title = f"Benchmark product {index}"
+            batch.append(
+                {
+                    "title": title,
+                    "title_lower": title.lower(),
+                    "subtitle": "Synthetic product",
+                    "description": ["Line one", "Line two", "Line three"],
+                    "color": rng.choice(COLORS),
+                    "price": round(rng.uniform(5, 1500), 2),
+                    "best_seller": rng.random() < 0.1,
+                    "images": [
+                        {
+                            "id": f"Image{image + 1:02}",
+                            "image_src": image_ids[(index + image) % len(image_ids)],
+                        }
+                        for image in range(images_per_product)
+                    ],
+                    "dimension": {
+                        "width": rng.randint(1, 100),
+                        "height": rng.randint(1, 100),
+                        "unit": "cm",
+                    },
+                    "weight": {"Weight": rng.randint(1, 50), "unit": "kg"},
+                    "created_at": created_at + timedelta(minutes=index),
+                    "category": category["_id"] if category else None,
+                    "variant": rng.choice(variants),
+                    "benchmark": True,
+                }
+            )
+        db.product.insert_many(batch)
+
+    # The routes read the storefront projection, not the raw products
+    rebuild(db)
+    category_cache.invalidate()
+    return {
+        "categories": categories,
+        "products": products,
+        "images": len(image_ids),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--images-per-product", type=int, default=3)
+    parser.add_argument("--distinct-images", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--clear", action="store_true", help="Only remove seeded data")
+    args = parser.parse_args()
+    if args.clear:
+        clear(get_db())
+        rebuild(get_db())
+    else:
+        started = time.perf_counter()
+        summary = seed(
+            get_db(),
+            args.categories,
+            args.products,
+            args.images_per_product,
+            args.distinct_images,
+            args.seed,
+        )
+        print(f"Seeded {summary} in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,132 @@
+"""
+Micro-benchmark of response serialization for the product listings.
+
+Runs `serialize_list` over synthetic storefront documents and renders the
+result either through FastAPI's `response_model` path (validation, then
+`jsonable_encoder` and `JSONResponse`) or through the prebuilt TypeAdapters
+of `mongo_engine.encoding`. No database is needed:
+
+    python -m benchmarks.serialization --items 1000 10000
+
+Both paths must produce the same bytes; the script checks this first.
+"""
+
+import argparse
+import asyncio
+import copy
+import time
+from datetime import datetime
+from typing import List
+
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from mongo_engine.encoding import encode, type_adapter
+from mongo_engine.models.pydantic_models import ProductModel, ProductSummaryModel
+from mongo_engine.Routes.productRoutes import serialize_list
+
+BASE_URL = "http://bench"
+
+
+class ListCursor:
+    """
+    Async iterator over prepared documents, standing in for a Motor cursor.
+    """
+
+    def __init__(self, docs: list):
+        self.docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def storefront_docs(count: int) -> list:
+    return [
+        {
+            "_id": ObjectId(),
+            "title": f"Benchmark product {index}",
+            "subtitle": "Synthetic product",
+            "description": ["Line one", "Line two"],
+            "price": 10.0 + index % 100,
+            "color": "black",
+            "best_seller": index % 10 == 0,
+            "images": [
+                {
+                    "id": f"Image{image + 1:02}",
+                    "image_src": f"/images/{ObjectId()}",
+                    "thumbnail_src": f"/images/{ObjectId()}/thumbnail",
+                }
+                for image in range(3)
+            ],
+            "dimension": {"width": 10, "height": 20, "unit": "cm"},
+            "weight": {"Weight": 2, "unit": "kg"},
+            "created_at": datetime(2024, 1, 1),
+            "category": "Chairs",
+            "variant": "Wood",
+            "priority": 1,
+        }
+        for index in range(count)
+    ]
+
+
+async def fastapi_render(field, docs: list) -> bytes:
+    items = await serialize_list(ListCursor(docs), BASE_URL)
+    content = await serialize_response(
+        field=field, response_content=items, is_coroutine=True
+    )
+    return JSONResponse(content).body
+
+
+async def fast_render(adapter, docs: list) -> bytes:
+    items = await serialize_list(ListCursor(docs), BASE_URL)
+    return encode(adapter, items)
+
+
+async def measure(render, target, docs: list, repeat: int) -> float:
+    """
+    Best time in milliseconds over `repeat` runs. Copying the documents is
+    not timed, serialize_list rewrites them in place.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        batch = copy.deepcopy(docs)
+        started = time.perf_counter()
+        await render(target, batch)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+async def main(counts, repeat: int) -> None:
+    print(
+        f"{'items':>7} {'model':>20} {'fastapi ms':>11} {'adapter ms':>11} {'speedup':>8}"
+    )
+    for response_type in (List[ProductSummaryModel], List[ProductModel]):
+        field = create_response_field(name="Response", type_=response_type)
+        adapter = type_adapter(response_type)
+        for count in counts:
+            docs = storefront_docs(count)
+            expected = await fastapi_render(field, copy.deepcopy(docs))
+            assert await fast_render(adapter, copy.deepcopy(docs)) == expected
+            baseline = await measure(fastapi_render, field, docs, repeat)
+            fast = await measure(fast_render, adapter, docs, repeat)
+            name = response_type.__args__[0].__name__
+            print(
+                f"{count:>7} {name:>20} {baseline:>11.1f} {fast:>11.1f} "
+                f"{baseline / fast:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.items, args.repeat))
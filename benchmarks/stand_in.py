@@ -0,0 +1,62 @@
+"""
+The in-memory stand-in for MongoDB used by `benchmarks.load --memory` and
+the tests: mongomock for the sync client, mongomock-motor for Motor, both
+on one store. Needs the tools of requirements-dev.txt.
+
+mongomock ignores indexes and query plans, so timings taken on it only
+say something about the CPU work of the app, not about its queries.
+"""
+
+from typing import Tuple
+
+import mongoengine
+import mongomock
+import mongomock.gridfs
+from mongomock_motor import (
+    AsyncMongoMockClient,
+    AsyncMongoMockCollection,
+    AsyncMongoMockDatabase,
+)
+
+
+class StandInCollection(AsyncMongoMockCollection):
+    """
+    Adds what Motor's GridFS bucket relies on and mongomock-motor lacks:
+    the `delegate` of a collection, and async sub-collections
+    (`bucket.collection.files`).
+    """
+
+    def __init__(self, database, collection: mongomock.Collection):
+        super().__init__(database, collection)
+        self.delegate = collection
+
+    def __getattr__(self, name: str):
+        value = super().__getattr__(name)
+        if isinstance(value, mongomock.Collection):
+            return StandInCollection(self.database, value)
+        return value
+
+
+class StandInDatabase(AsyncMongoMockDatabase):
+    def get_collection(self, *args, **kwargs) -> StandInCollection:
+        return StandInCollection(self, self.delegate.get_collection(*args, **kwargs))
+
+
+class StandInClient(AsyncMongoMockClient):
+    def __init__(self, client: mongomock.MongoClient):
+        super().__init__(mock_mongo_client=client)
+        self.delegate = client
+
+    def get_database(self, *args, **kwargs) -> StandInDatabase:
+        return StandInDatabase(self, self.delegate.get_database(*args, **kwargs))
+
+
+def connect(db: str) -> Tuple[mongomock.MongoClient, StandInClient]:
+    """
+    Register a mongomock client as the default mongoengine connection, and
+    return it with the Motor stand-in sharing its store.
+    """
+    # Lets GridFS and Motor's GridFS bucket accept the mock databases
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongoengine.connect(db=db, mongo_client_class=mongomock.MongoClient)
+    return client, StandInClient(client)
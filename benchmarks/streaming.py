@@ -0,0 +1,185 @@
+"""
+Compare the full JSON listing with the NDJSON streaming mode.
+
+Seeds N synthetic products into the database named by MONGO_DB (use a scratch
+database on a local mongod), then reads the whole listing once per mode, each
+in a fresh subprocess so peak RSS is measured independently:
+
+    python -m benchmarks.streaming --products 10000 50000 100000
+
+The modes are `full` (`/products` without a limit: one JSON array, the path
+before streaming existed), `pages` (500 products per request, following
+X-Next-Cursor) and `stream` (`?stream=true`). Requests are sent straight to
+the ASGI app, so time to first byte is when the app sends its first body
+chunk, not when a client has buffered the whole response. Reports time to
+first byte, total time and peak RSS for each mode.
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import sys
+import time
+from typing import Callable
+from urllib.parse import urlencode
+
+from bson import ObjectId
+from starlette.types import ASGIApp, Message
+
+from benchmarks.concurrency import build_app
+from mongo_engine.db import get_db
+from mongo_engine.read_model import rebuild
+
+SEED_BATCH_SIZE = 5000
+PAGE_SIZE = 500
+MODES = ("full", "pages", "stream")
+
+
+def seed(count: int) -> None:
+    db = get_db()
+    db.product.delete_many({"benchmark": True})
+    for start in range(0, count, SEED_BATCH_SIZE):
+        db.product.insert_many(
+            [
+                {
+                    "title": f"Benchmark product {index}",
+                    "title_lower": f"benchmark product {index}",
+                    "subtitle": "Synthetic product",
+                    "price": 10.0 + index % 100,
+                    "best_seller": index % 10 == 0,
+                    "images": [{"id": "Image01", "image_src": ObjectId()}],
+                    "benchmark": True,
+                }
+                for index in range(start, min(start + SEED_BATCH_SIZE, count))
+            ]
+        )
+    # The routes read the storefront projection, not the raw products
+    rebuild(db)
+
+
+async def get_products(
+    app: ASGIApp, params: dict, on_body: Callable[[bytes], None]
+) -> dict:
+    """
+    Send one GET /products to the ASGI app and pass each body chunk to
+    `on_body` as the app sends it. Returns the response headers.
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/products",
+        "raw_path": b"/products",
+        "root_path": "",
+        "query_string": urlencode(params).encode("ascii"),
+        "headers": [(b"host", b"bench")],
+        "server": ("bench", 80),
+        "client": ("127.0.0.1", 0),
+    }
+    headers = {}
+    requested = False
+    finished = asyncio.Event()
+
+    async def receive() -> Message:
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # Streaming responses listen for a disconnect until they are done
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers.update(
+                (name.decode("latin-1").lower(), value.decode("latin-1"))
+                for name, value in message["headers"]
+            )
+        elif message["type"] == "http.response.body":
+            on_body(message.get("body", b""))
+            if not message.get("more_body", False):
+                finished.set()
+
+    await app(scope, receive, send)
+    return headers
+
+
+async def read_listing(mode: str) -> dict:
+    app = build_app()
+    first_byte = None
+    lines = 0
+    chunks = []
+
+    def on_body(chunk: bytes) -> None:
+        nonlocal first_byte, lines
+        if not chunk:
+            return
+        first_byte = first_byte or time.perf_counter()
+        if mode == "stream":
+            # Counted as they arrive, streamed lines are not kept
+            lines += chunk.count(b"\n")
+        else:
+            chunks.append(chunk)
+
+    params = {"base_url": "http://bench"}
+    items = 0
+    started = time.perf_counter()
+    if mode == "pages":
+        params["limit"] = PAGE_SIZE
+        while True:
+            headers = await get_products(app, params, on_body)
+            items += len(json.loads(b"".join(chunks)))
+            chunks.clear()
+            if "x-next-cursor" not in headers:
+                break
+            params["after"] = headers["x-next-cursor"]
+    else:
+        if mode == "stream":
+            params["stream"] = "true"
+        await get_products(app, params, on_body)
+    finished = time.perf_counter()
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    if mode == "stream":
+        items = lines
+    elif mode == "full":
+        items = len(json.loads(b"".join(chunks)))
+    return {
+        "mode": mode,
+        "items": items,
+        "ttfb_ms": round((first_byte - started) * 1000, 1),
+        "total_ms": round((finished - started) * 1000, 1),
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+
+def main(counts) -> None:
+    print(f"{'products':>9} {'mode':>7} {'ttfb ms':>9} {'total ms':>9} {'rss MB':>8}")
+    for count in counts:
+        seed(count)
+        for mode in MODES:
+            output = subprocess.check_output(
+                [sys.executable, "-m", "benchmarks.streaming", "--read", mode]
+            )
+            result = json.loads(output)
+            print(
+                f"{count:>9} {mode:>7} {result['ttfb_ms']:>9} "
+                f"{result['total_ms']:>9} {result['peak_rss_mb']:>8}"
+            )
+    get_db().product.delete_many({"benchmark": True})
+    rebuild(get_db())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--read", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.read:
+        print(json.dumps(asyncio.run(read_listing(args.read))))
+    else:
+        main(args.products)
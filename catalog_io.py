@@ -0,0 +1,639 @@
+"""
+Bulk import and export of products and categories, as JSON lines or CSV.
+
+    python catalog_io.py import categories.csv --kind categories
+    python catalog_io.py import products.jsonl --images-dir ./photos
+    python catalog_io.py export products.csv --images-dir ./export
+
+Input is read and written in batches, so memory stays bounded whatever the
+size of the file. Products are upserted by lowercased title and categories
+by lowercased name, with one unordered bulk_write per batch, so re-running
+an import updates the same documents. A record is the full state of its
+document: optional fields it leaves out are removed.
+
+Product images are paths relative to `--images-dir`, or the ids of images
+already in the GridFS bucket. New files are processed by the upload worker
+pool (with the thumbnail `ImageField` generates) and stored with the sha256
+of their content, so a re-run reuses them instead of storing them again.
+Images that a re-import no longer references are left to gridfs_gc.py.
+
+Import the categories first: products name their category. The storefront
+read model is rebuilt at the end of an import.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import mongoengine as me
+from bson import ObjectId
+from gridfs import GridFS
+from PIL import Image as PILImage
+from pymongo import UpdateOne
+from pymongo.database import Database
+
+from mongo_engine import image_pipeline
+from mongo_engine.db import MONGO_BUCKET_NAME, ensure_image_indexes, get_db
+from mongo_engine.gridfs_cleanup import batched
+from mongo_engine.models.models import Category, Image, Product, ensure_indexes
+from mongo_engine.read_model import rebuild
+
+IMPORT_BATCH_SIZE = 1000
+HASH_READ_SIZE = 1 << 20
+# Separates the items of list columns in CSV files
+LIST_SEPARATOR = "|"
+
+PRODUCT_FIELDS = (
+    "title",
+    "subtitle",
+    "description",
+    "color",
+    "price",
+    "best_seller",
+    "dimension",
+    "weight",
+    "variant",
+)
+PRODUCT_COLUMNS = (
+    "title",
+    "subtitle",
+    "description",
+    "color",
+    "price",
+    "best_seller",
+    "category",
+    "variant",
+    "dimension_width",
+    "dimension_height",
+    "dimension_unit",
+    "weight",
+    "weight_unit",
+    "images",
+)
+CATEGORY_FIELDS = ("name", "description", "variants")
+CATEGORY_COLUMNS = ("name", "description", "variants", "images")
+# Fields an import removes from the stored document when its record lacks them
+PRODUCT_OPTIONAL = (
+    "subtitle",
+    "color",
+    "price",
+    "dimension",
+    "weight",
+    "variant",
+    "category",
+)
+CATEGORY_OPTIONAL = ("description",)
+
+Record = dict
+# An image reference resolves to its GridFS id, or to the reason it could not
+ImageResult = Union[ObjectId, Exception]
+# A line of an import file parses to a record, or to the reason it did not
+RecordResult = Union[Record, Exception]
+
+
+@dataclass
+class ImportReport:
+    read: int = 0
+    inserted: int = 0
+    updated: int = 0
+    images_stored: int = 0
+    images_reused: int = 0
+    errors: List[Tuple[int, str]] = field(default_factory=list)
+
+
+# CSV rows <-> records
+
+
+def split_list(value: Optional[str], separator: str = LIST_SEPARATOR) -> List[str]:
+    return [item.strip() for item in (value or "").split(separator) if item.strip()]
+
+
+def parse_bool(value: Optional[str]) -> bool:
+    return (value or "").strip().lower() in ("1", "true", "yes")
+
+
+def product_from_row(row: dict) -> Record:
+    record = {
+        key: row.get(key) or None
+        for key in ("title", "subtitle", "color", "price", "category", "variant")
+    }
+    # Description lines are the lines of the cell
+    record["description"] = (row.get("description") or "").splitlines()
+    record["best_seller"] = parse_bool(row.get("best_seller"))
+    if row.get("dimension_width") or row.get("dimension_height"):
+        record["dimension"] = {
+            "width": row.get("dimension_width") or None,
+            "height": row.get("dimension_height") or None,
+            "unit": row.get("dimension_unit") or None,
+        }
+    if row.get("weight"):
+        record["weight"] = {"Weight": row["weight"], "unit": row.get("weight_unit")}
+    record["images"] = split_list(row.get("images"))
+    return record
+
+
+def product_to_row(record: Record) -> dict:
+    dimension = record.get("dimension") or {}
+    weight = record.get("weight") or {}
+    return {
+        "title": record.get("title"),
+        "subtitle": record.get("subtitle"),
+        "description": "\n".join(record.get("description") or []),
+        "color": record.get("color"),
+        "price": record.get("price"),
+        "best_seller": "true" if record.get("best_seller") else "false",
+        "category": record.get("category"),
+        "variant": record.get("variant"),
+        "dimension_width": dimension.get("width"),
+        "dimension_height": dimension.get("height"),
+        "dimension_unit": dimension.get("unit"),
+        "weight": weight.get("Weight"),
+        "weight_unit": weight.get("unit"),
+        "images": LIST_SEPARATOR.join(record.get("images") or []),
+    }
+
+
+def category_from_row(row: dict) -> Record:
+    variants = []
+    # "Wood:1|Steel:2", variant names with their priority
+    for item in split_list(row.get("variants")):
+        name, _, priority = item.rpartition(":")
+        variants.append({"variant": name.strip(), "Priority": priority.strip()})
+    return {
+        "name": row.get("name") or None,
+        "description": row.get("description") or None,
+        "variants": variants,
+        "images": split_list(row.get("images")),
+    }
+
+
+def category_to_row(record: Record) -> dict:
+    return {
+        "name": record.get("name"),
+        "description": record.get("description"),
+        "variants": LIST_SEPARATOR.join(
+            f"{variant['variant']}:{variant['Priority']}"
+            for variant in record.get("variants") or []
+        ),
+        "images": LIST_SEPARATOR.join(record.get("images") or []),
+    }
+
+
+CSV_FORMATS = {
+    "products": (PRODUCT_COLUMNS, product_from_row, product_to_row),
+    "categories": (CATEGORY_COLUMNS, category_from_row, category_to_row),
+}
+
+
+def file_format(path: str, requested: Optional[str]) -> str:
+    if requested:
+        return requested
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def parse_line(line: str) -> RecordResult:
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        return ValueError(f"Invalid JSON: {e}")
+    if not isinstance(record, dict):
+        return ValueError(f"Expected a JSON object, got {type(record).__name__}")
+    return record
+
+
+def read_records(
+    path: str, kind: str, fmt: str
+) -> Iterator[Tuple[int, RecordResult]]:
+    """
+    Stream the records of a file with their line numbers. A line that is not
+    a record yields the reason instead, so the rest of the file still imports.
+    """
+    with open(path, newline="", encoding="utf-8") as file:
+        if fmt == "csv":
+            from_row = CSV_FORMATS[kind][1]
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, from_row(row)
+        else:
+            for line_number, line in enumerate(file, start=1):
+                if line.strip():
+                    yield line_number, parse_line(line)
+
+
+class RecordWriter:
+    def __init__(self, file, kind: str, fmt: str):
+        self.file = file
+        self.csv = None
+        if fmt == "csv":
+            columns, _, self.to_row = CSV_FORMATS[kind]
+            self.csv = csv.DictWriter(file, fieldnames=columns)
+            self.csv.writeheader()
+
+    def write(self, record: Record) -> None:
+        if self.csv is not None:
+            self.csv.writerow(self.to_row(record))
+        else:
+            self.file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+
+# Images
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_READ_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageIngest:
+    """
+    Resolves the image references of a batch of records to GridFS ids,
+    storing the files that are not in the bucket yet. Decoding and thumbnails
+    run in the upload worker pool; hashing and GridFS writes run on threads.
+    """
+
+    def __init__(self, db: Database, images_dir: str, threads: ThreadPoolExecutor):
+        self.fs = GridFS(db, MONGO_BUCKET_NAME)
+        self.files = db[f"{MONGO_BUCKET_NAME}.files"]
+        self.images_dir = images_dir
+        self.threads = threads
+        self.thumbnail_size = Image._fields["image_src"].thumbnail_size
+        self.stored = 0
+        self.reused = 0
+
+    def store(self, path: str, processed, digest: str) -> ObjectId:
+        try:
+            return image_pipeline.store(
+                self.fs,
+                processed,
+                os.path.basename(path),
+                mimetypes.guess_type(path)[0],
+                sha256=digest,
+            )
+        finally:
+            # Unchanged originals are stored straight from the source file
+            image_pipeline.remove_temporary_files(
+                p for p in (processed.path, processed.thumbnail_path) if p != path
+            )
+
+    def resolve(self, refs: Iterable[str]) -> Dict[str, ImageResult]:
+        results: Dict[str, ImageResult] = {}
+        paths: Dict[str, str] = {}
+        ids: Dict[str, ObjectId] = {}
+        for ref in set(refs):
+            path = os.path.join(self.images_dir, ref)
+            if os.path.isfile(path):
+                paths[ref] = path
+            elif ObjectId.is_valid(ref):
+                ids[ref] = ObjectId(ref)
+            else:
+                results[ref] = ValueError(f"Image not found: {ref}")
+
+        existing = set()
+        for batch in batched(list(ids.values())):
+            existing.update(
+                doc["_id"]
+                for doc in self.files.find({"_id": {"$in": batch}}, {"_id": 1})
+            )
+        for ref, file_id in ids.items():
+            if file_id in existing:
+                results[ref] = file_id
+            else:
+                results[ref] = ValueError(f"Unknown image id: {ref}")
+
+        digests = dict(zip(paths, self.threads.map(file_sha256, paths.values())))
+        by_digest: Dict[str, ImageResult] = {}
+        for batch in batched(list(set(digests.values()))):
+            for doc in self.files.find({"sha256": {"$in": batch}}, {"sha256": 1}):
+                by_digest[doc["sha256"]] = doc["_id"]
+        self.reused += len(by_digest)
+
+        # One upload per new content, however many references it has
+        new = {digest: paths[ref] for ref, digest in digests.items()}
+        pool = image_pipeline.get_pool()
+        processing = {
+            pool.submit(image_pipeline.process_image, path, self.thumbnail_size): digest
+            for digest, path in new.items()
+            if digest not in by_digest
+        }
+        storing = {}
+        for future in as_completed(processing):
+            digest = processing[future]
+            try:
+                processed = future.result()
+            except (OSError, ValueError, PILImage.DecompressionBombError) as e:
+                by_digest[digest] = me.ValidationError(
+                    "Invalid image: %s (%s)" % (new[digest], e)
+                )
+                continue
+            future = self.threads.submit(self.store, new[digest], processed, digest)
+            storing[future] = digest
+        for future in as_completed(storing):
+            by_digest[storing[future]] = future.result()
+            self.stored += 1
+
+        for ref, digest in digests.items():
+            results[ref] = by_digest[digest]
+        return results
+
+
+def image_entries(refs: List[str], images: Dict[str, ImageResult]) -> List[dict]:
+    """
+    The embedded images of a document, numbered the way `Product.save` does.
+    """
+    entries = []
+    for index, ref in enumerate(refs):
+        image = images[ref]
+        if isinstance(image, Exception):
+            raise image
+        entries.append({"id": f"Image{index + 1:02}", "image_src": image})
+    return entries
+
+
+# Import
+
+
+def upsert(key: str, doc: dict, optional: Iterable[str]) -> UpdateOne:
+    """
+    Upsert by `key`, setting the fields of `doc` and removing the `optional`
+    fields it lacks, so the document ends up as the record describes it.
+    """
+    update = {"$set": doc}
+    removed = {name: "" for name in optional if name not in doc}
+    if removed:
+        update["$unset"] = removed
+    if "created_at" in doc:
+        update["$setOnInsert"] = {"created_at": doc.pop("created_at")}
+    return UpdateOne({key: doc[key]}, update, upsert=True)
+
+
+def product_document(
+    record: Record, categories: Dict[str, ObjectId], images: Dict[str, ImageResult]
+) -> dict:
+    """
+    The stored form of a product record, as `Product.save` would write it.
+    """
+    if not record.get("title"):
+        raise ValueError("Missing title")
+    # Falsy values such as a price of 0 are kept, for validation to judge
+    values = {
+        name: record[name] for name in PRODUCT_FIELDS if record.get(name) is not None
+    }
+    category = record.get("category")
+    if category:
+        values["category"] = categories.get(category.lower())
+        if values["category"] is None:
+            raise ValueError(f"Unknown category: {category}")
+    product = Product(**values)
+    product.validate()
+    doc = product.to_mongo().to_dict()
+    doc["title_lower"] = doc["title"].lower()
+    doc["images"] = image_entries(record.get("images") or [], images)
+    return doc
+
+
+def category_document(record: Record, images: Dict[str, ImageResult]) -> dict:
+    if not record.get("name"):
+        raise ValueError("Missing name")
+    refs = record.get("images") or []
+    if len(refs) > Category._fields["images"].max_length:
+        raise ValueError(f"Too many images: {len(refs)}")
+    category = Category(
+        **{
+            name: record[name]
+            for name in CATEGORY_FIELDS
+            if record.get(name) is not None
+        }
+    )
+    category.validate()
+    doc = category.to_mongo().to_dict()
+    doc["name_lower"] = doc["name"].lower()
+    doc["images"] = image_entries(refs, images)
+    return doc
+
+
+def chunks(records: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(records)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def import_records(
+    db: Database,
+    kind: str,
+    records: Iterable[Tuple[int, RecordResult]],
+    images_dir: str,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    threads: int = 8,
+) -> ImportReport:
+    report = ImportReport()
+    if kind == "products":
+        collection, key, optional = db.product, "title_lower", PRODUCT_OPTIONAL
+    else:
+        collection, key, optional = db.category, "name_lower", CATEGORY_OPTIONAL
+    # Resolved once for the whole import
+    categories = {
+        doc["name_lower"]: doc["_id"]
+        for doc in db.category.find({"name_lower": {"$ne": None}}, {"name_lower": 1})
+    }
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        ingest = ImageIngest(db, images_dir, executor)
+        for batch in chunks(records, batch_size):
+            report.read += len(batch)
+            images = ingest.resolve(
+                ref
+                for _, record in batch
+                if not isinstance(record, Exception)
+                for ref in record.get("images") or []
+            )
+            # Keyed by the upsert key, so the last of duplicate records wins
+            updates: Dict[str, UpdateOne] = {}
+            for line, record in batch:
+                if isinstance(record, Exception):
+                    report.errors.append((line, str(record)))
+                    continue
+                try:
+                    if kind == "products":
+                        doc = product_document(record, categories, images)
+                    else:
+                        doc = category_document(record, images)
+                except (me.ValidationError, ValueError, TypeError) as e:
+                    report.errors.append((line, str(e)))
+                    continue
+                updates[doc[key]] = upsert(key, doc, optional)
+            if updates:
+                result = collection.bulk_write(list(updates.values()), ordered=False)
+                report.inserted += result.upserted_count
+                report.updated += result.matched_count
+        report.images_stored = ingest.stored
+        report.images_reused = ingest.reused
+    return report
+
+
+# Export
+
+
+def export_image(fs: GridFS, file_id: ObjectId, images_dir: str) -> str:
+    """
+    Write an image to `images_dir`, unless a previous export already did,
+    and return its path relative to the directory.
+    """
+    grid_out = fs.get(file_id)
+    extension = mimetypes.guess_extension(grid_out.content_type or "") or ""
+    name = f"{file_id}{extension}"
+    path = os.path.join(images_dir, name)
+    if not os.path.exists(path):
+        with open(path, "wb") as file:
+            for chunk in grid_out:
+                file.write(chunk)
+    return name
+
+
+def product_record(doc: dict, category_names: Dict[ObjectId, str]) -> Record:
+    record = {name: doc.get(name) for name in PRODUCT_FIELDS if name in doc}
+    if doc.get("category") in category_names:
+        record["category"] = category_names[doc["category"]]
+    return record
+
+
+def category_record(doc: dict) -> Record:
+    return {name: doc.get(name) for name in CATEGORY_FIELDS if name in doc}
+
+
+def export_records(
+    db: Database,
+    kind: str,
+    writer: RecordWriter,
+    images_dir: Optional[str],
+    batch_size: int = IMPORT_BATCH_SIZE,
+    threads: int = 8,
+) -> int:
+    """
+    Write every document of `kind`. Images are written as their GridFS ids,
+    or as files in `images_dir` when it is given.
+    """
+    collection = db.product if kind == "products" else db.category
+    category_names = {
+        doc["_id"]: doc.get("name") for doc in db.category.find({}, {"name": 1})
+    }
+    fs = GridFS(db, MONGO_BUCKET_NAME)
+    if images_dir:
+        os.makedirs(images_dir, exist_ok=True)
+    count = 0
+    cursor = collection.find(batch_size=batch_size).sort("_id", 1)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for batch in chunks(cursor, batch_size):
+            image_ids = {
+                image["image_src"]
+                for doc in batch
+                for image in doc.get("images") or []
+                if isinstance(image.get("image_src"), ObjectId)
+            }
+            refs = {file_id: str(file_id) for file_id in image_ids}
+            if images_dir:
+                names = executor.map(
+                    lambda file_id: export_image(fs, file_id, images_dir), image_ids
+                )
+                refs = dict(zip(image_ids, names))
+            for doc in batch:
+                if kind == "products":
+                    record = product_record(doc, category_names)
+                else:
+                    record = category_record(doc)
+                record["images"] = [
+                    refs[image["image_src"]]
+                    for image in doc.get("images") or []
+                    if image.get("image_src") in refs
+                ]
+                writer.write(record)
+                count += 1
+    return count
+
+
+def main(args) -> int:
+    db = get_db()
+    fmt = file_format(args.file, args.format)
+    started = time.perf_counter()
+    if args.command == "export":
+        with open(args.file, "w", newline="", encoding="utf-8") as file:
+            writer = RecordWriter(file, args.kind, fmt)
+            count = export_records(
+                db, args.kind, writer, args.images_dir, args.batch_size, args.threads
+            )
+        print(
+            f"Exported {count} {args.kind} to {args.file} "
+            f"in {time.perf_counter() - started:.1f}s."
+        )
+        return 0
+
+    # The upserts look documents up by their normalized name or title
+    ensure_indexes()
+    ensure_image_indexes()
+    try:
+        report = import_records(
+            db,
+            args.kind,
+            read_records(args.file, args.kind, fmt),
+            args.images_dir or os.path.dirname(os.path.abspath(args.file)),
+            args.batch_size,
+            args.threads,
+        )
+    finally:
+        image_pipeline.shutdown()
+    print(
+        f"Read {report.read} {args.kind}: {report.inserted} inserted, "
+        f"{report.updated} updated, {len(report.errors)} rejected. "
+        f"Images: {report.images_stored} stored, {report.images_reused} reused."
+    )
+    for line, error in report.errors:
+        print(f"  line {line}: {error}", file=sys.stderr)
+    if not args.no_rebuild:
+        count = rebuild(db)
+        if count is None:
+            print(
+                "The storefront read model is being rebuilt by another process, "
+                "run rebuild_read_model.py once it is done.",
+                file=sys.stderr,
+            )
+        else:
+            print(f"Rebuilt the storefront read model with {count} products.")
+    print(f"Done in {time.perf_counter() - started:.1f}s.")
+    return 1 if report.errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("file", help="JSON lines (.jsonl) or CSV (.csv) file")
+    parser.add_argument(
+        "--kind", choices=["products", "categories"], default="products"
+    )
+    parser.add_argument(
+        "--format", choices=["jsonl", "csv"], help="Default: from the file extension"
+    )
+    parser.add_argument(
+        "--images-dir",
+        help="Import: where image paths are relative to (default: the file's "
+        "directory). Export: write the images there instead of their ids",
+    )
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument(
+        "--threads", type=int, default=8, help="Threads hashing and storing images"
+    )
+    parser.add_argument(
+        "--no-rebuild",
+        action="store_true",
+        help="Skip the read model rebuild, e.g. before importing more files",
+    )
+    sys.exit(main(parser.parse_args()))
@@ -1,17 +1,9 @@
-from mongoengine import connect
+from mongo_engine.db import connection
 from mongo_engine.models.models import Admin
 from bcrypt import hashpw, gensalt
-from dotenv import load_dotenv
-import os
 
-# Load environment variables from .env file
-load_dotenv()
-
-# Connect to MongoDB Atlas using mongoengine
-connect(
-    db=os.getenv("MONGO_DB"),
-    host=os.getenv("MONGO_CONNECTION_URL"),
-)
+# Connect to MongoDB Atlas with the shared, configured client
+connection.connect()
 
 
 # Create an admin user
@@ -0,0 +1,165 @@
+import argparse
+import math
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from mongo_engine.db import get_db, MONGO_BUCKET_NAME
+from mongo_engine.gridfs_cleanup import (
+    batched,
+    delete_images,
+    BATCH_SIZE,
+    REFERENCING_COLLECTIONS,
+)
+
+
+def referenced_image_ids(db) -> set:
+    """
+    Stream the image ids referenced by products and categories into a set of
+    raw 12-byte ids, which keeps memory proportional to the number of images.
+    """
+    referenced = set()
+    for collection in REFERENCING_COLLECTIONS:
+        cursor = db[collection].find({}, {"images.image_src": 1}, batch_size=BATCH_SIZE)
+        for doc in cursor:
+            for image in doc.get("images") or []:
+                if isinstance(image.get("image_src"), ObjectId):
+                    referenced.add(image["image_src"].binary)
+    return referenced
+
+
+def add_thumbnail_ids(files, referenced: set) -> None:
+    """
+    Mark the thumbnails of referenced images as referenced too.
+    """
+    originals = [ObjectId(oid) for oid in referenced]
+    for batch in batched(originals):
+        cursor = files.find(
+            {"_id": {"$in": batch}, "thumbnail_id": {"$ne": None}}, {"thumbnail_id": 1}
+        )
+        for doc in cursor:
+            referenced.add(doc["thumbnail_id"].binary)
+
+
+def chunk_counts(chunks, file_ids: list) -> dict:
+    pipeline = [
+        {"$match": {"files_id": {"$in": file_ids}}},
+        {"$group": {"_id": "$files_id", "count": {"$sum": 1}}},
+    ]
+    return {doc["_id"]: doc["count"] for doc in chunks.aggregate(pipeline)}
+
+
+def scan(db, bucket_name: str, min_age: timedelta) -> dict:
+    """
+    Scan the bucket in batches and return the unreferenced files, the files
+    with missing chunks and the ids of chunks that have no file document.
+    Files and chunks younger than `min_age` are skipped, as they may belong
+    to an upload in progress.
+    """
+    files = db[f"{bucket_name}.files"]
+    chunks = db[f"{bucket_name}.chunks"]
+    cutoff = datetime.now(timezone.utc) - min_age
+
+    referenced = referenced_image_ids(db)
+    add_thumbnail_ids(files, referenced)
+
+    existing = set()
+    unreferenced = []
+    incomplete = []
+
+    def check_batch(batch: list) -> None:
+        counts = chunk_counts(chunks, [doc["_id"] for doc in batch])
+        for doc in batch:
+            expected = math.ceil(doc["length"] / doc["chunkSize"])
+            if counts.get(doc["_id"], 0) != expected:
+                incomplete.append(doc["_id"])
+
+    batch = []
+    cursor = files.find(
+        {},
+        {"length": 1, "chunkSize": 1, "uploadDate": 1, "metadata.variant_of": 1},
+        batch_size=BATCH_SIZE,
+    )
+    for doc in cursor:
+        existing.add(doc["_id"].binary)
+        variant_of = (doc.get("metadata") or {}).get("variant_of")
+        is_referenced = doc["_id"].binary in referenced or (
+            isinstance(variant_of, ObjectId) and variant_of.binary in referenced
+        )
+        too_recent = doc["uploadDate"].replace(tzinfo=timezone.utc) > cutoff
+        if not is_referenced and not too_recent:
+            unreferenced.append(doc["_id"])
+        batch.append(doc)
+        if len(batch) >= BATCH_SIZE:
+            check_batch(batch)
+            batch = []
+    if batch:
+        check_batch(batch)
+
+    # Sorting on files_id lets the server walk the files_id_1_n_1 index
+    orphan_chunk_file_ids = []
+    pipeline = [{"$sort": {"files_id": 1}}, {"$group": {"_id": "$files_id"}}]
+    for doc in chunks.aggregate(pipeline, allowDiskUse=True):
+        files_id = doc["_id"]
+        if (
+            isinstance(files_id, ObjectId)
+            and files_id.binary not in existing
+            and files_id.generation_time <= cutoff
+        ):
+            orphan_chunk_file_ids.append(files_id)
+
+    return {
+        "referenced": len(referenced),
+        "files": len(existing),
+        "unreferenced": unreferenced,
+        "incomplete": incomplete,
+        "orphan_chunks": orphan_chunk_file_ids,
+    }
+
+
+def collect_garbage(delete: bool, min_age_hours: float, verbose: bool) -> None:
+    db = get_db()
+    report = scan(db, MONGO_BUCKET_NAME, timedelta(hours=min_age_hours))
+
+    print(f"Referenced images and thumbnails: {report['referenced']}")
+    print(f"Files in bucket '{MONGO_BUCKET_NAME}': {report['files']}")
+    print(f"Unreferenced files: {len(report['unreferenced'])}")
+    print(f"Files with missing chunks: {len(report['incomplete'])}")
+    print(f"Chunk groups without a file document: {len(report['orphan_chunks'])}")
+    if verbose:
+        for name in ("unreferenced", "incomplete", "orphan_chunks"):
+            for file_id in report[name]:
+                print(f"  {name}: {file_id}")
+
+    if not delete:
+        print("Dry run, pass --delete to remove unreferenced files and orphan chunks.")
+        return
+
+    result = delete_images(db, MONGO_BUCKET_NAME, report["unreferenced"])
+    chunks = db[f"{MONGO_BUCKET_NAME}.chunks"]
+    removed_chunks = 0
+    for batch in batched(report["orphan_chunks"]):
+        removed_chunks += chunks.delete_many({"files_id": {"$in": batch}}).deleted_count
+    print(f"Deleted {len(result.deleted)} files and {removed_chunks} orphan chunks.")
+    for file_id, error in result.failed.items():
+        print(f"Error deleting file with ID {file_id}: {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find and remove unreferenced or broken files in the GridFS bucket."
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="Delete what is found (default: report only)",
+    )
+    parser.add_argument(
+        "--min-age-hours",
+        type=float,
+        default=24,
+        help="Ignore files and chunks newer than this, they may be uploads in progress",
+    )
+    parser.add_argument("--verbose", action="store_true", help="List every file id")
+    args = parser.parse_args()
+    collect_garbage(args.delete, args.min_age_hours, args.verbose)
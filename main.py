@@ -1,6 +1,9 @@
-from mongoengine import connect
-import os
-from dotenv import load_dotenv
+import time
+
+# Start of the import, for the import-to-ready time logged once warmed up
+IMPORTED_AT = time.perf_counter()
+
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from starlette_admin import DropDown
 from starlette_admin import I18nConfig
@@ -11,22 +14,35 @@ from starlette.middleware import Middleware
 from starlette.middleware.sessions import SessionMiddleware
 from mongo_engine.Routes.categoryRoutes import router as categoryRouter
 from mongo_engine.Routes.productRoutes import router as productRouter
+from mongo_engine.Routes.imageRoutes import router as imageRouter
+from mongo_engine.category_cache import category_cache
+from mongo_engine.image_cache import image_cache
+from mongo_engine.config import settings
+from mongo_engine.db import (
+    ReadYourWritesMiddleware,
+    connection,
+    ensure_image_indexes,
+    get_db,
+)
+from mongo_engine import image_pipeline
+from mongo_engine.metrics import (
+    METRICS_ENABLED,
+    METRICS_PATH,
+    MetricsMiddleware,
+    metrics_endpoint,
+    registry,
+)
+from mongo_engine.read_model import ensure_read_model
+from mongo_engine.response_cache import ResponseCacheMiddleware, response_cache
+from mongo_engine.startup import liveness, readiness, startup
 from fastapi.middleware.cors import CORSMiddleware
 
-load_dotenv()
-
-MONGO_URL = os.environ.get("MONGO_URL")
-ORIGIN_URL = os.environ.get("ORIGIN_NAME")
-SECRET_KEY = os.environ.get("SECRET_KEY")
-
 # from app.config import config
-from mongo_engine.models.models import Product, Category
+from mongo_engine.models.models import Product, Category, ensure_indexes
 from mongo_engine.views import CategoryView, ProductView
 
 __all__ = ["admin", "connection"]
 
-connection = connect(host=MONGO_URL)
-
 admin = Admin(
     "MongoEngine Admin",
     base_url="/",
@@ -35,7 +51,7 @@ admin = Admin(
     login_logo_url="https://preview.tabler.io/static/logo.svg",
     templates_dir="templates/",
     auth_provider=MyAuthProvider(login_path="/sign-in", logout_path="/sign-out"),
-    middlewares=[Middleware(SessionMiddleware, secret_key=SECRET_KEY)],
+    middlewares=[Middleware(SessionMiddleware, secret_key=settings.secret_key)],
     i18n_config=I18nConfig(language_switcher=["en", "fr"]),
 )
 
@@ -50,19 +66,63 @@ admin.add_view(
 admin.add_view(Link(label="Go Back to Home", icon="fa fa-link", url="/product/list"))
 
 
-app = FastAPI()
+def prepare_database():
+    # The first statements that need the server, retried by startup until it is up
+    ensure_indexes()
+    ensure_image_indexes()
+    ensure_read_model(get_db())
+    # Optional change-stream refresh of the category cache (needs a replica set)
+    if settings.category_cache_watch:
+        category_cache.watch(get_db())
+
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One shared pool for the whole process. Creating the clients does not wait
+    # for the server; indexes and warmup run in the background, see /readyz.
+    connection.connect()
+    startup.start(app, prepare_database, IMPORTED_AT)
+    yield
+    await startup.stop()
+    image_pipeline.shutdown()
+    image_cache.close()
+    connection.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Added before CORS so cached responses get CORS headers per request
+app.add_middleware(ResponseCacheMiddleware, cache=response_cache)
+# Sets the cookie that sends an admin's storefront reads to the primary after a write
+app.add_middleware(ReadYourWritesMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
     # allow_origins="http://192.168.29.147:3000",
-    allow_origins=ORIGIN_URL,
+    allow_origins=settings.origin_url,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+if METRICS_ENABLED:
+    # Outermost, so the timings include the cache and CORS middlewares
+    app.add_middleware(MetricsMiddleware)
+    app.add_route(METRICS_PATH, metrics_endpoint, include_in_schema=False)
+    registry.add_collector("mongo_pool", connection.stats)
+    registry.add_collector("category_cache", category_cache.stats)
+    registry.add_collector("image_cache", image_cache.stats)
+    registry.add_collector("response_cache", response_cache.stats)
+
+
+# Liveness and readiness probes, registered before the admin mounted at "/"
+app.add_route("/healthz", liveness, include_in_schema=False)
+app.add_route("/readyz", readiness, include_in_schema=False)
+
+
 app.include_router(categoryRouter)
 app.include_router(productRouter)
+app.include_router(imageRouter)
 
 admin.mount_to(app)
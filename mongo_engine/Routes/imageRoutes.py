@@ -0,0 +1,415 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from io import BytesIO
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+import anyio
+from bson import ObjectId
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket, AsyncIOMotorGridOut
+from PIL import Image as PILImage
+from starlette.concurrency import run_in_threadpool
+
+from mongo_engine.config import env_int, env_list
+from mongo_engine.db import get_async_bucket
+from mongo_engine.image_cache import CachedImage, image_cache
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# Load every PIL image plugin so PILImage.MIME knows all formats
+PILImage.init()
+
+# GridFS files never change for a given ObjectId, so they can be cached forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+FILE_READ_SIZE = 256 * 1024
+
+# Variants are only generated for these widths; requests are rounded up to one
+IMAGE_VARIANT_WIDTHS = sorted(
+    int(width)
+    for width in env_list("IMAGE_VARIANT_WIDTHS", "128,256,480,768,1024,1600")
+)
+IMAGE_VARIANT_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+IMAGE_VARIANT_QUALITY = env_int("IMAGE_VARIANT_QUALITY", 80)
+THUMBNAIL_WIDTH = 128
+# Raised by Pillow for files it cannot decode (UnidentifiedImageError is an
+# OSError), for oversized ones, and for formats it cannot write
+UNRENDERABLE_ERRORS = (OSError, ValueError, PILImage.DecompressionBombError)
+
+# Ids of thumbnails and generated variants, keyed by (original id, ...)
+_derived_ids: Dict[tuple, ObjectId] = {}
+_derived_ids_max = 100_000
+_variant_locks: Dict[tuple, asyncio.Lock] = {}
+
+
+def as_utc(value: datetime) -> datetime:
+    # PyMongo returns naive UTC datetimes unless tz_aware, and HTTP dates
+    # with a -0000 offset parse as naive ones
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def file_headers(file_doc: dict) -> dict:
+    """
+    Validators and caching headers of a GridFS file.
+    """
+    upload_date = as_utc(file_doc["uploadDate"])
+    return {
+        "ETag": f'"{file_doc.get("md5") or file_doc["_id"]}"',
+        "Last-Modified": format_datetime(upload_date, usegmt=True),
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+
+
+def file_content_type(file_doc: dict) -> str:
+    # Thumbnails written by mongoengine only carry the PIL format name,
+    # generated variants keep it in their metadata
+    metadata = file_doc.get("metadata") or {}
+    return (
+        file_doc.get("contentType")
+        or metadata.get("contentType")
+        or PILImage.MIME.get(file_doc.get("format") or "")
+        or "application/octet-stream"
+    )
+
+
+def is_not_modified(request: Request, headers: dict) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in etags or headers["ETag"] in etags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # Last-Modified has whole seconds, unlike uploadDate
+        return as_utc(parsedate_to_datetime(headers["Last-Modified"])) <= as_utc(since)
+    return False
+
+
+def parse_range(
+    request: Request, headers: dict, length: int
+) -> Optional[Tuple[int, int]]:
+    """
+    Return the inclusive byte range requested by a single-range `Range` header,
+    or None to serve the whole file. Raises 416 if the range cannot be satisfied.
+    """
+    range_header = request.headers.get("range")
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range and if_range not in (headers["ETag"], headers["Last-Modified"]):
+        return None
+    spec = range_header[len("bytes=") :].strip()
+    if "," in spec:
+        # Multipart ranges are not supported, fall back to the full body
+        return None
+    start, _, end = spec.partition("-")
+    try:
+        if start:
+            first = int(start)
+            last = int(end) if end else length - 1
+        else:
+            # Suffix range: the last N bytes
+            first = max(length - int(end), 0)
+            last = length - 1
+    except ValueError:
+        return None
+    if first >= length or first > last:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{length}"},
+        )
+    return first, min(last, length - 1)
+
+
+async def iter_file(grid_out: AsyncIOMotorGridOut, first: int, last: int):
+    """
+    Yield the bytes `first`..`last` of a GridFS file, starting from the chunk
+    that contains `first`.
+    """
+    grid_out.seek(first)
+    remaining = last - first + 1
+    while remaining > 0:
+        data = await grid_out.read(min(remaining, grid_out.chunk_size))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+async def iter_cached_file(path: str, first: int, last: int):
+    async with await anyio.open_file(path, "rb") as f:
+        await f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            data = await f.read(min(remaining, FILE_READ_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+async def load_image(bucket: AsyncIOMotorGridFSBucket, image_id: str) -> CachedImage:
+    """
+    Return the image from the cache, reading it from GridFS on a miss. Files
+    too large for the cache are returned without data so they get streamed.
+    Cached entries are revalidated as `ImageCache.stale` says.
+    """
+    cached = image_cache.get(image_id)
+    if cached:
+        if not image_cache.stale(cached):
+            return cached
+        # Deleted through another worker, whose discard never reached this cache
+        exists = await bucket.collection.files.find_one(
+            {"_id": ObjectId(image_id)}, {"_id": 1}
+        )
+        if exists:
+            image_cache.mark_checked(cached)
+            return cached
+        image_cache.discard([image_id])
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    file_doc = await bucket.collection.files.find_one({"_id": ObjectId(image_id)})
+    if not file_doc:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if not image_cache.cacheable(file_doc["length"]):
+        return CachedImage(file_doc=file_doc, size=file_doc["length"])
+
+    grid_out = AsyncIOMotorGridOut(bucket.collection, file_document=file_doc)
+    return await image_cache.put(file_doc, await grid_out.read())
+
+
+def remember_derived_id(key: tuple, file_id: ObjectId) -> None:
+    if len(_derived_ids) >= _derived_ids_max:
+        _derived_ids.clear()
+    _derived_ids[key] = file_id
+
+
+async def read_image_bytes(
+    bucket: AsyncIOMotorGridFSBucket, image: CachedImage
+) -> bytes:
+    if image.data is not None:
+        return image.data
+    if image.path is not None and os.path.exists(image.path):
+        async with await anyio.open_file(image.path, "rb") as f:
+            return await f.read()
+    grid_out = AsyncIOMotorGridOut(bucket.collection, file_document=image.file_doc)
+    return await grid_out.read()
+
+
+def render_variant(data: bytes, width: int, image_format: Optional[str]) -> bytes:
+    """
+    Resize an image to at most `width` pixels wide, keeping its aspect ratio,
+    and encode it as `image_format` (the original format when None).
+    """
+    with PILImage.open(BytesIO(data)) as img:
+        image_format = image_format or img.format
+        img.thumbnail((width, img.height), PILImage.LANCZOS)
+        if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        output = BytesIO()
+        img.save(output, image_format, quality=IMAGE_VARIANT_QUALITY)
+        return output.getvalue()
+
+
+async def load_variant(
+    bucket: AsyncIOMotorGridFSBucket,
+    image_id: str,
+    width: int,
+    image_format: Optional[str],
+) -> CachedImage:
+    """
+    Return a width-bounded (and optionally re-encoded) variant of an image.
+    Variants are generated once with Pillow, stored back in GridFS with a
+    `metadata.variant_of` reference to the original, and reused afterwards.
+    """
+    original = await load_image(bucket, image_id)
+    original_format = original.file_doc.get("format")
+    if (
+        width >= (original.file_doc.get("width") or width + 1)
+        and image_format in (None, original_format)
+    ):
+        # No point in storing a copy of the original
+        return original
+
+    key = (image_id, width, image_format)
+    variant_id = _derived_ids.get(key)
+    if variant_id is None:
+        lock = _variant_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            variant_id = _derived_ids.get(key)
+            if variant_id is None:
+                variant_filter = {
+                    "metadata.variant_of": ObjectId(image_id),
+                    "metadata.width": width,
+                    "metadata.format": image_format,
+                }
+                variant = await bucket.collection.files.find_one(
+                    variant_filter, {"_id": 1}
+                )
+                if variant:
+                    variant_id = variant["_id"]
+                else:
+                    data = await read_image_bytes(bucket, original)
+                    try:
+                        rendered = await run_in_threadpool(
+                            render_variant, data, width, image_format
+                        )
+                    except UNRENDERABLE_ERRORS as e:
+                        # Serve the stored file as is, and stop trying for this key
+                        logger.warning(
+                            "Cannot render a variant of %s: %s", image_id, e
+                        )
+                        remember_derived_id(key, ObjectId(image_id))
+                        _variant_locks.pop(key, None)
+                        return original
+                    output_format = image_format or original_format
+                    variant_id = await bucket.upload_from_stream(
+                        f"{image_id}-{width}w.{(output_format or 'img').lower()}",
+                        rendered,
+                        metadata={
+                            "variant_of": ObjectId(image_id),
+                            "width": width,
+                            "format": image_format,
+                            "contentType": PILImage.MIME.get(output_format or ""),
+                        },
+                    )
+                remember_derived_id(key, variant_id)
+        _variant_locks.pop(key, None)
+    return await load_image(bucket, str(variant_id))
+
+
+def serve_image(
+    request: Request, bucket: AsyncIOMotorGridFSBucket, image: CachedImage
+):
+    """
+    Build the response for an image, from the cache when it holds the bytes.
+    Supports conditional requests (ETag / Last-Modified) and single byte ranges.
+    """
+    file_doc = image.file_doc
+
+    headers = file_headers(file_doc)
+    if is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    length = file_doc["length"]
+    byte_range = parse_range(request, headers, length)
+    if byte_range:
+        first, last = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {first}-{last}/{length}"
+    else:
+        first, last = 0, length - 1
+        status_code = 200
+    headers["Content-Length"] = str(last - first + 1)
+    media_type = file_content_type(file_doc)
+
+    if image.data is not None:
+        image_cache.record_served(last - first + 1)
+        return Response(
+            image.data[first : last + 1],
+            status_code=status_code,
+            headers=headers,
+            media_type=media_type,
+        )
+    if image.path is not None and os.path.exists(image.path):
+        image_cache.record_served(last - first + 1)
+        if status_code == 200:
+            return FileResponse(image.path, headers=headers, media_type=media_type)
+        return StreamingResponse(
+            iter_cached_file(image.path, first, last),
+            status_code=status_code,
+            headers=headers,
+            media_type=media_type,
+        )
+
+    # The file document is already loaded, so opening the stream costs no query
+    grid_out = AsyncIOMotorGridOut(bucket.collection, file_document=file_doc)
+    return StreamingResponse(
+        iter_file(grid_out, first, last),
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type,
+    )
+
+
+@router.get("/images/{image_id}")
+async def get_image(
+    image_id: str,
+    request: Request,
+    width: Optional[int] = Query(
+        default=None,
+        ge=1,
+        description="Maximum width, rounded up to one of the generated variant widths",
+    ),
+    output_format: Optional[str] = Query(
+        default=None, alias="format", description="Re-encode the image: webp or jpeg"
+    ),
+    bucket: AsyncIOMotorGridFSBucket = Depends(get_async_bucket),
+):
+    """
+    Fetch image by ID from GridFS, through the local image cache.
+    With `width` and/or `format`, serve a resized or re-encoded variant instead.
+    """
+    if not ObjectId.is_valid(image_id):
+        raise HTTPException(status_code=400, detail="Invalid image ID format")
+    if output_format is not None and output_format.lower() not in IMAGE_VARIANT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported image format")
+
+    if width is None and output_format is None:
+        image = await load_image(bucket, image_id)
+    else:
+        variant_width = IMAGE_VARIANT_WIDTHS[-1]
+        if width is not None:
+            variant_width = next(
+                (w for w in IMAGE_VARIANT_WIDTHS if w >= width), variant_width
+            )
+        image_format = (
+            IMAGE_VARIANT_FORMATS[output_format.lower()] if output_format else None
+        )
+        image = await load_variant(bucket, image_id, variant_width, image_format)
+    return serve_image(request, bucket, image)
+
+
+@router.get("/images/{image_id}/thumbnail")
+async def get_thumbnail(
+    image_id: str,
+    request: Request,
+    bucket: AsyncIOMotorGridFSBucket = Depends(get_async_bucket),
+):
+    """
+    Fetch the thumbnail generated by `ImageField` for an image. Images stored
+    without one get a width-bounded variant instead.
+    """
+    if not ObjectId.is_valid(image_id):
+        raise HTTPException(status_code=400, detail="Invalid image ID format")
+
+    key = (image_id, "thumbnail")
+    thumbnail_id = _derived_ids.get(key)
+    if thumbnail_id is None:
+        cached = image_cache.peek(image_id)
+        file_doc = (
+            cached.file_doc
+            if cached
+            else await bucket.collection.files.find_one(
+                {"_id": ObjectId(image_id)}, {"thumbnail_id": 1}
+            )
+        )
+        if not file_doc:
+            raise HTTPException(status_code=404, detail="Image not found")
+        thumbnail_id = file_doc.get("thumbnail_id")
+        if thumbnail_id is None:
+            image = await load_variant(bucket, image_id, THUMBNAIL_WIDTH, None)
+            return serve_image(request, bucket, image)
+        remember_derived_id(key, thumbnail_id)
+    return serve_image(request, bucket, await load_image(bucket, str(thumbnail_id)))
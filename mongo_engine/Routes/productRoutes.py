@@ -1,69 +1,421 @@
 # router.py
 
-from fastapi import APIRouter, HTTPException, Depends, Query
-import os
-from dotenv import load_dotenv
-from typing import List, Optional
-from pymongo.database import Database
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
+import base64
+import json
+from typing import List, Optional, Tuple, Type
+from pydantic import BaseModel
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson import ObjectId
+from pymongo.errors import ExecutionTimeout
 from mongo_engine.models.pydantic_models import (
     ProductModel,
     ProductSummaryModel,
     BestSellerModel,
+    ProductFacetsModel,
 )
-from mongo_engine.db import get_db
-
-load_dotenv()
+from mongo_engine.db import get_async_db
+from mongo_engine.category_cache import category_cache
+from mongo_engine.read_model import MAX_PREFIX_LENGTH, STOREFRONT_COLLECTION, words
+from mongo_engine.encoding import render, type_adapter
+from mongo_engine.config import env_int, env_list, settings
 
 router = APIRouter()
-BASE_URL = os.environ.get("BASE_URL")
+BASE_URL = settings.base_url
+DEFAULT_PAGE_SIZE = env_int("DEFAULT_PAGE_SIZE", 100)
+MAX_PAGE_SIZE = env_int("MAX_PAGE_SIZE", 500)
+STREAM_BATCH_SIZE = env_int("STREAM_BATCH_SIZE", 500)
+SEARCH_DEFAULT_LIMIT = env_int("SEARCH_DEFAULT_LIMIT", 20)
+SEARCH_MAX_LIMIT = env_int("SEARCH_MAX_LIMIT", 50)
+SEARCH_MAX_TIME_MS = env_int("SEARCH_MAX_TIME_MS", 2000)
+SEARCH_MAX_TERMS = 5
+# Lower boundaries of the price facet buckets; the last bucket is open-ended
+PRICE_BUCKETS = [
+    float(boundary)
+    for boundary in env_list("PRICE_BUCKETS", "0,50,100,250,500,1000")
+]
+
+# Storefront documents are already in response shape, only bookkeeping fields are dropped
+PRODUCT_PROJECTION = {"title_lower": 0, "title_prefixes": 0, "priority": 0, "v": 0}
+SUMMARY_PROJECTION = {
+    "title": 1,
+    "subtitle": 1,
+    "images": {"$slice": 1},
+    "priority": 1,
+}
+
+PRODUCT_ADAPTER = type_adapter(ProductModel)
+PRODUCT_LIST_ADAPTER = type_adapter(List[ProductSummaryModel])
+BESTSELLER_LIST_ADAPTER = type_adapter(List[BestSellerModel])
+FACETS_ADAPTER = type_adapter(ProductFacetsModel)
+
+
+def value_counts(field: str) -> list:
+    return [
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}},
+        {"$project": {"_id": 0, "value": "$_id", "count": 1}},
+    ]
+
+
+def price_buckets(buckets: list, unpriced: list) -> list:
+    """
+    Price facet buckets as {min, max, count}. Prices above the last
+    boundary fall in the open-ended top bucket; products without a price
+    are counted in a last bucket with neither bound.
+    """
+    bounds = dict(zip(PRICE_BUCKETS, PRICE_BUCKETS[1:]))
+    facet = [
+        {
+            "min": PRICE_BUCKETS[-1] if bucket["_id"] == "other" else bucket["_id"],
+            "max": bounds.get(bucket["_id"]),
+            "count": bucket["count"],
+        }
+        for bucket in buckets
+    ]
+    if unpriced:
+        facet.append({"min": None, "max": None, "count": unpriced[0]["count"]})
+    return facet
 
 
-def serialize_doc(doc, base_url: str, db: Database):
+def serialize_doc(doc, base_url: str, thumbnails: bool = False):
     """
-    Serialize a MongoDB document to convert ObjectId to string
-    and generate URL for images.
+    Serialize a storefront document: convert the ObjectId to a string and
+    prefix the stored image paths with `base_url`. Everything else (category
+    name, variant priority) is already resolved in the read model.
+    With `thumbnails`, image URLs point to the stored thumbnails instead of
+    the full-size originals.
     """
     if "_id" in doc:
         doc["_id"] = str(doc["_id"])
-    # Replace category ObjectId with category name
-    if "category" in doc and isinstance(doc["category"], ObjectId):
-        category = db.category.find_one({"_id": ObjectId(doc["category"])})
-        doc["category"] = category["name"] if category else "Unknown"
     if "images" in doc:
-        for image in doc["images"]:
-            if "image_src" in image and isinstance(image["image_src"], ObjectId):
-                image["image_src"] = (
-                    f"{base_url}/images/{image['image_src']}"  # Generate image URL
-                )
+        doc["images"] = [
+            {
+                "id": image["id"],
+                "image_src": base_url
+                + (image["thumbnail_src"] if thumbnails else image["image_src"]),
+            }
+            for image in doc["images"]
+        ]
     return doc
 
 
-def serialize_list(cursor, base_url: str, db: Database):
-    return [serialize_doc(doc, base_url, db) for doc in cursor]
+async def serialize_list(cursor, base_url: str, thumbnails: bool = False):
+    return [serialize_doc(doc, base_url, thumbnails) async for doc in cursor]
+
+
+async def stream_ndjson(
+    cursor,
+    model: Type[BaseModel],
+    base_url: str,
+    thumbnails: bool = False,
+):
+    """
+    Serialize documents as NDJSON while they are read from the cursor,
+    validating each one against `model`. Lines are flushed once per batch.
+    """
+    lines = []
+    async for doc in cursor:
+        item = model.model_validate(serialize_doc(doc, base_url, thumbnails))
+        lines.append(item.model_dump_json(by_alias=True))
+        if len(lines) >= STREAM_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def reject_paged_stream(stream: bool, limit: Optional[int], after: Optional[str]):
+    """
+    A stream is the whole listing: its headers are sent before the last
+    product is read, so there is no X-Next-Cursor to page with.
+    """
+    if stream and (limit is not None or after):
+        raise HTTPException(
+            status_code=400, detail="stream cannot be combined with limit or after"
+        )
+
+
+def encode_cursor(values: list) -> str:
+    """
+    Encode the sort key of the last item of a page into an opaque cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if (
+            isinstance(values, list)
+            and len(values) == size
+            and ObjectId.is_valid(values[-1])
+        ):
+            return values
+    except ValueError:
+        pass
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def category_filter(
+    db: AsyncIOMotorDatabase, category_name: Optional[str], variant: Optional[str]
+) -> Tuple[dict, list]:
+    """
+    Resolve the category and variant filters of a listing into a storefront
+    query, and return it with the category's variants (empty without one).
+    Raises 404 for an unknown category or a variant the category lacks.
+    """
+    query = {}
+    category_variants = []
+
+    # Step 1: Filter by Category
+    if category_name:
+        # Case-insensitive search for category name
+        category = await category_cache.get_by_name(db, category_name)
+
+        if not category:
+            raise HTTPException(status_code=404, detail="Category not found")
+
+        query["category_id"] = category["_id"]
+
+        # Fetch the variant priorities from the category
+        category_variants = category.get("variants", [])
+
+        # Step 2: If a variant is provided, filter by it
+        if variant:
+            variant_names = [v["variant"].lower() for v in category_variants]
+            if variant.lower() in variant_names:
+                query["variant"] = variant
+            else:
+                raise HTTPException(
+                    status_code=404, detail="Variant not found in the category"
+                )
+    return query, category_variants
+
+
+def listing_order(sort_by_priority: bool, after: Optional[str]) -> Tuple[list, dict]:
+    """
+    Sort of a listing and the filter that resumes it after the `after` cursor.
+    """
+    if sort_by_priority:
+        if not after:
+            return [("priority", 1), ("_id", 1)], {}
+        priority, last_id = decode_cursor(after, 2)
+        after_filter = {
+            "$or": [
+                {"priority": {"$gt": priority}},
+                {"priority": priority, "_id": {"$gt": ObjectId(last_id)}},
+            ]
+        }
+        return [("priority", 1), ("_id", 1)], after_filter
+    # If no category_name or variant is mentioned, return products in insertion order
+    if not after:
+        return [("_id", 1)], {}
+    (last_id,) = decode_cursor(after, 1)
+    return [("_id", 1)], {"_id": {"$gt": ObjectId(last_id)}}
+
+
+def next_cursor(last: dict, sort_by_priority: bool) -> str:
+    return encode_cursor(
+        [last["priority"], last["_id"]] if sort_by_priority else [last["_id"]]
+    )
+
+
+# Declared before /products/{product_name}, which would otherwise match them
+@router.get("/products/facets", response_model=ProductFacetsModel)
+async def get_product_facets(
+    request: Request,
+    response: Response,
+    base_url: str = Query(default=BASE_URL, description="Base URL for image paths"),
+    category_name: Optional[str] = Query(
+        default=None, description="Name of the category to filter products"
+    ),
+    variant: Optional[str] = Query(
+        default=None, description="Variant name to filter products within the category"
+    ),
+    color: Optional[str] = Query(default=None, description="Exact color to filter by"),
+    min_price: Optional[float] = Query(default=None, ge=0),
+    max_price: Optional[float] = Query(default=None, ge=0),
+    best_seller: Optional[bool] = Query(default=None),
+    limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = Query(
+        default=None, description="Cursor from the X-Next-Cursor header of the previous page"
+    ),
+    db: AsyncIOMotorDatabase = Depends(get_async_db),
+):
+    """
+    Get a page of products together with the counts of every match per
+    variant, color, price bucket and best_seller, in a single `$facet`
+    aggregation. Category, variant, ordering and cursors behave as in
+    `get_products_by_category`; the cursor only moves the product page,
+    the counts always cover all matches.
+    """
+    try:
+        query, category_variants = await category_filter(db, category_name, variant)
+        if color:
+            query["color"] = color
+        if min_price is not None or max_price is not None:
+            query["price"] = {}
+            if min_price is not None:
+                query["price"]["$gte"] = min_price
+            if max_price is not None:
+                query["price"]["$lte"] = max_price
+        if best_seller is not None:
+            query["best_seller"] = best_seller
+
+        sort_by_priority = bool(category_name and not variant and category_variants)
+        sort, after_filter = listing_order(sort_by_priority, after)
+        page = [{"$match": after_filter}] if after_filter else []
+        page += [
+            {"$limit": limit + 1},
+            {
+                "$project": {
+                    "title": 1,
+                    "subtitle": 1,
+                    "images": {"$slice": ["$images", 1]},
+                    "priority": 1,
+                }
+            },
+        ]
+        pipeline = [
+            {"$match": query},
+            # Sorting before $facet lets the listing indexes serve the order
+            {"$sort": dict(sort)},
+            {
+                "$facet": {
+                    "products": page,
+                    "total": [{"$count": "count"}],
+                    "variant": value_counts("variant"),
+                    "color": value_counts("color"),
+                    "price": [
+                        # Only numbers, or missing prices land in the top bucket
+                        {"$match": {"price": {"$type": "number"}}},
+                        {
+                            "$bucket": {
+                                "groupBy": "$price",
+                                "boundaries": PRICE_BUCKETS,
+                                "default": "other",
+                                "output": {"count": {"$sum": 1}},
+                            }
+                        }
+                    ],
+                    "unpriced": [
+                        {"$match": {"price": {"$not": {"$type": "number"}}}},
+                        {"$count": "count"},
+                    ],
+                    "best_seller": value_counts("best_seller"),
+                }
+            },
+        ]
+        (result,) = await db[STOREFRONT_COLLECTION].aggregate(pipeline).to_list(1)
+
+        products = [
+            serialize_doc(doc, base_url, thumbnails=True) for doc in result["products"]
+        ]
+        if len(products) > limit:
+            products = products[:limit]
+            response.headers["X-Next-Cursor"] = next_cursor(
+                products[-1], sort_by_priority
+            )
+        request.state.cache_tags = (
+            [f"category:{query['category_id']}"] if category_name else ["products"]
+        )
+        facets = {
+            "products": products,
+            "total": result["total"][0]["count"] if result["total"] else 0,
+            "facets": {
+                "variant": result["variant"],
+                "color": result["color"],
+                "price": price_buckets(result["price"], result["unpriced"]),
+                "best_seller": result["best_seller"],
+            },
+        }
+        return render(FACETS_ADAPTER, facets, response)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
+@router.get("/products/search", response_model=List[ProductSummaryModel])
+async def search_products(
+    request: Request,
+    q: str = Query(min_length=1, max_length=100, description="Search terms"),
+    prefix: bool = Query(
+        default=False,
+        description="Match the start of title words (autocomplete) instead of full-text search",
+    ),
+    category_name: Optional[str] = Query(
+        default=None, description="Only search within this category"
+    ),
+    limit: int = Query(default=SEARCH_DEFAULT_LIMIT, ge=1, le=SEARCH_MAX_LIMIT),
+    base_url: str = Query(default=BASE_URL, description="Base URL for image paths"),
+    db: AsyncIOMotorDatabase = Depends(get_async_db),
+):
+    """
+    Search products by title, subtitle, description and color, best matches
+    first. With `prefix`, every term must start a word of the title, which
+    suits search-as-you-type; results are then in title order.
+    Both modes are answered from indexes and capped by `limit`.
+    """
+    try:
+        query = {}
+        if category_name:
+            category = await category_cache.get_by_name(db, category_name)
+            if not category:
+                raise HTTPException(status_code=404, detail="Category not found")
+            query["category_id"] = category["_id"]
+
+        if prefix:
+            terms = [term[:MAX_PREFIX_LENGTH] for term in words(q)[:SEARCH_MAX_TERMS]]
+            if not terms:
+                return render(PRODUCT_LIST_ADAPTER, [])
+            query["title_prefixes"] = {"$all": terms}
+            cursor = db[STOREFRONT_COLLECTION].find(query, SUMMARY_PROJECTION)
+            cursor = cursor.sort("title_lower", 1)
+        else:
+            query["$text"] = {"$search": q}
+            projection = {**SUMMARY_PROJECTION, "score": {"$meta": "textScore"}}
+            cursor = db[STOREFRONT_COLLECTION].find(query, projection)
+            cursor = cursor.sort([("score", {"$meta": "textScore"})])
+
+        cursor = cursor.limit(limit).max_time_ms(SEARCH_MAX_TIME_MS)
+        products = await serialize_list(cursor, base_url, thumbnails=True)
+        request.state.cache_tags = ["products"]
+        return render(PRODUCT_LIST_ADAPTER, products)
+    except HTTPException as he:
+        raise he
+    except ExecutionTimeout:
+        raise HTTPException(status_code=503, detail="Search timed out")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
 @router.get("/products/{product_name}", response_model=ProductModel)
 async def get_product(
+    request: Request,
     product_name: str,
     base_url: str = Query(default=BASE_URL, description="Base URL for image paths"),
+    db: AsyncIOMotorDatabase = Depends(get_async_db),
 ):
     """
     Get a single product by name.
     """
     try:
-        db = get_db()
-
-        # Case-insensitive search for product title
-        product = db.product.find_one(
-            {"title": {"$regex": f"^{product_name}$", "$options": "i"}}
+        # Case-insensitive search for product title on the indexed normalized field
+        product = await db[STOREFRONT_COLLECTION].find_one(
+            {"title_lower": product_name.lower()}, PRODUCT_PROJECTION
         )
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
 
-        return serialize_doc(
-            product, base_url, db
-        )  # Ensure ObjectIds are converted to strings
+        request.state.cache_tags = [
+            f"product:{product['_id']}",
+            f"category:{product.pop('category_id')}",
+        ]
+        # Ensure ObjectIds are converted to strings
+        return render(PRODUCT_ADAPTER, serialize_doc(product, base_url))
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -71,6 +423,8 @@ async def get_product(
 
 @router.get("/products", response_model=List[ProductSummaryModel])
 async def get_products_by_category(
+    request: Request,
+    response: Response,
     base_url: str = Query(default=BASE_URL, description="Base URL for image paths"),
     category_name: Optional[str] = Query(
         default=None, description="Name of the category to filter products"
@@ -78,76 +432,68 @@ async def get_products_by_category(
     variant: Optional[str] = Query(
         default=None, description="Variant name to filter products within the category"
     ),
+    limit: Optional[int] = Query(
+        default=None,
+        ge=1,
+        le=MAX_PAGE_SIZE,
+        description="Page size. Without it, every product is returned in one response",
+    ),
+    after: Optional[str] = Query(
+        default=None, description="Cursor from the X-Next-Cursor header of the previous page"
+    ),
+    stream: bool = Query(
+        default=False,
+        description="Stream every product as NDJSON, one per line, without limit or after",
+    ),
+    db: AsyncIOMotorDatabase = Depends(get_async_db),
 ):
     """
-    Get products by category and optional variant.
+    Get products by category and optional variant, one page at a time when
+    `limit` is given, otherwise all of them.
     If variant is provided, return all products matching that variant.
     If no variant is provided, return all products sorted by the priority of the variant, only if a category is mentioned.
     If the category does not have variants, return products without sorting.
+    Products are ordered by `_id` within the same priority. When more products
+    are available, the cursor for the next page is sent in the X-Next-Cursor header.
+    With `stream`, every product is written as NDJSON while it is read from
+    the cursor instead of being collected into a list first; it cannot be
+    combined with `limit` or `after`.
     """
     try:
-        db = get_db()
+        reject_paged_stream(stream, limit, after)
+        query, category_variants = await category_filter(db, category_name, variant)
 
-        query = {}
-        projection = {
-            "title": 1,
-            "subtitle": 1,
-            "images": {"$slice": 1},
-            "variant": 1,
-            "category": 1,
-        }
+        # Step 3: If category is mentioned and no variant is provided, sort by variant priority.
+        # The priority is stored in the read model, so this is a plain indexed sort.
+        sort_by_priority = bool(category_name and not variant and category_variants)
+        sort, after_filter = listing_order(sort_by_priority, after)
+        query.update(after_filter)
 
-        # Step 1: Filter by Category
-        if category_name:
-            # Case-insensitive search for category name
-            category = db.category.find_one(
-                {"name": {"$regex": f"^{category_name}$", "$options": "i"}}
+        cursor = db[STOREFRONT_COLLECTION].find(query, SUMMARY_PROJECTION).sort(sort)
+        if stream:
+            cursor = cursor.batch_size(STREAM_BATCH_SIZE)
+            return StreamingResponse(
+                stream_ndjson(cursor, ProductSummaryModel, base_url, True),
+                media_type="application/x-ndjson",
             )
 
-            if not category:
-                raise HTTPException(status_code=404, detail="Category not found")
-
-            query["category"] = category["_id"]
-
-            # Fetch the variant priorities from the category
-            category_variants = category.get("variants", [])
-
-            # Step 2: If a variant is provided, filter by it
-            if variant:
-                variant_names = [v["variant"].lower() for v in category_variants]
-                if variant.lower() in variant_names:
-                    query["variant"] = variant
-                else:
-                    raise HTTPException(
-                        status_code=404, detail="Variant not found in the category"
-                    )
-
-        # Step 3: Fetch products based on query
-        cursor = db.product.find(query, projection)
-        products = serialize_list(cursor, base_url, db)
-
-        # Step 4: If category is mentioned and no variant is provided, sort by variant priority
-        if category_name and not variant:
-            if category_variants:
-                # If the category has variants, assign priority to each product based on the variant's priority
-                variant_priority_map = {
-                    v["variant"].lower(): v.get("Priority", 0)
-                    for v in category_variants
-                }
+        if limit is not None:
+            # Fetch one extra document to know whether there is a next page
+            cursor = cursor.limit(limit + 1)
+        request.state.cache_tags = (
+            [f"category:{query['category_id']}"] if category_name else ["products"]
+        )
 
-                # Assign priority to each product based on the variant's priority
-                for product in products:
-                    product_variant = product.get("variant", "").lower()
-                    product["priority"] = variant_priority_map.get(product_variant, 0)
+        # Step 4: Fetch the page, or the whole listing without a limit
+        products = await serialize_list(cursor, base_url, thumbnails=True)
 
-                # Sort the products list by the priority field
-                products = sorted(products, key=lambda x: x.get("priority", 0))
-            else:
-                # If no variants exist for the category, return products without sorting
-                pass
+        if limit is not None and len(products) > limit:
+            products = products[:limit]
+            response.headers["X-Next-Cursor"] = next_cursor(
+                products[-1], sort_by_priority
+            )
 
-        # If no category_name or variant is mentioned, return products without sorting
-        return products
+        return render(PRODUCT_LIST_ADAPTER, products, response)
 
     except HTTPException as he:
         raise he  # Re-raise HTTP exceptions to be handled by FastAPI
@@ -157,28 +503,67 @@ async def get_products_by_category(
 
 @router.get("/bestsellers", response_model=List[BestSellerModel])
 async def get_bestsellers(
-    base_url: str = Query(default=BASE_URL, description="Base URL for image paths")
+    request: Request,
+    response: Response,
+    base_url: str = Query(default=BASE_URL, description="Base URL for image paths"),
+    limit: Optional[int] = Query(
+        default=None,
+        ge=1,
+        le=MAX_PAGE_SIZE,
+        description="Page size. Without it, every product is returned in one response",
+    ),
+    after: Optional[str] = Query(
+        default=None, description="Cursor from the X-Next-Cursor header of the previous page"
+    ),
+    stream: bool = Query(
+        default=False,
+        description="Stream every bestseller as NDJSON, one per line, without limit or after",
+    ),
+    db: AsyncIOMotorDatabase = Depends(get_async_db),
 ):
     """
-    Get all products marked as bestsellers (best_seller: true), returning only
+    Get products marked as bestsellers (best_seller: true), returning only
     title, price, and the first image for scalability.
+    Results are paginated by `_id` or streamed whole; see `get_products_by_category`.
     """
     try:
-        db = get_db()
+        reject_paged_stream(stream, limit, after)
+        query = {"best_seller": True}
+        if after:
+            (last_id,) = decode_cursor(after, 1)
+            query["_id"] = {"$gt": ObjectId(last_id)}
 
-        # Query the products collection for bestsellers, fetching only the necessary fields
-        cursor = db.product.find(
-            {"best_seller": True},
+        # Query the storefront products for bestsellers, fetching only the necessary fields
+        cursor = db[STOREFRONT_COLLECTION].find(
+            query,
             {
                 "title": 1,  # Only fetch the title
                 "price": 1,  # Only fetch the price
                 "images": {"$slice": 1},  # Fetch only the first image
             },
-        )
+        ).sort("_id", 1)
+
+        if stream:
+            cursor = cursor.batch_size(STREAM_BATCH_SIZE)
+            return StreamingResponse(
+                stream_ndjson(cursor, BestSellerModel, base_url, True),
+                media_type="application/x-ndjson",
+            )
+
+        if limit is not None:
+            cursor = cursor.limit(limit + 1)
+        request.state.cache_tags = ["bestsellers"]
 
         # Serialize the products with the base_url for image handling
-        bestsellers = serialize_list(cursor, base_url, db)
-        return bestsellers
+        bestsellers = await serialize_list(cursor, base_url, thumbnails=True)
+
+        if limit is not None and len(bestsellers) > limit:
+            bestsellers = bestsellers[:limit]
+            response.headers["X-Next-Cursor"] = encode_cursor([bestsellers[-1]["_id"]])
 
+        return render(BESTSELLER_LIST_ADAPTER, bestsellers, response)
+
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal Server Error")
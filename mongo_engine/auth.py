@@ -2,20 +2,69 @@ from starlette.requests import Request
 from starlette.responses import Response
 from starlette_admin.auth import AuthProvider, AdminUser
 from starlette_admin.exceptions import LoginFailed
-from mongoengine import connect
 from mongo_engine.models.models import (
     Admin,
 )  # Ensure your models.py contains the Admin model
 from bcrypt import checkpw
-from typing import Optional
-from dotenv import load_dotenv
-import os
+from starlette.concurrency import run_in_threadpool
+from collections import OrderedDict
+from typing import Optional, Tuple
+import hashlib
+import threading
+import time
+from mongo_engine.config import env_float, env_int
 
-# Load environment variables from .env file
-load_dotenv()
+# How long a signed-in admin is trusted before the database is checked again.
+# Deleting an admin or changing their password takes effect within this delay.
+ADMIN_CACHE_TTL = env_float("ADMIN_CACHE_TTL", 30)
+# Admins whose stamp is kept, least recently used dropped first
+ADMIN_CACHE_SIZE = env_int("ADMIN_CACHE_SIZE", 1000)
 
-# Connect to MongoDB Atlas
-connect(db=os.getenv("MONGO_DB"), host=os.getenv("MONGO_URL"))
+
+def password_stamp(password_hash: str) -> str:
+    """
+    Short fingerprint of the password hash, stored in the session so that
+    changing the password invalidates existing sessions.
+    """
+    return hashlib.sha256(password_hash.encode("utf-8")).hexdigest()[:16]
+
+
+class AdminCache:
+    """
+    In-memory map of username to current password stamp, with a TTL. Only
+    admins that signed in are added, and at most `size` of them are kept.
+    """
+
+    def __init__(self, ttl: float = ADMIN_CACHE_TTL, size: int = ADMIN_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(username)
+                return entry[0]
+        return None
+
+    def set(self, username: str, stamp: str) -> None:
+        with self._lock:
+            self._entries[username] = (stamp, time.monotonic())
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: Optional[str] = None) -> None:
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+
+admin_cache = AdminCache()
 
 
 class MyAuthProvider(AuthProvider):
@@ -29,25 +78,38 @@ class MyAuthProvider(AuthProvider):
         response: Response,
     ) -> Response:
         # Retrieve the admin from the MongoDB database using MongoEngine
-        admin = Admin.objects(username=username).first()
+        admin = await run_in_threadpool(Admin.objects(username=username).first)
 
-        # Check if the admin exists and if the password is correct
-        if not admin or not checkpw(
-            password.encode("utf-8"), admin.password_hash.encode("utf-8")
+        # Check if the admin exists and if the password is correct.
+        # bcrypt is deliberately slow, keep it off the event loop.
+        if not admin or not await run_in_threadpool(
+            checkpw, password.encode("utf-8"), admin.password_hash.encode("utf-8")
         ):
             raise LoginFailed("Invalid username or password")
 
         # Store session details
-        request.session.update({"username": admin.username})
+        stamp = password_stamp(admin.password_hash)
+        request.session.update({"username": admin.username, "auth_stamp": stamp})
+        admin_cache.set(admin.username, stamp)
         return response
 
     async def is_authenticated(self, request: Request) -> bool:
         # Check if the session contains a username
         username = request.session.get("username")
-        if username:
-            admin = Admin.objects(username=username).first()
-            if admin:
-                request.state.user = admin
+        stamp = request.session.get("auth_stamp")
+        if username and stamp:
+            # Only hit the database when the cached entry is missing or expired
+            current_stamp = admin_cache.get(username)
+            if current_stamp is None:
+                admin = await run_in_threadpool(
+                    Admin.objects(username=username).only("password_hash").first
+                )
+                if not admin:
+                    return False
+                current_stamp = password_stamp(admin.password_hash)
+                admin_cache.set(username, current_stamp)
+            if current_stamp == stamp:
+                request.state.user = AdminUser(username=username)
                 return True
         return False
 
@@ -60,5 +122,6 @@ class MyAuthProvider(AuthProvider):
 
     async def logout(self, request: Request, response: Response) -> Response:
         # Clear the session to log out the admin
+        admin_cache.invalidate(request.session.get("username"))
         request.session.clear()
         return response
@@ -0,0 +1,136 @@
+import asyncio
+import copy
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+from mongo_engine.config import env_float
+
+CATEGORY_CACHE_TTL = env_float("CATEGORY_CACHE_TTL", 300)
+
+logger = logging.getLogger(__name__)
+
+
+class CategoryCache:
+    """
+    In-process index of the `category` collection keyed by `_id` and by
+    lowercased name.
+
+    The whole collection is loaded at once on the first lookup and reused until
+    it is invalidated (admin create/edit, change stream) or the TTL expires.
+    Lookups return copies so callers can serialize them in place.
+    """
+
+    def __init__(self, ttl: float = CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._by_id: Dict[ObjectId, dict] = {}
+        self._by_name: Dict[str, dict] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._load_lock = asyncio.Lock()
+
+    def _is_fresh(self) -> bool:
+        return (
+            self._loaded_at is not None
+            and time.monotonic() - self._loaded_at < self.ttl
+        )
+
+    async def _ensure_loaded(self, db: AsyncIOMotorDatabase) -> None:
+        if self._is_fresh():
+            self.hits += 1
+            return
+        async with self._load_lock:
+            # Another request may have reloaded the index while we waited
+            if self._is_fresh():
+                self.hits += 1
+                return
+            self.misses += 1
+            categories = await db.category.find().to_list(None)
+            self._swap(categories)
+
+    def _swap(self, categories: List[dict]) -> None:
+        with self._lock:
+            self._by_id = {category["_id"]: category for category in categories}
+            self._by_name = {
+                category["name"].lower(): category
+                for category in categories
+                if category.get("name")
+            }
+            self._loaded_at = time.monotonic()
+
+    async def all(self, db: AsyncIOMotorDatabase) -> List[dict]:
+        """
+        Return every category, in insertion order.
+        """
+        await self._ensure_loaded(db)
+        return [copy.deepcopy(category) for category in self._by_id.values()]
+
+    async def get_by_id(
+        self, db: AsyncIOMotorDatabase, category_id: ObjectId
+    ) -> Optional[dict]:
+        await self._ensure_loaded(db)
+        category = self._by_id.get(category_id)
+        return copy.deepcopy(category) if category else None
+
+    async def get_by_name(
+        self, db: AsyncIOMotorDatabase, name: str
+    ) -> Optional[dict]:
+        """
+        Case-insensitive lookup of a category by name.
+        """
+        await self._ensure_loaded(db)
+        category = self._by_name.get(name.lower())
+        return copy.deepcopy(category) if category else None
+
+    async def names(self, db: AsyncIOMotorDatabase) -> Dict[ObjectId, str]:
+        """
+        Mapping of category ObjectId to category name.
+        """
+        await self._ensure_loaded(db)
+        return {
+            category_id: category.get("name")
+            for category_id, category in self._by_id.items()
+        }
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded_at = None
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._by_id),
+            "fresh": self._is_fresh(),
+        }
+
+    def watch(self, db: Database) -> threading.Thread:
+        """
+        Invalidate the cache whenever the `category` collection changes.
+        Runs on a background thread with the blocking client.
+        Requires a replica set; if the change stream cannot be opened the
+        cache falls back to the TTL.
+        """
+
+        def run():
+            try:
+                with db.category.watch() as stream:
+                    for _ in stream:
+                        self.invalidate()
+            except PyMongoError as e:
+                logger.warning("Category change stream stopped: %s", e)
+
+        thread = threading.Thread(target=run, name="category-cache-watch", daemon=True)
+        thread.start()
+        return thread
+
+
+category_cache = CategoryCache()
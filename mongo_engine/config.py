@@ -0,0 +1,120 @@
+import os
+from dataclasses import dataclass
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+# The only place the .env file is read; every module takes its settings from here
+load_dotenv()
+
+
+def env_str(name: str, default: Optional[str] = None) -> Optional[str]:
+    return os.environ.get(name, default)
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true")
+
+
+def env_list(name: str, default: str) -> List[str]:
+    return [item.strip() for item in os.environ.get(name, default).split(",")]
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Settings of the process: connections, the app and its startup. Feature
+    tuning (cache sizes, page sizes, ...) stays next to the feature, read with
+    the helpers above.
+    """
+
+    # MONGO_URL is the name older .env files used for the admin connection
+    mongo_url: Optional[str]
+    mongo_db: Optional[str]
+    # Only checked against the bucket of the admin's ImageField, see db.py
+    mongo_bucket_name: Optional[str]
+
+    # Pool tuning, shared by the admin (mongoengine, GridFS) and storefront clients
+    mongo_max_pool_size: int
+    mongo_min_pool_size: int
+    mongo_max_idle_time_ms: int
+    mongo_wait_queue_timeout_ms: int
+    mongo_connect_timeout_ms: int
+    mongo_server_selection_timeout_ms: int
+    mongo_socket_timeout_ms: int
+    mongo_compressors: Optional[str]  # e.g. "zstd,zlib"
+    mongo_read_preference: str
+    mongo_app_name: str
+
+    # Storefront read routing. The admin and auth keep mongo_read_preference.
+    catalog_read_preference: str
+    image_read_preference: str
+    # The server rejects bounds below 90 seconds
+    storefront_max_staleness_seconds: int
+    # After an admin write, the storefront reads of that admin's browser (and
+    # response cache refills) go to the primary for this long
+    read_your_writes_seconds: float
+
+    origin_url: Optional[str]
+    secret_key: Optional[str]
+    base_url: Optional[str]
+    # Change-stream refresh of the category cache (needs a replica set)
+    category_cache_watch: bool
+
+    # Startup retries index creation and warmup with backoff up to this delay,
+    # until MongoDB is reachable. /readyz reports 503 in the meantime.
+    startup_retry_max_seconds: float
+    warmup_enabled: bool
+    # Bestseller images (and their thumbnails) loaded into the image cache
+    warmup_images: int
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            mongo_url=env_str("MONGO_CONNECTION_URL") or env_str("MONGO_URL"),
+            mongo_db=env_str("MONGO_DB"),
+            mongo_bucket_name=env_str("MONGO_BUCKET_NAME"),
+            mongo_max_pool_size=env_int("MONGO_MAX_POOL_SIZE", 50),
+            mongo_min_pool_size=env_int("MONGO_MIN_POOL_SIZE", 0),
+            mongo_max_idle_time_ms=env_int("MONGO_MAX_IDLE_TIME_MS", 300000),
+            mongo_wait_queue_timeout_ms=env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000),
+            mongo_connect_timeout_ms=env_int("MONGO_CONNECT_TIMEOUT_MS", 10000),
+            mongo_server_selection_timeout_ms=env_int(
+                "MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000
+            ),
+            mongo_socket_timeout_ms=env_int("MONGO_SOCKET_TIMEOUT_MS", 30000),
+            mongo_compressors=env_str("MONGO_COMPRESSORS"),
+            mongo_read_preference=env_str("MONGO_READ_PREFERENCE", "primary"),
+            mongo_app_name=env_str("MONGO_APP_NAME", "supersteel-admin"),
+            catalog_read_preference=env_str(
+                "CATALOG_READ_PREFERENCE", "secondaryPreferred"
+            ),
+            image_read_preference=env_str(
+                "IMAGE_READ_PREFERENCE", "secondaryPreferred"
+            ),
+            storefront_max_staleness_seconds=env_int(
+                "STOREFRONT_MAX_STALENESS_SECONDS", 90
+            ),
+            read_your_writes_seconds=env_float("READ_YOUR_WRITES_SECONDS", 30),
+            origin_url=env_str("ORIGIN_NAME"),
+            secret_key=env_str("SECRET_KEY"),
+            base_url=env_str("BASE_URL"),
+            category_cache_watch=env_bool("CATEGORY_CACHE_WATCH"),
+            startup_retry_max_seconds=env_float("STARTUP_RETRY_MAX_SECONDS", 30),
+            warmup_enabled=env_bool("WARMUP_ENABLED", True),
+            warmup_images=env_int("WARMUP_IMAGES", 20),
+        )
+
+
+settings = Settings.from_env()
@@ -1,25 +1,351 @@
-from pymongo import MongoClient
+import logging
+import threading
+from collections import Counter
+from typing import Optional
+
+import mongoengine
 from gridfs import GridFSBucket
-from dotenv import load_dotenv
-import os
+from itsdangerous import BadSignature, TimestampSigner
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import MongoClient
+from pymongo.database import Database
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from mongo_engine.config import settings
+from mongo_engine.metrics import METRICS_ENABLED, command_tracer
+from mongo_engine.models.models import Image
+
+# Shorthands for the modules and scripts that import them from here
+MONGO_CONNECTION_NAME = settings.mongo_url
+MONGO_DB = settings.mongo_db
+# The bucket the admin's ImageField writes to. Every reader and writer of
+# images uses it, so uploads are always served from where they were stored.
+MONGO_BUCKET_NAME = Image._fields["image_src"].collection_name
+
+# Signed timestamp sent to the browser of an admin after a write
+READ_YOUR_WRITES_COOKIE = "read_your_writes"
+
+logger = logging.getLogger(__name__)
+
+_write_signer = TimestampSigner(settings.secret_key or "", salt=READ_YOUR_WRITES_COOKIE)
+
+if settings.mongo_bucket_name not in (None, MONGO_BUCKET_NAME):
+    logger.warning(
+        "MONGO_BUCKET_NAME=%s is ignored, images are stored in the '%s' bucket",
+        settings.mongo_bucket_name,
+        MONGO_BUCKET_NAME,
+    )
+
+
+class PoolStats(ConnectionPoolListener):
+    """
+    Connection pool counters for every server the clients talk to.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def _count(self, name: str, delta: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += delta
+
+    def pool_created(self, event):
+        self._count("pools_created")
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count("pools_cleared")
+
+    def pool_closed(self, event):
+        self._count("pools_closed")
+
+    def connection_created(self, event):
+        self._count("connections_created")
+        self._count("connections_open")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count("connections_closed")
+        self._count("connections_open", -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._count("checkout_failures")
+
+    def connection_checked_out(self, event):
+        self._count("checkouts")
+        self._count("connections_in_use")
+
+    def connection_checked_in(self, event):
+        self._count("connections_in_use", -1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+def read_preference(
+    name: str, max_staleness: int = settings.storefront_max_staleness_seconds
+):
+    mode = read_pref_mode_from_name(name)
+    # Max staleness is not allowed with primary reads
+    return make_read_preference(mode, None, max_staleness if mode else -1)
+
+
+class MongoConnection:
+    """
+    Owner of the process' MongoDB connections.
+
+    The blocking client is the one registered with mongoengine, so the admin
+    models, GridFS, the read model and `get_db()` share a single pool. The
+    storefront routes use a Motor client built with the same settings; Motor
+    has to own its client, so it keeps a second pool of its own.
+    Clients are opened on first use or by `connect()` from the app lifespan,
+    and closed by `close()`.
+
+    Storefront reads use their own read preference (secondaries by default),
+    unless the caller asks for the primary, see `reading_own_writes`.
+    """
+
+    def __init__(self):
+        self.pool_stats = PoolStats()
+        self._lock = threading.Lock()
+        self._client: Optional[MongoClient] = None
+        self._db: Optional[Database] = None
+        self._bucket: Optional[GridFSBucket] = None
+        self._async_client: Optional[AsyncIOMotorClient] = None
+        self._async_db = None
+        self._catalog_db = None
+        self._async_bucket: Optional[AsyncIOMotorGridFSBucket] = None
+        self._image_bucket: Optional[AsyncIOMotorGridFSBucket] = None
+        self._route_reads = True
 
-load_dotenv()
+    def client_options(self) -> dict:
+        options = {
+            "maxPoolSize": settings.mongo_max_pool_size,
+            "minPoolSize": settings.mongo_min_pool_size,
+            "maxIdleTimeMS": settings.mongo_max_idle_time_ms,
+            "waitQueueTimeoutMS": settings.mongo_wait_queue_timeout_ms,
+            "connectTimeoutMS": settings.mongo_connect_timeout_ms,
+            "serverSelectionTimeoutMS": settings.mongo_server_selection_timeout_ms,
+            "socketTimeoutMS": settings.mongo_socket_timeout_ms,
+            "readPreference": settings.mongo_read_preference,
+            "appname": settings.mongo_app_name,
+            "event_listeners": [self.pool_stats],
+        }
+        if METRICS_ENABLED:
+            options["event_listeners"].append(command_tracer)
+        if settings.mongo_compressors:
+            options["compressors"] = settings.mongo_compressors
+        return options
 
-MONGO_CONNECTION_NAME = os.environ.get("MONGO_CONNECTION_URL")
-MONGO_DB = os.environ.get("MONGO_DB")
-MONGO_BUCKET_NAME = os.environ.get("MONGO_BUCKET_NAME")
+    def connect(self) -> None:
+        with self._lock:
+            if self._client is not None:
+                return
+            options = self.client_options()
+            client = mongoengine.connect(
+                db=MONGO_DB, host=MONGO_CONNECTION_NAME, **options
+            )
+            self._attach(client, AsyncIOMotorClient(MONGO_CONNECTION_NAME, **options))
 
-client = MongoClient(MONGO_CONNECTION_NAME)
-db = client[MONGO_DB]
-bucket = GridFSBucket(db, bucket_name=MONGO_BUCKET_NAME)
+    def use_clients(
+        self, client: MongoClient, async_client, route_reads: bool = True
+    ) -> None:
+        """
+        Adopt clients built elsewhere, such as the in-memory stand-ins of the
+        benchmarks. `client` must already be registered with mongoengine.
+        Without `route_reads` the storefront reads the primary as well.
+        """
+        with self._lock:
+            self._route_reads = route_reads
+            self._attach(client, async_client)
+
+    def _attach(self, client: MongoClient, async_client) -> None:
+        self._client = client
+        # Resolved by mongoengine from MONGO_DB or the database in the URL
+        self._db = mongoengine.get_db()
+        self._bucket = GridFSBucket(self._db, bucket_name=MONGO_BUCKET_NAME)
+        self._async_client = async_client
+        self._async_db = self._async_client[self._db.name]
+        self._catalog_db = self._async_db
+        if self._route_reads:
+            self._catalog_db = self._async_db.with_options(
+                read_preference=read_preference(settings.catalog_read_preference)
+            )
+        logger.info("MongoDB clients configured for database %s", self._db.name)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._client is None:
+                return
+            mongoengine.disconnect()
+            self._async_client.close()
+            self._client = self._db = self._bucket = None
+            self._async_client = self._async_db = self._catalog_db = None
+            self._async_bucket = self._image_bucket = None
+
+    @property
+    def db(self) -> Database:
+        self.connect()
+        return self._db
+
+    @property
+    def bucket(self) -> GridFSBucket:
+        self.connect()
+        return self._bucket
+
+    @property
+    def async_db(self):
+        self.connect()
+        return self._async_db
+
+    @property
+    def async_bucket(self) -> AsyncIOMotorGridFSBucket:
+        # Created on first use so it binds to the running event loop, then reused
+        if self._async_bucket is None:
+            self._async_bucket = AsyncIOMotorGridFSBucket(
+                self.async_db, bucket_name=MONGO_BUCKET_NAME
+            )
+        return self._async_bucket
+
+    @property
+    def image_bucket(self) -> AsyncIOMotorGridFSBucket:
+        if self._image_bucket is None:
+            if not self._route_reads:
+                return self.async_bucket
+            # Set on the database so `bucket.collection` reads follow it too
+            image_db = self.async_db.with_options(
+                read_preference=read_preference(settings.image_read_preference)
+            )
+            self._image_bucket = AsyncIOMotorGridFSBucket(
+                image_db, bucket_name=MONGO_BUCKET_NAME
+            )
+        return self._image_bucket
+
+    def catalog_db(self, primary: bool = False):
+        """
+        Database for storefront catalog reads, on the primary with `primary`.
+        """
+        self.connect()
+        return self._async_db if primary else self._catalog_db
+
+    def storefront_bucket(self, primary: bool = False) -> AsyncIOMotorGridFSBucket:
+        """
+        GridFS bucket for storefront image reads, on the primary with `primary`.
+        """
+        return self.async_bucket if primary else self.image_bucket
+
+    def stats(self) -> dict:
+        return {
+            "max_pool_size": settings.mongo_max_pool_size,
+            "connected": self._client is not None,
+            **self.pool_stats.snapshot(),
+        }
+
+
+connection = MongoConnection()
 
 
 def get_db():
-    return db
+    return connection.db
 
 
 def get_bucket():
-    return bucket
+    return connection.bucket
+
+
+def note_write(request: Request) -> None:
+    """
+    Send the storefront reads of the client that made an admin write to the
+    primary for `read_your_writes_seconds`, through a signed cookie that
+    `ReadYourWritesMiddleware` sets on the response. Other clients keep
+    reading the secondaries.
+    """
+    request.state.read_your_writes = True
+
+
+def reading_own_writes(request: Request) -> bool:
+    """
+    Whether a storefront request must read the primary: the client wrote
+    recently, or the response cache is refilling right after a purge.
+    """
+    if getattr(request.state, "read_primary", False):
+        return True
+    value = request.cookies.get(READ_YOUR_WRITES_COOKIE)
+    if not value:
+        return False
+    try:
+        _write_signer.unsign(value, max_age=settings.read_your_writes_seconds)
+    except BadSignature:
+        # Forged, or older than the window
+        return False
+    return True
+
+
+class ReadYourWritesMiddleware:
+    """
+    Set the read-your-writes cookie on responses to requests that called
+    `note_write`, such as admin create/edit/delete.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # Shared with the mounted admin, whose hooks write to request.state
+        state = scope.setdefault("state", {})
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start" and state.get(
+                "read_your_writes"
+            ):
+                cookie = (
+                    f"{READ_YOUR_WRITES_COOKIE}={_write_signer.sign(b'1').decode()}; "
+                    f"Max-Age={int(settings.read_your_writes_seconds)}; "
+                    "Path=/; HttpOnly; SameSite=Lax"
+                )
+                message = {
+                    **message,
+                    "headers": list(message.get("headers", []))
+                    + [(b"set-cookie", cookie.encode("latin-1"))],
+                }
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+async def get_async_db(request: Request):
+    return connection.catalog_db(reading_own_writes(request))
+
+
+async def get_async_bucket(request: Request):
+    return connection.storefront_bucket(reading_own_writes(request))
+
+
+def ensure_image_indexes():
+    """
+    Indexes used to find the generated variants of an image, and the images
+    stored by the catalog import by their content hash.
+    """
+    files = get_db()[f"{MONGO_BUCKET_NAME}.files"]
+    files.create_index(
+        [("metadata.variant_of", 1), ("metadata.width", 1), ("metadata.format", 1)]
+    )
+    files.create_index("sha256", sparse=True)
 
 
 def serialize_list(cursor):
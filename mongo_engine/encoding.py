@@ -0,0 +1,41 @@
+from functools import lru_cache
+from typing import Any, Optional
+
+from fastapi import Response
+from pydantic import TypeAdapter
+
+from mongo_engine.config import env_bool
+
+# Set to false to fall back to FastAPI's response_model validation and encoding
+FAST_JSON_RESPONSES = env_bool("FAST_JSON_RESPONSES", True)
+
+
+@lru_cache(maxsize=None)
+def type_adapter(response_type: Any) -> TypeAdapter:
+    """
+    Build the validator/serializer for a response type once and reuse it.
+    """
+    return TypeAdapter(response_type)
+
+
+def encode(adapter: TypeAdapter, data: Any) -> bytes:
+    """
+    Validate `data` against the response type and dump it straight to JSON
+    bytes, with the same output as FastAPI's `response_model` handling.
+    """
+    return adapter.dump_json(adapter.validate_python(data), by_alias=True)
+
+
+def render(adapter: TypeAdapter, data: Any, response: Optional[Response] = None):
+    """
+    Return a ready JSON response for `data`, or `data` itself when the fast
+    path is disabled. Routes keep their `response_model` for the OpenAPI
+    schema; FastAPI skips it for responses returned as `Response` objects.
+    Headers set on the injected `response` are copied over.
+    """
+    if not FAST_JSON_RESPONSES:
+        return data
+    rendered = Response(encode(adapter, data), media_type="application/json")
+    if response is not None:
+        rendered.headers.raw.extend(response.headers.raw)
+    return rendered
@@ -0,0 +1,118 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List
+
+from bson import ObjectId
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+# Upper bound on the size of each $in list sent to the server
+BATCH_SIZE = 1000
+# Collections whose documents reference GridFS images through images.image_src
+REFERENCING_COLLECTIONS = ("product", "category")
+
+
+@dataclass
+class GridFSCleanupResult:
+    """
+    Outcome of deleting a set of GridFS images.
+
+    `deleted` lists every removed file (originals, thumbnails and variants),
+    `missing` the referenced originals that were not in the bucket, `kept`
+    the images left in place because another document still uses them, and
+    `failed` the files whose deletion raised, with the error message.
+    """
+
+    deleted: List[ObjectId] = field(default_factory=list)
+    missing: List[ObjectId] = field(default_factory=list)
+    kept: List[ObjectId] = field(default_factory=list)
+    failed: Dict[ObjectId, str] = field(default_factory=dict)
+
+
+def batched(items: List, size: int = BATCH_SIZE) -> Iterable[List]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def referenced_image_ids(
+    db: Database, collection: str, ids: List[ObjectId]
+) -> List[ObjectId]:
+    """
+    Ids of the GridFS images referenced by the given documents, in one query
+    per batch.
+    """
+    image_ids = []
+    for batch in batched(ids):
+        for doc in db[collection].find(
+            {"_id": {"$in": batch}}, {"images.image_src": 1}
+        ):
+            image_ids.extend(
+                image["image_src"]
+                for image in doc.get("images") or []
+                if isinstance(image.get("image_src"), ObjectId)
+            )
+    return image_ids
+
+
+def still_referenced(db: Database, image_ids: List[ObjectId]) -> set:
+    """
+    The images among `image_ids` that a product or category references.
+    Imports reuse stored files, so one file can back several documents.
+    """
+    found = set()
+    for batch in batched(image_ids):
+        wanted = set(batch)
+        for collection in REFERENCING_COLLECTIONS:
+            values = db[collection].distinct(
+                "images.image_src", {"images.image_src": {"$in": batch}}
+            )
+            found.update(value for value in values if value in wanted)
+    return found
+
+
+def delete_images(
+    db: Database, bucket_name: str, image_ids: List[ObjectId]
+) -> GridFSCleanupResult:
+    """
+    Delete images together with their thumbnails and generated variants,
+    using `$in` deletes on the bucket's files and chunks collections.
+    Images still referenced by a product or category are kept, so remove
+    or update the documents that used them first.
+    """
+    files = db[f"{bucket_name}.files"]
+    chunks = db[f"{bucket_name}.chunks"]
+    result = GridFSCleanupResult()
+
+    image_ids = list(dict.fromkeys(image_ids))
+    try:
+        in_use = still_referenced(db, image_ids)
+    except PyMongoError as e:
+        # Deleting blind could break other documents, leave it to gridfs_gc
+        result.failed.update((image_id, str(e)) for image_id in image_ids)
+        return result
+    result.kept.extend(image_id for image_id in image_ids if image_id in in_use)
+    unused = [image_id for image_id in image_ids if image_id not in in_use]
+
+    for batch in batched(unused):
+        file_ids = []
+        found = set()
+        try:
+            query = {
+                "$or": [
+                    {"_id": {"$in": batch}},
+                    {"metadata.variant_of": {"$in": batch}},
+                ]
+            }
+            for doc in files.find(query, {"thumbnail_id": 1}):
+                found.add(doc["_id"])
+                file_ids.append(doc["_id"])
+                if doc.get("thumbnail_id"):
+                    file_ids.append(doc["thumbnail_id"])
+            # Remove the file documents first so no reader sees a partial file
+            files.delete_many({"_id": {"$in": file_ids}})
+            chunks.delete_many({"files_id": {"$in": file_ids}})
+        except PyMongoError as e:
+            result.failed.update((file_id, str(e)) for file_id in file_ids or batch)
+            continue
+        result.deleted.extend(file_ids)
+        result.missing.extend(file_id for file_id in batch if file_id not in found)
+    return result
@@ -0,0 +1,234 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from mongo_engine.config import env_float, env_int, env_str
+
+# Sizes are in bytes. The disk tier is disabled unless IMAGE_CACHE_DIR is set.
+IMAGE_CACHE_MEMORY_BYTES = env_int("IMAGE_CACHE_MEMORY_BYTES", 64 << 20)
+IMAGE_CACHE_MEMORY_MAX_FILE = env_int("IMAGE_CACHE_MEMORY_MAX_FILE", 256 << 10)
+IMAGE_CACHE_DIR = env_str("IMAGE_CACHE_DIR")
+IMAGE_CACHE_DISK_BYTES = env_int("IMAGE_CACHE_DISK_BYTES", 1 << 30)
+IMAGE_CACHE_DISK_MAX_FILE = env_int("IMAGE_CACHE_DISK_MAX_FILE", 32 << 20)
+IMAGE_CACHE_EVICTION = env_str("IMAGE_CACHE_EVICTION", "lru")  # lru or fifo
+# Seconds a cached entry is served before checking again that its GridFS file
+# still exists; 0 checks on every hit. Bounds how long a worker serves an
+# image deleted through another worker.
+IMAGE_CACHE_REVALIDATE_SECONDS = env_float("IMAGE_CACHE_REVALIDATE_SECONDS", 0)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedImage:
+    """
+    A GridFS file held by the cache: its file document plus either the bytes
+    (memory tier) or the path of a local copy (disk tier).
+    """
+
+    file_doc: dict
+    size: int
+    data: Optional[bytes] = None
+    path: Optional[str] = None
+    # When the file was last known to exist in GridFS, see ImageCache.stale
+    checked_at: float = field(default_factory=time.monotonic)
+
+
+class _Tier:
+    def __init__(self, capacity: int, eviction: str):
+        self.capacity = capacity
+        self.eviction = eviction
+        self.used = 0
+        self.entries: "OrderedDict[str, CachedImage]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[CachedImage]:
+        entry = self.entries.get(key)
+        if entry is not None and self.eviction == "lru":
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CachedImage) -> list:
+        """
+        Store an entry and return the entries evicted to make room for it.
+        """
+        # Re-caching the same file replaces it in place, nothing to delete
+        self.pop(key)
+        evicted = []
+        while self.entries and self.used + entry.size > self.capacity:
+            _, old = self.entries.popitem(last=False)
+            self.used -= old.size
+            evicted.append(old)
+        self.entries[key] = entry
+        self.used += entry.size
+        return evicted
+
+    def pop(self, key: str) -> Optional[CachedImage]:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used -= entry.size
+        return entry
+
+
+class ImageCache:
+    """
+    Read-through cache for GridFS image bytes.
+
+    Files up to `memory_max_file` bytes are kept in an in-memory tier, larger
+    ones (up to `disk_max_file`) are copied to a subdirectory of `disk_dir`
+    owned by the current process, removed by `close()`. Both tiers are
+    bounded in bytes and evict by LRU (or FIFO). GridFS files are immutable
+    per id, so entries only need to be dropped when the file is deleted.
+
+    Entries are per process: `discard` only reaches the worker that deleted
+    the files. Other workers find out through `stale`, by checking that the
+    file still exists once `revalidate_seconds` have passed.
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int = IMAGE_CACHE_MEMORY_BYTES,
+        memory_max_file: int = IMAGE_CACHE_MEMORY_MAX_FILE,
+        disk_dir: Optional[str] = IMAGE_CACHE_DIR,
+        disk_bytes: int = IMAGE_CACHE_DISK_BYTES,
+        disk_max_file: int = IMAGE_CACHE_DISK_MAX_FILE,
+        eviction: str = IMAGE_CACHE_EVICTION,
+        revalidate_seconds: float = IMAGE_CACHE_REVALIDATE_SECONDS,
+    ):
+        self.memory_max_file = memory_max_file
+        self.revalidate_seconds = revalidate_seconds
+        self.disk_root = disk_dir
+        self.disk_max_file = disk_max_file if disk_dir else 0
+        self._memory = _Tier(memory_bytes, eviction)
+        self._disk = _Tier(disk_bytes, eviction)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+
+    @property
+    def disk_dir(self) -> Optional[str]:
+        # Per process, so workers sharing IMAGE_CACHE_DIR never remove each
+        # other's files. Resolved on use, as workers may be forked after import.
+        if not self.disk_root:
+            return None
+        return os.path.join(self.disk_root, f"gridfs-images-{os.getpid()}")
+
+    def cacheable(self, length: int) -> bool:
+        return (
+            length <= min(self.memory_max_file, self._memory.capacity)
+            or length <= min(self.disk_max_file, self._disk.capacity)
+        )
+
+    def get(self, file_id: str) -> Optional[CachedImage]:
+        with self._lock:
+            entry = self._memory.get(file_id) or self._disk.get(file_id)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def stale(self, entry: CachedImage) -> bool:
+        """
+        Whether the file of an entry must be looked up again before serving it.
+        """
+        return time.monotonic() - entry.checked_at >= self.revalidate_seconds
+
+    def mark_checked(self, entry: CachedImage) -> None:
+        entry.checked_at = time.monotonic()
+
+    def peek(self, file_id: str) -> Optional[CachedImage]:
+        """
+        Look an entry up without counting it in the hit ratio or refreshing
+        its eviction order, for callers that only need its file document.
+        """
+        with self._lock:
+            return self._memory.entries.get(file_id) or self._disk.entries.get(
+                file_id
+            )
+
+    async def put(self, file_doc: dict, data: bytes) -> CachedImage:
+        file_id = str(file_doc["_id"])
+        entry = CachedImage(file_doc=file_doc, size=len(data))
+        if entry.size <= min(self.memory_max_file, self._memory.capacity):
+            entry.data = data
+            with self._lock:
+                self._memory.put(file_id, entry)
+            return entry
+
+        entry.path = os.path.join(self.disk_dir, file_id)
+        await run_in_threadpool(self._write_file, entry.path, data)
+        with self._lock:
+            evicted = self._disk.put(file_id, entry)
+        await run_in_threadpool(self._remove_files, evicted)
+        return entry
+
+    def discard(self, file_ids: Iterable) -> None:
+        """
+        Drop deleted GridFS files from both tiers.
+        """
+        evicted = []
+        with self._lock:
+            for file_id in file_ids:
+                self._memory.pop(str(file_id))
+                entry = self._disk.pop(str(file_id))
+                if entry is not None:
+                    evicted.append(entry)
+        self._remove_files(evicted)
+
+    def close(self) -> None:
+        """
+        Empty both tiers and remove this process' directory. Entries are not
+        persisted across restarts.
+        """
+        with self._lock:
+            self._memory = _Tier(self._memory.capacity, self._memory.eviction)
+            self._disk = _Tier(self._disk.capacity, self._disk.eviction)
+        if self.disk_dir:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+
+    def record_served(self, size: int) -> None:
+        self.bytes_served += size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_served": self.bytes_served,
+            "memory_bytes": self._memory.used,
+            "memory_entries": len(self._memory.entries),
+            "disk_bytes": self._disk.used,
+            "disk_entries": len(self._disk.entries),
+        }
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        # Write then rename so a concurrent reader never sees a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove_files(entries: Iterable[CachedImage]) -> None:
+        for entry in entries:
+            if entry.path:
+                try:
+                    os.remove(entry.path)
+                except OSError as e:
+                    logger.warning(
+                        "Could not remove cached image %s: %s", entry.path, e
+                    )
+
+
+image_cache = ImageCache()
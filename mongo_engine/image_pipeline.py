@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from bson import ObjectId
+from gridfs import GridFS
+from mongoengine import ValidationError
+from PIL import Image as PILImage, ImageOps
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+
+from mongo_engine.config import env_bool, env_int, env_str
+
+# Decoding and resizing run in this many worker processes
+IMAGE_UPLOAD_WORKERS = env_int("IMAGE_UPLOAD_WORKERS", os.cpu_count() or 1)
+IMAGE_UPLOAD_STRIP_EXIF = env_bool("IMAGE_UPLOAD_STRIP_EXIF", True)
+# JPEG/WebP quality to recompress uploads with, 0 keeps the original quality
+IMAGE_UPLOAD_QUALITY = env_int("IMAGE_UPLOAD_QUALITY", 0)
+# Longest side of stored originals in pixels, 0 keeps the uploaded size
+IMAGE_UPLOAD_MAX_DIMENSION = env_int("IMAGE_UPLOAD_MAX_DIMENSION", 0)
+IMAGE_UPLOAD_TMP_DIR = env_str("IMAGE_UPLOAD_TMP_DIR")  # system default if unset
+COPY_BUFFER_SIZE = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass
+class ProcessedImage:
+    """
+    Result of processing one upload in a worker: the image and thumbnail to
+    store, as temporary files, with the attributes `ImageField` records.
+    """
+
+    path: str
+    width: int
+    height: int
+    format: str
+    thumbnail_path: Optional[str] = None
+    thumbnail_width: Optional[int] = None
+    thumbnail_height: Optional[int] = None
+
+
+def temporary_path(suffix: str = "") -> str:
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=IMAGE_UPLOAD_TMP_DIR)
+    os.close(fd)
+    return path
+
+
+def process_image(
+    path: str,
+    thumbnail_size: Optional[dict],
+    strip_exif: bool = IMAGE_UPLOAD_STRIP_EXIF,
+    quality: int = IMAGE_UPLOAD_QUALITY,
+    max_dimension: int = IMAGE_UPLOAD_MAX_DIMENSION,
+) -> ProcessedImage:
+    """
+    Decode, optionally normalize and generate the thumbnail of an image file.
+    Runs in a worker process, so it only takes and returns plain values.
+    The original file is stored as is unless it has to be resized, stripped
+    of its EXIF data or recompressed.
+    """
+    with PILImage.open(path) as source:
+        image_format = source.format
+        image = source
+        has_exif = "exif" in source.info
+        if strip_exif and has_exif:
+            # Apply the EXIF orientation before the tag is dropped
+            image = ImageOps.exif_transpose(source)
+        if max_dimension and max(image.size) > max_dimension:
+            image = image.copy() if image is source else image
+            image.thumbnail((max_dimension, max_dimension), PILImage.LANCZOS)
+
+        stored_path = path
+        if image is not source or quality:
+            options = {}
+            if image_format in ("JPEG", "WEBP"):
+                options["quality"] = quality or 90
+            stored_path = temporary_path()
+            image.save(stored_path, image_format, **options)
+
+        processed = ProcessedImage(stored_path, image.width, image.height, image_format)
+        if thumbnail_size:
+            size = (thumbnail_size["width"], thumbnail_size["height"])
+            if thumbnail_size.get("force"):
+                thumbnail = ImageOps.fit(image, size, PILImage.LANCZOS)
+            else:
+                thumbnail = image.copy()
+                thumbnail.thumbnail(size, PILImage.LANCZOS)
+            processed.thumbnail_path = temporary_path()
+            thumbnail.save(processed.thumbnail_path, image_format)
+            processed.thumbnail_width, processed.thumbnail_height = thumbnail.size
+        return processed
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned rather than forked: the parent holds driver threads and sockets
+        _pool = ProcessPoolExecutor(
+            max_workers=IMAGE_UPLOAD_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+def spool(file) -> str:
+    """
+    Copy an uploaded file to a temporary file in fixed-size chunks, so the
+    worker can read it without the bytes crossing the process boundary.
+    """
+    path = temporary_path()
+    file.seek(0)
+    with open(path, "wb") as target:
+        shutil.copyfileobj(file, target, COPY_BUFFER_SIZE)
+    return path
+
+
+def remove_temporary_files(paths) -> None:
+    for path in paths:
+        if path:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Could not remove temporary file %s: %s", path, e)
+
+
+def store(
+    fs: GridFS,
+    processed: ProcessedImage,
+    filename: str,
+    content_type: str,
+    **attributes,
+) -> ObjectId:
+    """
+    Stream the processed files into GridFS chunk by chunk, writing the same
+    file documents as `ImageGridFsProxy.put` does. Extra `attributes` are
+    recorded on the file document of the image, not of its thumbnail.
+    """
+    thumbnail_id = None
+    if processed.thumbnail_path:
+        with open(processed.thumbnail_path, "rb") as thumbnail:
+            thumbnail_id = fs.put(
+                thumbnail,
+                width=processed.thumbnail_width,
+                height=processed.thumbnail_height,
+                format=processed.format,
+                contentType=PILImage.MIME.get(processed.format),
+            )
+    with open(processed.path, "rb") as image:
+        return fs.put(
+            image,
+            filename=filename,
+            contentType=content_type,
+            width=processed.width,
+            height=processed.height,
+            format=processed.format,
+            thumbnail_id=thumbnail_id,
+            **attributes,
+        )
+
+
+async def upload_image(
+    fs: GridFS, upload: UploadFile, thumbnail_size: Optional[dict]
+) -> ObjectId:
+    """
+    Run one upload through the pipeline: spool to disk, process in the
+    worker pool, then store in GridFS. Raises ValidationError for files
+    that are not images.
+    """
+    paths = set()
+    try:
+        source_path = await run_in_threadpool(spool, upload.file)
+        paths.add(source_path)
+        try:
+            processed = await asyncio.get_running_loop().run_in_executor(
+                get_pool(), process_image, source_path, thumbnail_size
+            )
+        except (OSError, ValueError, PILImage.DecompressionBombError) as e:
+            raise ValidationError("Invalid image: %s" % upload.filename) from e
+        paths.update((processed.path, processed.thumbnail_path))
+        return await run_in_threadpool(
+            store, fs, processed, upload.filename, upload.content_type
+        )
+    finally:
+        remove_temporary_files(paths)
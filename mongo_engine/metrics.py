@@ -0,0 +1,422 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import bson
+from pymongo.monitoring import CommandListener
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from mongo_engine.config import env_bool, env_float, env_int, env_str
+
+# Adds the middleware, the command listener and /metrics, which is served
+# without authentication, so only enable it where the port is not public
+METRICS_ENABLED = env_bool("METRICS_ENABLED")
+METRICS_PATH = env_str("METRICS_PATH", "/metrics")
+# Re-encodes every command and reply to count their size, so off by default
+METRICS_COMMAND_BYTES = env_bool("METRICS_COMMAND_BYTES")
+# Commands slower than this are logged with their filter shape, 0 disables the log
+SLOW_QUERY_MS = env_float("SLOW_QUERY_MS", 100)
+# Commands kept for the slow query log while awaiting their reply, oldest
+# dropped first, so commands that never finish cannot pile up
+SLOW_QUERY_PENDING = env_int("SLOW_QUERY_PENDING", 10000)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+Labels = Tuple[str, ...]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values.
+    Updated from the event loop and from driver threads, hence the lock.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, float] = {}
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+            for labels, value in values
+        ]
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(),
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # Per label values: the count of each bucket (not cumulative), then the sum
+        self._observations: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._observations.setdefault(
+                labels, ([0] * len(self.buckets), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            observations = [
+                (labels, list(counts), total[0])
+                for labels, (counts, total) in self._observations.items()
+            ]
+        lines = []
+        for labels, counts, total in observations:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = format_labels(
+                    self.labels + ("le",), labels + (format_value(float(bound)),)
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            suffix = format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{suffix} {format_value(total)}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    The metrics of the process, plus collectors: functions returning a flat
+    dict of numbers (the `stats()` of the caches and the connection pool)
+    that are read at scrape time and exported as gauges.
+    """
+
+    def __init__(self, prefix: str = "supersteel"):
+        self.prefix = prefix
+        self._metrics: List[Metric] = []
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, name: str, collect: Callable[[], dict]) -> None:
+        self._collectors[name] = collect
+
+    def collect(self) -> List[str]:
+        lines = []
+        for name, collect in self._collectors.items():
+            try:
+                stats = collect()
+            except Exception as e:
+                logger.warning("Could not collect %s metrics: %s", name, e)
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (bool, int, float)):
+                    metric = f"{self.prefix}_{name}_{key}"
+                    lines.append(f"# TYPE {metric} gauge")
+                    lines.append(f"{metric} {format_value(value)}")
+        return lines
+
+    def render(self) -> bytes:
+        lines = [line for metric in self._metrics for line in metric.render()]
+        lines.extend(self.collect())
+        return ("\n".join(lines) + "\n").encode()
+
+
+registry = Registry()
+
+requests_total = registry.register(
+    Counter(
+        "http_requests_total",
+        "HTTP requests by route and status.",
+        ("method", "route", "status"),
+    )
+)
+request_duration = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time to the end of the response body.",
+        ("method", "route"),
+    )
+)
+requests_in_flight = registry.register(
+    Gauge(
+        "http_requests_in_flight",
+        "Requests currently being handled.",
+        ("method", "route"),
+    )
+)
+request_commands = registry.register(
+    Histogram(
+        "http_request_mongo_commands",
+        "MongoDB commands issued per request.",
+        ("route",),
+        COMMAND_COUNT_BUCKETS,
+    )
+)
+request_mongo_duration = registry.register(
+    Histogram(
+        "http_request_mongo_duration_seconds",
+        "Time spent in MongoDB commands per request.",
+        ("route",),
+    )
+)
+request_mongo_bytes = registry.register(
+    Counter(
+        "http_request_mongo_bytes_total",
+        "Size of the MongoDB commands sent and replies received, by route.",
+        ("route", "direction"),
+    )
+)
+commands_total = registry.register(
+    Counter(
+        "mongo_commands_total",
+        "MongoDB commands by name and outcome.",
+        ("command", "outcome"),
+    )
+)
+command_duration = registry.register(
+    Histogram(
+        "mongo_command_duration_seconds",
+        "MongoDB command round trips.",
+        ("command",),
+    )
+)
+
+
+@dataclass
+class RequestStats:
+    """
+    MongoDB work attributed to one request.
+    """
+
+    commands: int = 0
+    duration: float = 0.0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+
+
+# Set by the middleware. Threadpool calls and Motor's executor copy the context,
+# so commands issued on their threads are counted against the request too.
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    "request_stats", default=None
+)
+
+
+def query_shape(value):
+    """
+    The shape of a filter or pipeline: field names and operators are kept,
+    values are replaced with their BSON type name.
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return [query_shape(item) for item in value]
+        return "array"
+    return type(value).__name__
+
+
+def command_filter(command) -> Optional[dict]:
+    """
+    The part of a command that decides which documents it touches.
+    """
+    for key in ("filter", "query", "pipeline"):
+        if key in command:
+            return command[key]
+    for key in ("updates", "deletes"):
+        if command.get(key):
+            return command[key][0].get("q")
+    return None
+
+
+class CommandTracer(CommandListener):
+    """
+    Count and time every command of the clients, attribute them to the
+    current request, and log the slow ones with their filter shape.
+    """
+
+    def __init__(
+        self,
+        slow_query_ms: float = SLOW_QUERY_MS,
+        measure_bytes: bool = METRICS_COMMAND_BYTES,
+        max_pending: int = SLOW_QUERY_PENDING,
+    ):
+        self.slow_query_ms = slow_query_ms
+        self.measure_bytes = measure_bytes
+        self.max_pending = max_pending
+        # Commands awaiting their reply, for the slow query log. Events come
+        # from every driver thread, hence the lock
+        self._pending: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._pending_lock = threading.Lock()
+
+    @staticmethod
+    def _key(event) -> tuple:
+        return (event.connection_id, event.request_id)
+
+    def started(self, event):
+        if self.slow_query_ms:
+            with self._pending_lock:
+                self._pending[self._key(event)] = (event.database_name, event.command)
+                while len(self._pending) > self.max_pending:
+                    self._pending.popitem(last=False)
+        if self.measure_bytes:
+            stats = request_stats.get()
+            if stats is not None:
+                stats.bytes_sent += len(bson.encode(event.command))
+
+    def _finished(self, event, outcome: str) -> Optional[RequestStats]:
+        with self._pending_lock:
+            pending = self._pending.pop(self._key(event), None)
+        seconds = event.duration_micros / 1e6
+        commands_total.inc(event.command_name, outcome)
+        command_duration.observe(seconds, event.command_name)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.commands += 1
+            stats.duration += seconds
+        if pending is not None and seconds * 1000 >= self.slow_query_ms:
+            database, command = pending
+            logger.warning(
+                "Slow %s on %s.%s took %.1f ms (%s), filter %s",
+                event.command_name,
+                database,
+                command.get(event.command_name),
+                seconds * 1000,
+                outcome,
+                query_shape(command_filter(command)),
+            )
+        return stats
+
+    def succeeded(self, event):
+        stats = self._finished(event, "succeeded")
+        if stats is not None and self.measure_bytes:
+            stats.bytes_received += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        self._finished(event, "failed")
+
+
+command_tracer = CommandTracer()
+
+
+def route_path(scope: Scope) -> str:
+    """
+    The path template of the route a request goes to, so that
+    `/products/{product_name}` is one label rather than one per product.
+    """
+    partial = None
+    for route in getattr(scope.get("app"), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path or "/"
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path or "/"
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Time every HTTP request and record its status and MongoDB work.
+    Added outermost, so responses served from the response cache count too.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = route_path(scope)
+        status = 500
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        started = time.perf_counter()
+        requests_in_flight.inc(method, route)
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_stats.reset(token)
+            requests_in_flight.dec(method, route)
+            request_duration.observe(time.perf_counter() - started, method, route)
+            requests_total.inc(method, route, str(status))
+            request_commands.observe(stats.commands, route)
+            request_mongo_duration.observe(stats.duration, route)
+            if stats.bytes_sent or stats.bytes_received:
+                request_mongo_bytes.inc(route, "sent", amount=stats.bytes_sent)
+                request_mongo_bytes.inc(route, "received", amount=stats.bytes_received)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return Response(registry.render(), media_type=CONTENT_TYPE)
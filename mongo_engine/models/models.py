@@ -1,8 +1,17 @@
+import logging
 import mongoengine as me
 from datetime import datetime
 from enum import Enum
 from starlette.requests import Request
 from bcrypt import hashpw, gensalt
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from mongo_engine import read_model
+
+# Normalized fields backfilled per bulk write by ensure_indexes
+BACKFILL_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
 
 
 class Unit(str, Enum):
@@ -38,6 +47,7 @@ class Image(me.EmbeddedDocument):
 
 class Product(me.Document):
     title = me.StringField(min_length=3)
+    title_lower = me.StringField()  # Normalized title for indexed lookups
     subtitle = me.StringField()
     description = me.ListField(me.StringField())
     color = me.StringField()
@@ -50,11 +60,27 @@ class Product(me.Document):
     category = me.ReferenceField("Category")
     variant = me.StringField()
 
+    meta = {
+        "indexes": [
+            "title_lower",
+            ("category", "variant"),  # Category listings
+            ("best_seller", "id"),  # Bestseller pages, in cursor order
+            "price",  # Default sort of the admin product list
+        ]
+    }
+
     def save(self, *args, **kwargs):
         # Generate IDs for images in the format "Image01", "Image02", ...
         for index, image in enumerate(self.images):
             image.id = f"Image{index + 1:02}"
+        self.title_lower = self.title.lower() if self.title else None
         super().save(*args, **kwargs)  # Call the parent save method
+        # Keep the storefront projection in step with the product
+        read_model.sync_product(self._get_db(), self.to_mongo().to_dict())
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        read_model.delete_products(self._get_db(), [self.pk])
 
 
 class Admin(me.Document):
@@ -76,10 +102,104 @@ class Variant(me.EmbeddedDocument):
 
 class Category(me.Document):
     name = me.StringField(min_length=3, unique=True)
+    name_lower = me.StringField()  # Normalized name for indexed lookups
     description = me.StringField(min_length=3)
     images = me.ListField(me.EmbeddedDocumentField(Image), max_length=3)
     # variants = me.ListField(me.EmbeddedDocumentField(Variant))
     variants = me.ListField(me.EmbeddedDocumentField(Variant))
 
+    meta = {
+        "indexes": [
+            # Categories are looked up by name_lower, so it must name one of them.
+            # Documents without it (see dedupe_category_names) are left out
+            {
+                "fields": ["name_lower"],
+                "unique": True,
+                "partialFilterExpression": {"name_lower": {"$type": "string"}},
+            }
+        ]
+    }
+
+    def save(self, *args, **kwargs):
+        self.name_lower = self.name.lower() if self.name else None
+        super().save(*args, **kwargs)
+        # Renames and new variant priorities are copied onto the storefront products
+        read_model.sync_category(self._get_db(), self.to_mongo().to_dict())
+
     def __admin_repr__(self, request: Request):
         return self.name
+
+
+def dedupe_category_names(collection) -> None:
+    """
+    Of categories whose names differ only in case, keep `name_lower` on the
+    oldest one and remove it from the others, which stay unreachable by name
+    until they are renamed.
+    """
+    duplicates = collection.aggregate(
+        [
+            {"$match": {"name_lower": {"$type": "string"}}},
+            {"$group": {"_id": "$name_lower", "ids": {"$push": "$_id"}}},
+            {"$match": {"ids.1": {"$exists": True}}},
+        ]
+    )
+    for group in duplicates:
+        extra = sorted(group["ids"])[1:]
+        collection.update_many({"_id": {"$in": extra}}, {"$unset": {"name_lower": ""}})
+        logger.warning(
+            "Categories %s duplicate the name %r in another case, rename them",
+            extra,
+            group["_id"],
+        )
+
+
+def backfill(collection, updates: list) -> None:
+    try:
+        collection.bulk_write(updates, ordered=False)
+    except BulkWriteError as e:
+        # A case duplicate of a name already indexed, left for a rename
+        skipped = [error for error in e.details["writeErrors"] if error["code"] == 11000]
+        if len(skipped) < len(e.details["writeErrors"]):
+            raise
+        logger.warning(
+            "%d documents of %s duplicate an existing name in another case, "
+            "rename them",
+            len(skipped),
+            collection.name,
+        )
+
+
+def ensure_indexes():
+    """
+    Backfill the normalized lookup fields of documents saved before they
+    existed, then create the declared indexes.
+    """
+    for document, source, target in (
+        (Product, "title", "title_lower"),
+        (Category, "name", "name_lower"),
+    ):
+        # Not _get_collection, which creates the indexes before the cleanup
+        collection = document._get_db()[document._get_collection_name()]
+        updates = []
+        for doc in collection.find(
+            {target: {"$exists": False}, source: {"$type": "string"}},
+            {source: 1},
+            batch_size=BACKFILL_BATCH_SIZE,
+        ):
+            updates.append(
+                UpdateOne({"_id": doc["_id"]}, {"$set": {target: doc[source].lower()}})
+            )
+            if len(updates) >= BACKFILL_BATCH_SIZE:
+                backfill(collection, updates)
+                updates = []
+        if updates:
+            backfill(collection, updates)
+
+    categories = Category._get_db()[Category._get_collection_name()]
+    dedupe_category_names(categories)
+    # Created by earlier versions without the unique option
+    index = categories.index_information().get("name_lower_1")
+    if index and not index.get("unique"):
+        categories.drop_index("name_lower_1")
+    Product.ensure_indexes()
+    Category.ensure_indexes()
@@ -33,6 +33,36 @@ class ProductSummaryModel(BaseModel):
     images: List[ImageModel]
 
 
+class FacetValueModel(BaseModel):
+    value: Optional[str]
+    count: int
+
+
+class BestSellerFacetModel(BaseModel):
+    value: bool
+    count: int
+
+
+class PriceBucketModel(BaseModel):
+    min: Optional[float]  # None, with max, for the products without a price
+    max: Optional[float]  # None for the open-ended top bucket
+    count: int
+
+
+class FacetsModel(BaseModel):
+    variant: List[FacetValueModel]
+    color: List[FacetValueModel]
+    price: List[PriceBucketModel]
+    best_seller: List[BestSellerFacetModel]
+
+
+# Products of a filtered listing together with the facet counts of all matches
+class ProductFacetsModel(BaseModel):
+    products: List[ProductSummaryModel]
+    total: int
+    facets: FacetsModel
+
+
 # Full Pydantic model for a Product
 class ProductModel(BaseModel):
     id: str = Field(alias="_id")  # MongoDB ObjectId
@@ -0,0 +1,343 @@
+import logging
+import os
+import re
+import uuid
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING, TEXT, ReplaceOne, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+# Denormalized copy of each product, shaped for the public storefront routes
+STOREFRONT_COLLECTION = "storefront_product"
+REBUILD_BATCH_SIZE = 1000
+# Scratch collections are named with this prefix and a unique suffix
+SCRATCH_PREFIX = f"{STOREFRONT_COLLECTION}_rebuild_"
+# Ids of the products and categories synced since the last rebuild started,
+# replayed onto the new projection once it is swapped in
+CHANGES_COLLECTION = f"{STOREFRONT_COLLECTION}_changes"
+# One lease document lets a single process rebuild at a time. It is renewed
+# after every batch, and taken over once it expires (e.g. the holder died).
+LEASE_COLLECTION = "read_model_lease"
+LEASE_SECONDS = 300
+# Bumped when the document shape changes, so startup rebuilds older projections
+STOREFRONT_VERSION = 2
+# Longest title word prefix stored for autocomplete
+MAX_PREFIX_LENGTH = 15
+
+STOREFRONT_INDEXES = [
+    [("title_lower", ASCENDING)],
+    # Category listings, ordered by variant priority then insertion order
+    [("category_id", ASCENDING), ("priority", ASCENDING), ("_id", ASCENDING)],
+    [("category_id", ASCENDING), ("variant", ASCENDING), ("_id", ASCENDING)],
+    [("best_seller", ASCENDING), ("_id", ASCENDING)],
+    # Faceted listings: equality filters first, then the price range
+    [
+        ("category_id", ASCENDING),
+        ("variant", ASCENDING),
+        ("best_seller", ASCENDING),
+        ("price", ASCENDING),
+    ],
+    [("category_id", ASCENDING), ("color", ASCENDING), ("price", ASCENDING)],
+    # Prefix autocomplete, alphabetical within the first matched prefix
+    [("title_prefixes", ASCENDING), ("title_lower", ASCENDING)],
+]
+
+# Full-text search, ranked mostly on the title
+STOREFRONT_TEXT_INDEX = {
+    "keys": [
+        ("title", TEXT),
+        ("subtitle", TEXT),
+        ("description", TEXT),
+        ("color", TEXT),
+    ],
+    "weights": {"title": 10, "subtitle": 5, "color": 3, "description": 1},
+    "name": "storefront_text",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def variant_priority_map(category: Optional[dict]) -> dict:
+    variants = (category or {}).get("variants") or []
+    return {v["variant"].lower(): v.get("Priority", 0) for v in variants}
+
+
+def variant_priority_expression(category: dict) -> dict:
+    """
+    Aggregation expression giving the priority of a product's variant within
+    its category (0 when the variant is unknown), matched case-insensitively.
+    """
+    product_variant = {"$toLower": {"$ifNull": ["$variant", ""]}}
+    return {
+        "$switch": {
+            "branches": [
+                {"case": {"$eq": [product_variant, name]}, "then": priority}
+                for name, priority in variant_priority_map(category).items()
+            ],
+            "default": 0,
+        }
+    }
+
+
+def words(text: Optional[str]) -> List[str]:
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def title_prefixes(title: Optional[str]) -> List[str]:
+    """
+    Edge n-grams of every word of the title: "Steel chair" gives
+    "s", "st", ..., "steel", "c", ..., "chair".
+    """
+    prefixes = set()
+    for word in words(title):
+        for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+            prefixes.add(word[:length])
+    return sorted(prefixes)
+
+
+def build_storefront_doc(product: dict, category: Optional[dict]) -> dict:
+    """
+    Resolve everything the storefront needs for a raw `product` document:
+    category name, variant priority and image paths (relative to the base URL).
+    """
+    images = []
+    for image in product.get("images") or []:
+        image_src = image.get("image_src")
+        if isinstance(image_src, ObjectId):
+            images.append(
+                {
+                    "id": image.get("id"),
+                    "image_src": f"/images/{image_src}",
+                    "thumbnail_src": f"/images/{image_src}/thumbnail",
+                }
+            )
+    title = product.get("title")
+    variant = product.get("variant")
+    return {
+        "_id": product["_id"],
+        "title": title,
+        "title_lower": title.lower() if title else None,
+        "title_prefixes": title_prefixes(title),
+        "subtitle": product.get("subtitle"),
+        "description": product.get("description") or [],
+        "price": product.get("price"),
+        "color": product.get("color"),
+        "best_seller": product.get("best_seller", False),
+        "images": images,
+        "dimension": product.get("dimension"),
+        "weight": product.get("weight"),
+        "created_at": product.get("created_at"),
+        "category": category["name"] if category else "Unknown",
+        "category_id": category["_id"] if category else None,
+        "variant": variant,
+        "priority": variant_priority_map(category).get((variant or "").lower(), 0),
+        "v": STOREFRONT_VERSION,
+    }
+
+
+def ensure_indexes(db: Database, collection: Optional[str] = None) -> None:
+    collection = db[collection or STOREFRONT_COLLECTION]
+    for keys in STOREFRONT_INDEXES:
+        collection.create_index(keys)
+    options = dict(STOREFRONT_TEXT_INDEX)
+    collection.create_index(options.pop("keys"), **options)
+
+
+def record_changes(db: Database, kind: str, ids: Iterable[ObjectId]) -> None:
+    """
+    Note products or categories about to be synced, so a rebuild running
+    meanwhile replays them. Recorded before the storefront write: a rebuild
+    that misses the record swapped its projection in before that write.
+    """
+    updates = [
+        UpdateOne({"_id": _id}, {"$set": {"kind": kind}}, upsert=True) for _id in ids
+    ]
+    if updates:
+        db[CHANGES_COLLECTION].bulk_write(updates, ordered=False)
+
+
+def sync_product(db: Database, product: dict) -> None:
+    """
+    Refresh the storefront document of one product after it was saved.
+    """
+    category = None
+    if isinstance(product.get("category"), ObjectId):
+        category = db.category.find_one(
+            {"_id": product["category"]}, {"name": 1, "variants": 1}
+        )
+    try:
+        record_changes(db, "product", [product["_id"]])
+        db[STOREFRONT_COLLECTION].replace_one(
+            {"_id": product["_id"]},
+            build_storefront_doc(product, category),
+            upsert=True,
+        )
+    except PyMongoError as e:
+        # The product itself is saved; a rebuild will catch the projection up
+        logger.error("Could not update storefront product %s: %s", product["_id"], e)
+
+
+def sync_category(db: Database, category: dict) -> None:
+    """
+    Propagate a category's name and variant priorities to its products.
+    """
+    try:
+        record_changes(db, "category", [category["_id"]])
+        db[STOREFRONT_COLLECTION].update_many(
+            {"category_id": category["_id"]},
+            [
+                {
+                    "$set": {
+                        "category": category["name"],
+                        "priority": variant_priority_expression(category),
+                    }
+                }
+            ],
+        )
+    except PyMongoError as e:
+        logger.error("Could not update storefront category %s: %s", category["_id"], e)
+
+
+def delete_products(db: Database, product_ids: Iterable[ObjectId]) -> None:
+    product_ids = list(product_ids)
+    record_changes(db, "product", product_ids)
+    db[STOREFRONT_COLLECTION].delete_many({"_id": {"$in": product_ids}})
+
+
+def acquire_lease(db: Database, owner: str) -> bool:
+    """
+    Take or renew the rebuild lease for `owner`. False while another
+    process holds an unexpired lease.
+    """
+    now = datetime.utcnow()
+    try:
+        db[LEASE_COLLECTION].find_one_and_update(
+            {
+                "_id": STOREFRONT_COLLECTION,
+                "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}],
+            },
+            {
+                "$set": {
+                    "owner": owner,
+                    "expires_at": now + timedelta(seconds=LEASE_SECONDS),
+                }
+            },
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # The upsert collided with the lease document of another owner
+        return False
+    return True
+
+
+def release_lease(db: Database, owner: str) -> None:
+    db[LEASE_COLLECTION].delete_one({"_id": STOREFRONT_COLLECTION, "owner": owner})
+
+
+def replay_changes(db: Database) -> int:
+    """
+    Re-sync the products and categories recorded in the change journal onto
+    the live projection, and return how many were replayed.
+    """
+    changes = list(db[CHANGES_COLLECTION].find())
+    product_ids = [c["_id"] for c in changes if c.get("kind") == "product"]
+    category_ids = [c["_id"] for c in changes if c.get("kind") == "category"]
+    for category in db.category.find({"_id": {"$in": category_ids}}):
+        sync_category(db, category)
+    if product_ids:
+        products = {p["_id"]: p for p in db.product.find({"_id": {"$in": product_ids}})}
+        categories = {
+            c["_id"]: c
+            for c in db.category.find(
+                {"_id": {"$in": list({p.get("category") for p in products.values()})}}
+            )
+        }
+        writes = [
+            ReplaceOne(
+                {"_id": product["_id"]},
+                build_storefront_doc(product, categories.get(product.get("category"))),
+                upsert=True,
+            )
+            for product in products.values()
+        ]
+        if writes:
+            db[STOREFRONT_COLLECTION].bulk_write(writes, ordered=False)
+        deleted = [_id for _id in product_ids if _id not in products]
+        if deleted:
+            db[STOREFRONT_COLLECTION].delete_many({"_id": {"$in": deleted}})
+    db[CHANGES_COLLECTION].delete_many({"_id": {"$in": [c["_id"] for c in changes]}})
+    return len(changes)
+
+
+def rebuild(db: Database) -> Optional[int]:
+    """
+    Rebuild the whole projection into a scratch collection, then swap it in
+    with a single rename so readers never see a partial projection.
+
+    Only one process rebuilds at a time: returns None without doing anything
+    while another holds the lease. Products and categories synced during the
+    rebuild are replayed after the swap, as their writes went to the
+    collection the rename replaces.
+    """
+    owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+    if not acquire_lease(db, owner):
+        logger.info("%s is being rebuilt by another process", STOREFRONT_COLLECTION)
+        return None
+    scratch = f"{SCRATCH_PREFIX}{uuid.uuid4().hex}"
+    try:
+        # Left behind by holders that died; only the lease holder creates them
+        for name in db.list_collection_names():
+            if name.startswith(SCRATCH_PREFIX):
+                db.drop_collection(name)
+        # Everything synced from here on is in the scan below or replayed
+        db[CHANGES_COLLECTION].delete_many({})
+        categories = {category["_id"]: category for category in db.category.find()}
+
+        count = 0
+        batch: List[ReplaceOne] = []
+        for product in db.product.find(batch_size=REBUILD_BATCH_SIZE):
+            doc = build_storefront_doc(
+                product, categories.get(product.get("category"))
+            )
+            batch.append(ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+            if len(batch) >= REBUILD_BATCH_SIZE:
+                db[scratch].bulk_write(batch, ordered=False)
+                count += len(batch)
+                batch = []
+                if not acquire_lease(db, owner):
+                    raise RuntimeError(
+                        f"Lost the {STOREFRONT_COLLECTION} rebuild lease"
+                    )
+        if batch:
+            db[scratch].bulk_write(batch, ordered=False)
+            count += len(batch)
+
+        # Creates the scratch collection even without products, so it can be renamed
+        ensure_indexes(db, scratch)
+        db[scratch].rename(STOREFRONT_COLLECTION, dropTarget=True)
+        replayed = replay_changes(db)
+        if replayed:
+            logger.info("Replayed %d changes made during the rebuild", replayed)
+        return count
+    finally:
+        db.drop_collection(scratch)
+        release_lease(db, owner)
+
+
+def ensure_read_model(db: Database) -> None:
+    """
+    Create the indexes, and build the projection if it has never been built
+    or was built by an older version.
+    """
+    ensure_indexes(db)
+    storefront = db[STOREFRONT_COLLECTION]
+    if storefront.estimated_document_count() == 0:
+        if db.product.estimated_document_count() > 0:
+            logger.info("Building %s for the first time", STOREFRONT_COLLECTION)
+            rebuild(db)
+    elif storefront.find_one({"v": {"$ne": STOREFRONT_VERSION}}, {"_id": 1}):
+        logger.info("Rebuilding %s for a new document version", STOREFRONT_COLLECTION)
+        rebuild(db)
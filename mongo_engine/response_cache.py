@@ -0,0 +1,472 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from pymongo import ReturnDocument
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from mongo_engine.config import env_float, env_int, env_str, settings
+from mongo_engine.db import connection
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # Optional, only needed for RESPONSE_CACHE_BACKEND=redis
+    redis = None
+
+# memory, redis or off
+RESPONSE_CACHE_BACKEND = env_str("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_REDIS_URL = env_str(
+    "RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0"
+)
+RESPONSE_CACHE_MAX_ENTRIES = env_int("RESPONSE_CACHE_MAX_ENTRIES", 1000)
+# Bounds staleness after edits that bypass the admin (scripts, direct database writes)
+RESPONSE_CACHE_TTL = env_int("RESPONSE_CACHE_TTL", 300)
+RESPONSE_CACHE_PATHS = ("/categories", "/products", "/bestsellers")
+# How often the memory backend checks for purges made by other workers
+RESPONSE_CACHE_SYNC_SECONDS = env_float("RESPONSE_CACHE_SYNC_SECONDS", 1)
+GENERATION_COLLECTION = "response_cache_generation"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedResponse:
+    """
+    An encoded response body with its raw headers and ETag.
+    """
+
+    body: bytes
+    headers: List[Tuple[bytes, bytes]]
+    etag: str
+    expires_at: float = 0.0
+
+
+def product_tags(product_id, category_ids: Iterable = ()) -> List[str]:
+    """
+    Tags to purge when a product changes: its own pages, the listings of
+    the categories it belongs (or belonged) to, and the global listings.
+    """
+    tags = ["products", "bestsellers", f"product:{product_id}"]
+    tags.extend(
+        f"category:{category_id}" for category_id in category_ids if category_id
+    )
+    return tags
+
+
+def category_tags(category_id) -> List[str]:
+    return ["categories", f"category:{category_id}"]
+
+
+class SharedGeneration:
+    """
+    Purge counter kept in MongoDB, bumped by every purge in any worker.
+    Reads are cached for `interval` seconds, which bounds how long another
+    worker keeps serving responses a purge removed.
+    """
+
+    def __init__(self, interval: float = RESPONSE_CACHE_SYNC_SECONDS):
+        self.interval = interval
+        self._value = 0
+        self._read_at = float("-inf")
+
+    def _collection(self):
+        # The primary, so a worker never reads a counter older than its own
+        return connection.async_db[GENERATION_COLLECTION]
+
+    async def current(self) -> int:
+        if time.monotonic() - self._read_at >= self.interval:
+            doc = await self._collection().find_one({"_id": "response_cache"})
+            self._value = (doc or {}).get("generation", 0)
+            self._read_at = time.monotonic()
+        return self._value
+
+    async def bump(self) -> int:
+        doc = await self._collection().find_one_and_update(
+            {"_id": "response_cache"},
+            {"$inc": {"generation": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._value = doc["generation"]
+        self._read_at = time.monotonic()
+        return self._value
+
+
+class MemoryBackend:
+    """
+    In-process LRU of cached responses, with a tag to keys index for purges.
+    Each worker process has its own copy. With `shared`, purges made by other
+    workers empty it within `shared.interval` seconds; the Redis backend
+    shares entries and purges between workers right away.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        shared: Optional[SharedGeneration] = None,
+    ):
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries: "OrderedDict[str, Tuple[CachedResponse, List[str]]]" = (
+            OrderedDict()
+        )
+        self._tags: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        # Bumped on every purge seen by this process, local or shared
+        self._generation = 0
+        self._shared_seen: Optional[int] = None
+
+    async def generation(self) -> int:
+        if self.shared is not None:
+            current = await self.shared.current()
+            if current != self._shared_seen:
+                with self._lock:
+                    # Purged elsewhere, the tags are not known: drop everything
+                    if self._shared_seen is not None:
+                        self._entries.clear()
+                        self._tags.clear()
+                    self._shared_seen = current
+                    self._generation += 1
+        return self._generation
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        await self.generation()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0].expires_at < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    async def set(
+        self, key: str, entry: CachedResponse, tags: List[str], generation: int
+    ) -> bool:
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._remove(key)
+            while len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+            self._entries[key] = (entry, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+        return True
+
+    async def purge(self, tags: Iterable[str]) -> None:
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+        if self.shared is not None:
+            # Already applied here, so this worker does not empty itself
+            value = await self.shared.bump()
+            with self._lock:
+                if self._shared_seen is not None and value == self._shared_seen + 1:
+                    self._shared_seen = value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: str) -> None:
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        for tag in item[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisBackend:
+    """
+    Responses stored in a Redis-compatible server, shared by all workers.
+    Each tag is a set of the keys it covers; Redis expiry bounds both the
+    entries and the tag sets. A purge counter in the server keeps responses
+    computed before a purge in any worker from being stored after it.
+    """
+
+    def __init__(
+        self, url: str = RESPONSE_CACHE_REDIS_URL, prefix: str = "response-cache:"
+    ):
+        if redis is None:
+            raise RuntimeError(
+                "RESPONSE_CACHE_BACKEND=redis requires the redis package"
+            )
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+        self.generation_key = f"{prefix}generation"
+
+    async def generation(self) -> int:
+        return int(await self.client.get(self.generation_key) or 0)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        item = await self.client.hgetall(self.prefix + key)
+        if not item:
+            return None
+        headers = [
+            (name.encode("latin-1"), value.encode("latin-1"))
+            for name, value in json.loads(item[b"headers"])
+        ]
+        return CachedResponse(item[b"body"], headers, item[b"etag"].decode("ascii"))
+
+    async def set(
+        self, key: str, entry: CachedResponse, tags: List[str], generation: int
+    ) -> bool:
+        headers = [
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in entry.headers
+        ]
+        async with self.client.pipeline(transaction=True) as pipe:
+            # The write is dropped if a purge bumps the counter before it runs
+            await pipe.watch(self.generation_key)
+            if int(await pipe.get(self.generation_key) or 0) != generation:
+                await pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.hset(
+                self.prefix + key,
+                mapping={
+                    "body": entry.body,
+                    "headers": json.dumps(headers),
+                    "etag": entry.etag,
+                },
+            )
+            pipe.expire(self.prefix + key, RESPONSE_CACHE_TTL)
+            for tag in tags:
+                pipe.sadd(f"{self.prefix}tag:{tag}", key)
+                pipe.expire(f"{self.prefix}tag:{tag}", RESPONSE_CACHE_TTL)
+            try:
+                await pipe.execute()
+            except redis.WatchError:
+                return False
+        return True
+
+    async def purge(self, tags: Iterable[str]) -> None:
+        # First, so fetches that started before the purge are not stored
+        await self.client.incr(self.generation_key)
+        for tag in tags:
+            tag_key = f"{self.prefix}tag:{tag}"
+            keys = await self.client.smembers(tag_key)
+            await self.client.delete(
+                tag_key, *(self.prefix + key.decode() for key in keys)
+            )
+
+
+class ResponseCache:
+    """
+    Cache of encoded GET responses keyed by path and normalized query string.
+
+    Routes opt in by setting `request.state.cache_tags`; only 200 responses
+    carrying tags are stored. Admin hooks purge entries by tag after edits.
+    The backend's purge counter, read before a response is computed, keeps
+    responses computed before a purge from being stored after it. For the
+    read-your-writes window after a purge, refills read the primary, so a
+    lagging secondary cannot put the purged data back.
+    """
+
+    def __init__(self, backend=None, ttl: int = RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._last_generation: Optional[int] = None
+        self._purged_at = float("-inf")
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    @staticmethod
+    def key(scope: Scope) -> str:
+        query = parse_qsl(
+            scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True
+        )
+        return f"{scope['path']}?{urlencode(sorted(query))}"
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        try:
+            entry = await self.backend.get(key)
+        except Exception as e:
+            logger.warning("Response cache lookup failed: %s", e)
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def generation(self) -> Optional[int]:
+        """
+        The backend's purge counter, or None if it cannot be read, in which
+        case the response is not stored.
+        """
+        try:
+            generation = await self.backend.generation()
+        except Exception as e:
+            logger.warning("Response cache generation lookup failed: %s", e)
+            return None
+        if generation != self._last_generation:
+            if self._last_generation is not None:
+                self._purged_at = time.monotonic()
+            self._last_generation = generation
+        return generation
+
+    def recently_purged(self) -> bool:
+        return time.monotonic() - self._purged_at < settings.read_your_writes_seconds
+
+    async def set(
+        self,
+        key: str,
+        body: bytes,
+        headers: list,
+        tags: List[str],
+        generation: Optional[int],
+    ) -> CachedResponse:
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        entry = CachedResponse(body, headers, etag, time.time() + self.ttl)
+        if generation is None:
+            return entry
+        try:
+            await self.backend.set(key, entry, tags, generation)
+        except Exception as e:
+            logger.warning("Response cache store failed: %s", e)
+        return entry
+
+    async def purge(self, tags: Iterable[str]) -> None:
+        if not self.enabled:
+            return
+        self._purged_at = time.monotonic()
+        try:
+            await self.backend.purge(list(tags))
+        except Exception as e:
+            # A failed purge leaves entries stale until their TTL expires
+            logger.error("Response cache purge failed for %s: %s", tags, e)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ResponseCacheMiddleware:
+    """
+    Serve cached responses for GET requests under `paths`, answering
+    `If-None-Match` with 304 from the stored hash, and store the responses
+    of routes that set `request.state.cache_tags`.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        cache: "ResponseCache",
+        paths: Tuple[str, ...] = RESPONSE_CACHE_PATHS,
+    ):
+        self.app = app
+        self.cache = cache
+        self.paths = paths
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "GET"
+            or not self.cache.enabled
+            or not scope["path"].startswith(self.paths)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        key = self.cache.key(scope)
+        entry = await self.cache.get(key)
+        if entry is not None:
+            await self.send_entry(scope, send, entry)
+            return
+        # Read before the route runs, compared again when the response is stored
+        generation = await self.cache.generation()
+        if self.cache.recently_purged():
+            # See reading_own_writes
+            scope.setdefault("state", {})["read_primary"] = True
+
+        start: Optional[Message] = None
+        chunks: List[bytes] = []
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                tags = scope.get("state", {}).get("cache_tags")
+                if message["status"] == 200 and tags:
+                    # Hold the response until the body is complete and hashed
+                    start = message
+                    return
+            elif start is not None and message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    return
+                body = b"".join(chunks)
+                headers = [
+                    (name, value)
+                    for name, value in start["headers"]
+                    if name.lower() != b"etag"
+                ]
+                stored = await self.cache.set(
+                    key, body, headers, scope["state"]["cache_tags"], generation
+                )
+                await self.send_entry(scope, send, stored, hit=False)
+                return
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    async def send_entry(
+        scope: Scope, send: Send, entry: CachedResponse, hit: bool = True
+    ) -> None:
+        etag = entry.etag.encode()
+        if_none_match = Headers(scope=scope).get("if-none-match")
+        if if_none_match is not None:
+            etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            if "*" in etags or entry.etag in etags:
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": 304,
+                        "headers": [(b"etag", etag)],
+                    }
+                )
+                await send({"type": "http.response.body", "body": b""})
+                return
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": entry.headers
+                + [(b"etag", etag), (b"x-cache", b"HIT" if hit else b"MISS")],
+            }
+        )
+        await send({"type": "http.response.body", "body": entry.body})
+
+
+def create_backend(name: str = RESPONSE_CACHE_BACKEND):
+    if name == "redis":
+        return RedisBackend()
+    if name == "memory":
+        return MemoryBackend(shared=SharedGeneration())
+    return None
+
+
+response_cache = ResponseCache(create_backend())
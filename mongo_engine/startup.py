@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from pymongo.errors import ConnectionFailure, OperationFailure, PyMongoError
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp
+
+from mongo_engine.config import settings
+from mongo_engine.db import connection
+from mongo_engine.read_model import STOREFRONT_COLLECTION
+
+# Storefront responses and caches filled before the app reports ready
+WARMUP_PATHS = ("/categories", "/bestsellers")
+FIRST_RETRY_SECONDS = 0.5
+# Server error codes that go away on their own: elections, shutdowns,
+# network and lock timeouts
+TRANSIENT_ERROR_CODES = frozenset(
+    {6, 7, 24, 50, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+)
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient(error: PyMongoError) -> bool:
+    if isinstance(error, ConnectionFailure):
+        return True
+    if error.has_error_label("RetryableWriteError") or error.has_error_label(
+        "TransientTransactionError"
+    ):
+        return True
+    return isinstance(error, OperationFailure) and error.code in TRANSIENT_ERROR_CODES
+
+
+class Startup:
+    """
+    Brings the app to ready after the lifespan has started: ensures the
+    indexes, then warms the caches, retrying both while MongoDB errors are
+    transient.
+    Runs as a background task, so the server answers /healthz meanwhile and
+    /readyz reports the phase it is in.
+    """
+
+    def __init__(self):
+        self.phase = "starting"
+        self.ready = False
+        self.attempts = 0
+        self.error: Optional[str] = None
+        # Seconds spent in each phase
+        self.timings: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _retry(self, step: Callable[[], Awaitable[None]]) -> None:
+        delay = FIRST_RETRY_SECONDS
+        while True:
+            self.attempts += 1
+            try:
+                await step()
+                self.error = None
+                return
+            except PyMongoError as e:
+                if not is_transient(e):
+                    raise
+                self.error = str(e)
+                logger.warning(
+                    "MongoDB unavailable during %s, retrying in %.1fs: %s",
+                    self.phase,
+                    delay,
+                    e,
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.startup_retry_max_seconds)
+
+    async def _run_phase(self, phase: str, step) -> None:
+        self.phase = phase
+        started = time.perf_counter()
+        await step
+        self.timings[phase] = round(time.perf_counter() - started, 3)
+
+    async def run(
+        self, app: ASGIApp, prepare: Callable[[], None], imported_at: float
+    ) -> None:
+        async def prepare_and_warm_up() -> None:
+            await self._run_phase("indexes", run_in_threadpool(prepare))
+            if not settings.warmup_enabled:
+                return
+            try:
+                await self._run_phase("warmup", warm_up(app))
+            except Exception as e:
+                if isinstance(e, PyMongoError) and is_transient(e):
+                    raise
+                # Cold caches only make the first requests slower
+                logger.exception("Warmup failed, starting with cold caches")
+
+        try:
+            await self._retry(prepare_and_warm_up)
+        except Exception as e:
+            self.phase = "failed"
+            self.error = str(e)
+            logger.exception("Startup failed")
+            return
+        self.phase = "ready"
+        self.ready = True
+        logger.info("Ready %.2fs after import", time.perf_counter() - imported_at)
+
+    def start(
+        self, app: ASGIApp, prepare: Callable[[], None], imported_at: float
+    ) -> None:
+        self._task = asyncio.create_task(self.run(app, prepare, imported_at))
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phase": self.phase,
+            "attempts": self.attempts,
+            "error": self.error,
+            "timings": self.timings,
+        }
+
+
+async def hot_image_paths(limit: int) -> List[str]:
+    """
+    Paths of the first image and thumbnail of up to `limit` bestsellers.
+    """
+    if limit <= 0:
+        return []
+    cursor = (
+        connection.catalog_db()[STOREFRONT_COLLECTION]
+        .find({"best_seller": True}, {"images": {"$slice": 1}})
+        .sort("_id", 1)
+        .limit(limit)
+    )
+    paths = []
+    async for product in cursor:
+        for image in product.get("images") or []:
+            # Stored as paths in the read model, see build_storefront_doc
+            paths.extend([image["image_src"], image["thumbnail_src"]])
+    return paths
+
+
+async def warm_up(app: ASGIApp) -> None:
+    """
+    Request the hot storefront paths in-process, which fills the category
+    cache, the response cache and the image cache, and opens pool connections.
+    A failed request is logged and does not hold back readiness.
+    """
+    paths = list(WARMUP_PATHS) + await hot_image_paths(settings.warmup_images)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://warmup"
+    ) as client:
+        responses = await asyncio.gather(
+            *(client.get(path) for path in paths), return_exceptions=True
+        )
+    for path, response in zip(paths, responses):
+        if isinstance(response, Exception):
+            logger.warning("Warmup of %s failed: %s", path, response)
+        elif response.status_code != 200:
+            logger.warning("Warmup of %s returned %s", path, response.status_code)
+    logger.info("Warmed up %d paths", len(paths))
+
+
+startup = Startup()
+
+
+async def liveness(request: Request) -> JSONResponse:
+    return JSONResponse({"status": "ok"})
+
+
+async def readiness(request: Request) -> JSONResponse:
+    return JSONResponse(startup.status(), status_code=200 if startup.ready else 503)
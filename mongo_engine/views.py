@@ -1,23 +1,174 @@
-from typing import List, Any
+import asyncio
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Union
+import mongoengine as me
 from starlette_admin.contrib.mongoengine import ModelView
 from starlette.requests import Request
-from pymongo import MongoClient
-from gridfs import GridFSBucket
+from starlette.concurrency import run_in_threadpool
 from bson import ObjectId
-from mongo_engine.models.models import Product
-import os
-from dotenv import load_dotenv
+from bson import DBRef
+from gridfs import GridFS, GridOut
+from starlette.datastructures import UploadFile
+from mongo_engine.models.models import Image, Product
+from mongo_engine.config import env_int
+from mongo_engine.db import get_db, note_write, MONGO_BUCKET_NAME
+from mongo_engine.gridfs_cleanup import delete_images, referenced_image_ids
+from mongo_engine.category_cache import category_cache
+from mongo_engine.image_cache import image_cache
+from mongo_engine.image_pipeline import upload_image
+from mongo_engine import read_model
+from mongo_engine.response_cache import category_tags, product_tags, response_cache
+import logging
 from starlette_admin import RequestAction
+from starlette_admin.exceptions import FormValidationError
+from starlette_admin.contrib.mongoengine.helpers import build_order_clauses
 
 
-load_dotenv()
+# Images loaded per product on the admin list page, the rest show on its detail page
+ADMIN_LIST_IMAGES = env_int("ADMIN_LIST_IMAGES", 1)
 
-MONGO_URL = os.environ.get("MONGO_URL")
-MONGO_DB = os.environ.get("MONGO_DB")
-MONGO_BUCKET_NAME = os.environ.get("MONGO_BUCKET_NAME")
+logger = logging.getLogger(__name__)
 
 
-class ProductView(ModelView):
+async def publish_change(request: Request, tags: List[str]) -> None:
+    """
+    Make an admin write visible on the storefront: the admin's storefront
+    reads go to the primary for the read-your-writes window, and the
+    affected cached responses are purged.
+    """
+    note_write(request)
+    await response_cache.purge(tags)
+
+
+def file_proxies(doc: me.Document, names: Sequence[str]) -> List[me.GridFSProxy]:
+    """
+    GridFS proxies held by the given fields of a document, including those
+    of embedded documents and lists of them.
+    """
+    proxies = []
+
+    def collect(field, value):
+        if isinstance(field, me.FileField):
+            if value is not None and value.grid_id is not None:
+                proxies.append(value)
+        elif isinstance(field, me.ListField) and value:
+            for item in value:
+                collect(field.field, item)
+        elif isinstance(field, me.EmbeddedDocumentField) and value is not None:
+            for name, subfield in value._fields.items():
+                collect(subfield, getattr(value, name))
+
+    for name in names:
+        if name in doc._fields:
+            collect(doc._fields[name], getattr(doc, name))
+    return proxies
+
+
+def prefetch_files(docs: Sequence[me.Document], names: Sequence[str]) -> None:
+    """
+    Load the GridFS file documents behind the proxies of a page with one
+    query per collection. Serializing a file field reads its filename,
+    content type and thumbnail, which otherwise costs a query per image.
+    """
+    by_collection = defaultdict(list)
+    for doc in docs:
+        for proxy in file_proxies(doc, names):
+            if proxy.gridout is None:
+                by_collection[(proxy.db_alias, proxy.collection_name)].append(proxy)
+    for (alias, collection_name), proxies in by_collection.items():
+        root = me.connection.get_db(alias)[collection_name]
+        files = {
+            file["_id"]: file
+            for file in root.files.find(
+                {"_id": {"$in": list({proxy.grid_id for proxy in proxies})}}
+            )
+        }
+        for proxy in proxies:
+            if proxy.grid_id in files:
+                proxy.gridout = GridOut(root, file_document=files[proxy.grid_id])
+
+
+def prefetch_references(docs: Sequence[me.Document], names: Sequence[str]) -> None:
+    """
+    Dereference the reference fields of a page with one `$in` query per
+    field, instead of one query per row when each is first accessed.
+    Missing documents are left as references.
+    """
+    for name in names:
+        field = docs[0]._fields.get(name) if docs else None
+        if not isinstance(field, me.ReferenceField):
+            continue
+        refs = [doc._data.get(name) for doc in docs]
+        ids = {ref.id for ref in refs if isinstance(ref, DBRef)}
+        if not ids:
+            continue
+        found = field.document_type.objects.in_bulk(list(ids))
+        for doc, ref in zip(docs, refs):
+            if isinstance(ref, DBRef) and ref.id in found:
+                # Assigned to _data so the document is not marked as changed
+                doc._data[name] = found[ref.id]
+
+
+class ListPageModelView(ModelView):
+    """
+    ModelView whose list page only loads the listed fields, resolves their
+    references and GridFS files in batches, and counts unfiltered tables
+    from the collection metadata.
+    """
+
+    # Projections applied on top of the listed fields, e.g. {"slice__images": 1}
+    list_field_projection: Dict[str, Any] = {}
+
+    def list_field_names(self, request: Request) -> List[str]:
+        fields = self.get_fields_list(request, RequestAction.LIST)
+        return [field.name for field in fields]
+
+    def fetch_page(
+        self, request: Request, query: Any, skip: int, limit: int, order_by: List[str]
+    ) -> List[me.Document]:
+        names = self.list_field_names(request)
+        objs = (
+            self.document.objects(query)
+            .only(*names)
+            .fields(**self.list_field_projection)
+            .order_by(*build_order_clauses(order_by))
+        )
+        docs = list(objs[skip : skip + limit] if limit > 0 else objs[skip:])
+        prefetch_references(docs, names)
+        prefetch_files(docs, names)
+        return docs
+
+    async def find_all(
+        self,
+        request: Request,
+        skip: int = 0,
+        limit: int = 100,
+        where: Union[Dict[str, Any], str, None] = None,
+        order_by: Optional[List[str]] = None,
+    ) -> Sequence[Any]:
+        # Exports, select2 lookups and actions need whole documents
+        if getattr(request.state, "action", None) != RequestAction.LIST:
+            return await super().find_all(request, skip, limit, where, order_by)
+        query = await self._build_query(request, where)
+        return await run_in_threadpool(
+            self.fetch_page, request, query, skip, limit, order_by or []
+        )
+
+    async def count(
+        self,
+        request: Request,
+        where: Union[Dict[str, Any], str, None] = None,
+    ) -> int:
+        if not where:
+            # Read from the collection metadata instead of scanning the collection
+            return await run_in_threadpool(
+                self.document._get_collection().estimated_document_count
+            )
+        query = await self._build_query(request, where)
+        return await run_in_threadpool(self.document.objects(query).count)
+
+
+class ProductView(ListPageModelView):
     fields = [
         "id",
         "title",
@@ -40,44 +191,201 @@ class ProductView(ModelView):
     exclude_fields_from_create = ["created_at"]
     exclude_fields_from_edit = ["created_at"]
     fields_default_sort = [("price", True)]
+    list_field_projection = {"slice__images": ADMIN_LIST_IMAGES}
+
+    async def upload_images(self, request: Request, data: Dict[str, Any]) -> None:
+        """
+        Store every uploaded image concurrently through the upload pipeline,
+        instead of one after the other inside `ImageField`. The uploads are
+        taken out of `data` so the default form handling skips them, and are
+        attached to the product in `attach_images`.
+        """
+        uploads = {}
+        for index, image in enumerate(data.get("images") or []):
+            upload, should_be_deleted = image.get("image_src") or (None, False)
+            if isinstance(upload, UploadFile) and not should_be_deleted:
+                uploads[index] = upload
+                image["image_src"] = (None, False)
+
+        field = Image._fields["image_src"]
+        fs = GridFS(get_db(), MONGO_BUCKET_NAME)
+        results = await asyncio.gather(
+            *(
+                upload_image(fs, upload, field.thumbnail_size)
+                for upload in uploads.values()
+            ),
+            return_exceptions=True,
+        )
+        stored = dict(zip(uploads, results))
+        failures = [result for result in results if isinstance(result, Exception)]
+        if failures:
+            # Do not leave the images that did succeed behind
+            await run_in_threadpool(
+                delete_images,
+                get_db(),
+                MONGO_BUCKET_NAME,
+                [result for result in results if isinstance(result, ObjectId)],
+            )
+            raise failures[0]
+        request.state.uploaded_images = stored
+
+    async def attach_images(self, request: Request, obj: Any) -> None:
+        """
+        Point the product's images at the uploaded files. Files being
+        replaced are only noted here and removed in `remove_replaced_images`
+        once the product is saved.
+        """
+        replaced = []
+        for index, file_id in getattr(request.state, "uploaded_images", {}).items():
+            proxy = obj.images[index].image_src
+            if proxy.grid_id is not None:
+                replaced.append(proxy.grid_id)
+            proxy.grid_id = file_id
+            proxy._mark_as_changed()
+        request.state.replaced_images = replaced
+
+    async def delete_image_files(self, image_ids: List[ObjectId]) -> None:
+        # Removes thumbnails and generated variants along with the images
+        if not image_ids:
+            return
+        result = await run_in_threadpool(
+            delete_images, get_db(), MONGO_BUCKET_NAME, image_ids
+        )
+        image_cache.discard(result.deleted)
+        for file_id, error in result.failed.items():
+            logger.error("Error deleting image with ID %s: %s", file_id, error)
+
+    async def remove_replaced_images(self, request: Request) -> None:
+        # The saved product now owns the uploads, so a later failure keeps them
+        request.state.uploaded_images = {}
+        await self.delete_image_files(getattr(request.state, "replaced_images", []))
+
+    async def discard_uploaded_images(self, request: Request) -> None:
+        uploaded = getattr(request.state, "uploaded_images", {})
+        request.state.uploaded_images = {}
+        await self.delete_image_files(list(uploaded.values()))
+
+    async def create(self, request: Request, data: Dict[str, Any]) -> Any:
+        try:
+            await self.upload_images(request, data)
+        except Exception as e:
+            self.handle_exception(e)
+        try:
+            return await super().create(request, data)
+        except Exception:
+            await self.discard_uploaded_images(request)
+            raise
+
+    async def edit(self, request: Request, pk: Any, data: Dict[str, Any]) -> Any:
+        try:
+            await self.upload_images(request, data)
+        except Exception as e:
+            self.handle_exception(e)
+        try:
+            return await super().edit(request, pk, data)
+        except Exception:
+            await self.discard_uploaded_images(request)
+            raise
+
+    async def before_create(
+        self, request: Request, data: Dict[str, Any], obj: Any
+    ) -> None:
+        await self.attach_images(request, obj)
+
+    async def after_create(self, request: Request, obj: Any) -> None:
+        await self.remove_replaced_images(request)
+        await publish_change(
+            request, product_tags(obj.pk, [obj.category and obj.category.pk])
+        )
+
+    async def before_edit(
+        self, request: Request, data: Dict[str, Any], obj: Any
+    ) -> None:
+        # The stored category is needed to purge the listing the product leaves
+        stored = await run_in_threadpool(
+            get_db().product.find_one, {"_id": obj.pk}, {"category": 1}
+        )
+        request.state.previous_category = (stored or {}).get("category")
+        await self.attach_images(request, obj)
+
+    async def after_edit(self, request: Request, obj: Any) -> None:
+        await self.remove_replaced_images(request)
+        await publish_change(
+            request,
+            product_tags(
+                obj.pk,
+                [obj.category and obj.category.pk, request.state.previous_category],
+            )
+        )
 
     async def delete(self, request: Request, pks: List[Any]) -> int | None:
-        # Connect to MongoDB using PyMongo
-        client = MongoClient(MONGO_URL)
-        db = client[MONGO_DB]
-        bucket = GridFSBucket(db, bucket_name=MONGO_BUCKET_NAME)
+        product_ids = [ObjectId(str(pk)) for pk in pks]
+        db = get_db()
 
-        for pk in pks:
-            product = Product.objects(id=pk).first()
-            if product:
-                for image in product.images:
-                    # Handle both main image and thumbnail files
-                    file_ids = [image.image_src._id]
+        # The per-object hooks still run, around the bulk deletes below
+        products = await run_in_threadpool(list, Product.objects(id__in=product_ids))
+        for product in products:
+            await self.before_delete(request, product)
 
-                    # Check if a thumbnail exists
-                    if hasattr(image.image_src, "thumbnail_id"):
-                        file_ids.append(image.image_src.thumbnail_id)
+        category_ids = await run_in_threadpool(
+            db.product.distinct, "category", {"_id": {"$in": product_ids}}
+        )
 
-                    for file_id in file_ids:
-                        file_id = ObjectId(str(file_id))
-                        try:
-                            bucket.delete(file_id)
-                            print(f"Deleted image with ID {file_id} successfully.")
-                        except Exception as e:
-                            print(f"Error deleting image with ID {file_id}: {e}")
+        # Collect every image of the selected products in one query
+        image_ids = await run_in_threadpool(
+            referenced_image_ids, db, "product", product_ids
+        )
 
-                # Delete the product itself
-                product.delete()
+        # Delete the products and their storefront documents, one query each
+        deleted = await run_in_threadpool(Product.objects(id__in=product_ids).delete)
+        await run_in_threadpool(read_model.delete_products, db, product_ids)
 
-        client.close()
+        # Then remove the files no other product or category uses, with their
+        # thumbnails and variants, in batched $in deletes
+        result = await run_in_threadpool(
+            delete_images, db, MONGO_BUCKET_NAME, image_ids
+        )
+        image_cache.discard(result.deleted)
+        logger.info(
+            "Deleted %d GridFS files for %d products, kept %d shared images",
+            len(result.deleted),
+            len(pks),
+            len(result.kept),
+        )
+        if result.missing:
+            logger.warning("Images already missing from GridFS: %s", result.missing)
+        for file_id, error in result.failed.items():
+            logger.error("Error deleting image with ID %s: %s", file_id, error)
 
-        return await super().delete(request, pks)
+        await publish_change(
+            request,
+            [tag for pk in product_ids for tag in product_tags(pk, category_ids)],
+        )
+        for product in products:
+            await self.after_delete(request, product)
+        return deleted
 
 
-class CategoryView(ModelView):
+class CategoryView(ListPageModelView):
     fields = ["id", "name", "description", "images","variants"]
     exclude_fields_from_list = ["images", "description"]
     fields_default_sort = ["name"]
 
     def can_delete(self, request: Request) -> bool:
         return False
+
+    def handle_exception(self, exc: Exception) -> None:
+        # Names are unique regardless of case, see the name_lower index
+        if isinstance(exc, me.NotUniqueError):
+            raise FormValidationError(
+                {"name": "A category with this name already exists"}
+            )
+        super().handle_exception(exc)
+
+    async def after_create(self, request: Request, obj: Any) -> None:
+        category_cache.invalidate()
+        await publish_change(request, category_tags(obj.pk))
+
+    async def after_edit(self, request: Request, obj: Any) -> None:
+        category_cache.invalidate()
+        await publish_change(request, category_tags(obj.pk))
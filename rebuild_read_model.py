@@ -0,0 +1,17 @@
+import sys
+import time
+
+from mongo_engine.db import get_db
+from mongo_engine.read_model import STOREFRONT_COLLECTION, rebuild
+
+
+if __name__ == "__main__":
+    # Run after bulk imports or direct database edits that bypassed Product.save
+    start = time.perf_counter()
+    count = rebuild(get_db())
+    if count is None:
+        sys.exit(f"'{STOREFRONT_COLLECTION}' is being rebuilt by another process.")
+    print(
+        f"Rebuilt '{STOREFRONT_COLLECTION}' with {count} products "
+        f"in {time.perf_counter() - start:.1f}s."
+    )
@@ -0,0 +1,74 @@
+"""
+Tests run against the in-memory stand-in of benchmarks.seed (mongomock and
+mongomock-motor, see requirements-dev.txt), so they need no mongod. Tests
+that depend on the server itself (query plans, replica sets) are skipped
+unless TEST_MONGO_URL points at a scratch deployment.
+"""
+
+import os
+
+# Read by mongo_engine.config on import, before any app module is loaded
+os.environ.setdefault("RESPONSE_CACHE_BACKEND", "off")
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ.setdefault("ORIGIN_NAME", "http://localhost:3000")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("BASE_URL", "http://testserver")
+
+import mongoengine
+import pytest
+from fastapi.testclient import TestClient
+from pymongo import MongoClient
+
+from benchmarks.seed import use_in_memory_database
+from mongo_engine.category_cache import category_cache
+from mongo_engine.db import get_db
+
+TEST_MONGO_URL = os.environ.get("TEST_MONGO_URL")
+TEST_MONGO_DB = "supersteel_test"
+# mongoengine alias of the TEST_MONGO_URL deployment, for use with switch_db
+SERVER_ALIAS = "test-server"
+
+
+@pytest.fixture(scope="session")
+def memory_db():
+    use_in_memory_database()
+    return get_db()
+
+
+@pytest.fixture
+def db(memory_db):
+    for name in memory_db.list_collection_names():
+        memory_db.drop_collection(name)
+    category_cache.invalidate()
+    yield memory_db
+    category_cache.invalidate()
+
+
+@pytest.fixture
+def app(db):
+    from main import app
+
+    yield app
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def client(app):
+    # Not entered as a context manager: the lifespan would connect to MONGO_URL
+    return TestClient(app)
+
+
+@pytest.fixture
+def server_db():
+    """
+    Scratch database on the TEST_MONGO_URL deployment, dropped after the test.
+    """
+    if not TEST_MONGO_URL:
+        pytest.skip("TEST_MONGO_URL is not set")
+    client = MongoClient(TEST_MONGO_URL, serverSelectionTimeoutMS=5000)
+    client.drop_database(TEST_MONGO_DB)
+    mongoengine.register_connection(SERVER_ALIAS, host=TEST_MONGO_URL, db=TEST_MONGO_DB)
+    yield client[TEST_MONGO_DB]
+    mongoengine.disconnect(SERVER_ALIAS)
+    client.drop_database(TEST_MONGO_DB)
+    client.close()
@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+from mongo_engine.metrics import CommandTracer
+
+
+def test_pool_stats_are_not_public(client):
+    # The admin mounted at "/" answers unknown paths, with its login page
+    response = client.get("/pool-stats")
+    assert "max_pool_size" not in response.text
+
+
+def test_metrics_are_off_by_default(client):
+    response = client.get("/metrics")
+    assert "# TYPE" not in response.text
+
+
+def test_pending_commands_are_bounded():
+    tracer = CommandTracer(slow_query_ms=100, max_pending=2)
+    for request_id in range(5):
+        # Started, but the reply never comes
+        tracer.started(
+            SimpleNamespace(
+                connection_id=("localhost", 27017),
+                request_id=request_id,
+                database_name="supersteel",
+                command={"find": "product"},
+            )
+        )
+    assert list(tracer._pending) == [(("localhost", 27017), 3), (("localhost", 27017), 4)]
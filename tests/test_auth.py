@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from bcrypt import gensalt, hashpw
+from starlette_admin.exceptions import LoginFailed
+
+from mongo_engine import auth
+from mongo_engine.auth import AdminCache, MyAuthProvider, password_stamp
+from mongo_engine.models.models import Admin
+
+
+def fake_request(session=None):
+    return SimpleNamespace(session=session or {}, state=SimpleNamespace())
+
+
+@pytest.fixture
+def provider(db, monkeypatch):
+    monkeypatch.setattr(auth, "admin_cache", AdminCache(ttl=60))
+    return MyAuthProvider(login_path="/sign-in", logout_path="/sign-out")
+
+
+def sign_in(provider, username="owner", password="secret"):
+    request = fake_request()
+    asyncio.run(provider.login(username, password, False, request, None))
+    return request.session
+
+
+def is_authenticated(provider, session) -> bool:
+    return asyncio.run(provider.is_authenticated(fake_request(dict(session))))
+
+
+def test_login_stores_the_password_stamp(provider):
+    admin = Admin.create_admin("owner", "secret")
+    session = sign_in(provider)
+    assert session == {
+        "username": "owner",
+        "auth_stamp": password_stamp(admin.password_hash),
+    }
+    assert is_authenticated(provider, session)
+    with pytest.raises(LoginFailed):
+        sign_in(provider, password="wrong")
+
+
+def test_password_change_revokes_sessions_after_the_ttl(provider):
+    admin = Admin.create_admin("owner", "secret")
+    session = sign_in(provider)
+    admin.password_hash = hashpw(b"changed", gensalt()).decode("utf-8")
+    admin.save()
+
+    # Trusted from the cache until the TTL runs out, then checked again
+    assert is_authenticated(provider, session)
+    auth.admin_cache.ttl = 0
+    assert not is_authenticated(provider, session)
+    assert is_authenticated(provider, sign_in(provider, password="changed"))
+
+
+def test_deleted_admins_are_logged_out(provider):
+    admin = Admin.create_admin("owner", "secret")
+    session = sign_in(provider)
+    admin.delete()
+    auth.admin_cache.ttl = 0
+    assert not is_authenticated(provider, session)
+
+
+def test_admin_cache_is_bounded():
+    cache = AdminCache(ttl=60, size=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+    # "b" was the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
@@ -0,0 +1,43 @@
+import json
+
+from catalog_io import import_records, read_records
+
+
+def write_lines(path, lines):
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return str(path)
+
+
+def test_bad_lines_are_reported_without_aborting_the_import(db, tmp_path):
+    path = write_lines(
+        tmp_path / "products.jsonl",
+        [
+            json.dumps({"title": "Chair", "price": 120}),
+            "{not json",
+            json.dumps(["Table"]),
+            json.dumps({"title": "Lamp", "price": 40}),
+        ],
+    )
+
+    report = import_records(
+        db, "products", read_records(path, "products", "jsonl"), str(tmp_path)
+    )
+
+    assert report.inserted == 2
+    assert [line for line, _ in report.errors] == [2, 3]
+    assert "Expected a JSON object" in report.errors[1][1]
+    assert sorted(doc["title"] for doc in db.product.find()) == ["Chair", "Lamp"]
+
+
+def test_a_zero_price_is_rejected_rather_than_removed(db, tmp_path):
+    db.product.insert_one({"title": "Chair", "title_lower": "chair", "price": 120})
+    path = write_lines(
+        tmp_path / "products.jsonl", [json.dumps({"title": "Chair", "price": 0})]
+    )
+
+    report = import_records(
+        db, "products", read_records(path, "products", "jsonl"), str(tmp_path)
+    )
+
+    assert [line for line, _ in report.errors] == [1]
+    assert db.product.find_one({"title": "Chair"})["price"] == 120
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from gridfs import GridFS
+
+from gridfs_gc import collect_garbage
+from mongo_engine.db import MONGO_BUCKET_NAME
+
+OLD = datetime.now(timezone.utc) - timedelta(days=7)
+
+
+def put(db, age=OLD, **attributes) -> ObjectId:
+    file_id = GridFS(db, MONGO_BUCKET_NAME).put(b"x" * 10, **attributes)
+    files = db[f"{MONGO_BUCKET_NAME}.files"]
+    files.update_one({"_id": file_id}, {"$set": {"uploadDate": age}})
+    return file_id
+
+
+def orphan_chunk(db) -> ObjectId:
+    files_id = ObjectId.from_datetime(OLD)
+    db[f"{MONGO_BUCKET_NAME}.chunks"].insert_one(
+        {"files_id": files_id, "n": 0, "data": b"x"}
+    )
+    return files_id
+
+
+def file_ids(db) -> set:
+    return {doc["_id"] for doc in db[f"{MONGO_BUCKET_NAME}.files"].find()}
+
+
+def test_dry_run_deletes_nothing(db, capsys):
+    put(db)
+    orphan = orphan_chunk(db)
+    before = file_ids(db)
+
+    collect_garbage(delete=False, min_age_hours=24, verbose=True)
+
+    output = capsys.readouterr().out
+    assert "Unreferenced files: 1" in output
+    assert f"orphan_chunks: {orphan}" in output
+    assert "Dry run" in output
+    assert file_ids(db) == before
+    assert db[f"{MONGO_BUCKET_NAME}.chunks"].count_documents({"files_id": orphan}) == 1
+
+
+def test_recent_uploads_are_kept(db):
+    put(db)
+    recent = put(db, age=datetime.now(timezone.utc) - timedelta(hours=1))
+
+    collect_garbage(delete=True, min_age_hours=24, verbose=False)
+
+    assert file_ids(db) == {recent}
+
+
+def test_thumbnails_and_variants_of_referenced_images_are_kept(db):
+    thumbnail = put(db)
+    image = put(db, thumbnail_id=thumbnail)
+    variant = put(db, metadata={"variant_of": image, "width": 256})
+    unreferenced = put(db)
+    db.product.insert_one({"title": "Chair", "images": [{"image_src": image}]})
+
+    collect_garbage(delete=True, min_age_hours=24, verbose=False)
+
+    assert file_ids(db) == {thumbnail, image, variant}
+    assert unreferenced not in file_ids(db)
+
+
+def test_orphan_chunks_are_deleted_only_with_delete(db, capsys):
+    orphan = orphan_chunk(db)
+    chunks = db[f"{MONGO_BUCKET_NAME}.chunks"]
+
+    collect_garbage(delete=False, min_age_hours=24, verbose=False)
+    assert "Chunk groups without a file document: 1" in capsys.readouterr().out
+    assert chunks.count_documents({"files_id": orphan}) == 1
+
+    collect_garbage(delete=True, min_age_hours=24, verbose=False)
+    assert "1 orphan chunks" in capsys.readouterr().out
+    assert chunks.count_documents({"files_id": orphan}) == 0
@@ -0,0 +1,22 @@
+import asyncio
+import os
+
+from mongo_engine.image_cache import ImageCache
+
+
+def test_disk_tier_is_per_process_and_removed_on_close(tmp_path):
+    other_worker = tmp_path / "gridfs-images-1"
+    other_worker.mkdir()
+    (other_worker / "served").write_bytes(b"still being served")
+
+    cache = ImageCache(memory_max_file=0, disk_dir=str(tmp_path))
+    assert os.listdir(other_worker) == ["served"]
+
+    entry = asyncio.run(cache.put({"_id": "abc"}, b"x" * 100))
+    assert entry.path == str(tmp_path / f"gridfs-images-{os.getpid()}" / "abc")
+    assert open(entry.path, "rb").read() == b"x" * 100
+
+    cache.close()
+    assert not os.path.exists(cache.disk_dir)
+    assert cache.get("abc") is None
+    assert os.listdir(other_worker) == ["served"]
@@ -0,0 +1,255 @@
+import asyncio
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+from gridfs import GridFS
+from PIL import Image as PILImage
+from starlette_admin.contrib.mongoengine import ModelView
+from starlette_admin.exceptions import FormValidationError
+
+from catalog_io import import_records, read_records
+from mongo_engine.gridfs_cleanup import delete_images
+from mongo_engine.image_cache import image_cache
+from mongo_engine.image_pipeline import ProcessedImage, store
+from mongo_engine.models.models import Image, Product
+from mongo_engine.read_model import STOREFRONT_COLLECTION, rebuild
+from mongo_engine.views import ProductView
+
+
+def jpeg(size=(64, 48)) -> bytes:
+    buffer = io.BytesIO()
+    PILImage.new("RGB", size, "red").save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def test_images_are_served_from_the_admin_bucket(db, client):
+    data = jpeg()
+    # Where ImageField stores the admin uploads
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    image_id = fs.put(data, filename="chair.jpg", contentType="image/jpeg")
+
+    response = client.get(f"/images/{image_id}")
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["content-type"] == "image/jpeg"
+
+
+def test_thumbnail_lookup_is_not_counted_in_the_cache_stats(db, client):
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    thumbnail_id = fs.put(jpeg((16, 12)), contentType="image/jpeg")
+    image_id = fs.put(jpeg(), contentType="image/jpeg", thumbnail_id=thumbnail_id)
+    before = image_cache.stats()
+
+    for _ in range(3):
+        assert client.get(f"/images/{image_id}/thumbnail").status_code == 200
+
+    after = image_cache.stats()
+    # One miss to load the thumbnail, then hits; the original is never looked up
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 2
+
+
+def test_stored_thumbnails_record_their_format(db, tmp_path):
+    image_path, thumbnail_path = tmp_path / "image.jpg", tmp_path / "thumb.jpg"
+    image_path.write_bytes(jpeg())
+    thumbnail_path.write_bytes(jpeg((16, 12)))
+    processed = ProcessedImage(
+        path=str(image_path), width=64, height=48, format="JPEG",
+        thumbnail_path=str(thumbnail_path), thumbnail_width=16, thumbnail_height=12,
+    )
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    image_id = store(fs, processed, "chair.jpg", "image/jpeg")
+
+    thumbnail = fs.get(fs.get(image_id).thumbnail_id)
+    assert thumbnail.format == "JPEG"
+    assert thumbnail._file["contentType"] == "image/jpeg"
+
+
+def test_replaced_images_are_removed_only_after_the_save(db):
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    old_thumbnail = fs.put(jpeg((16, 12)))
+    old_image = fs.put(jpeg(), thumbnail_id=old_thumbnail)
+    new_image = fs.put(jpeg())
+    db.product.insert_one({"title": "Chair", "images": [{"image_src": old_image}]})
+    product = Product.objects.get(title="Chair")
+    view = ProductView(Product)
+    request = SimpleNamespace(state=SimpleNamespace(uploaded_images={0: new_image}))
+
+    asyncio.run(view.attach_images(request, product))
+    # Nothing is deleted until the product is saved
+    assert fs.exists(old_image)
+
+    product.save()
+    asyncio.run(view.remove_replaced_images(request))
+    assert not fs.exists(old_image)
+    assert not fs.exists(old_thumbnail)
+    assert fs.exists(new_image)
+    assert db.product.find_one()["images"][0]["image_src"] == new_image
+
+
+def test_uploads_are_removed_when_the_form_fails(db, monkeypatch):
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    uploaded = fs.put(jpeg())
+    view = ProductView(Product)
+    request = SimpleNamespace(state=SimpleNamespace())
+
+    async def upload_images(request, data):
+        request.state.uploaded_images = {0: uploaded}
+
+    async def invalid(self, request, pk, data):
+        raise FormValidationError({"title": "required"})
+
+    monkeypatch.setattr(view, "upload_images", upload_images)
+    monkeypatch.setattr(ModelView, "edit", invalid)
+    with pytest.raises(FormValidationError):
+        asyncio.run(view.edit(request, "pk", {}))
+    assert not fs.exists(uploaded)
+
+
+def stored_image(db):
+    data = jpeg((320, 240))
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    return fs.put(data, filename="chair.jpg", contentType="image/jpeg"), data
+
+
+def test_conditional_requests_return_304(db, client):
+    image_id, _ = stored_image(db)
+    first = client.get(f"/images/{image_id}")
+    etag, last_modified = first.headers["etag"], first.headers["last-modified"]
+
+    assert client.get(f"/images/{image_id}", headers={"If-None-Match": etag}).status_code == 304
+    for since in (last_modified, last_modified.replace("GMT", "-0000")):
+        response = client.get(f"/images/{image_id}", headers={"If-Modified-Since": since})
+        assert response.status_code == 304
+    earlier = "Mon, 01 Jan 2001 00:00:00 GMT"
+    response = client.get(f"/images/{image_id}", headers={"If-Modified-Since": earlier})
+    assert response.status_code == 200
+
+
+def test_range_requests(db, client):
+    image_id, data = stored_image(db)
+    length = len(data)
+
+    response = client.get(f"/images/{image_id}", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 10-19/{length}"
+    assert response.content == data[10:20]
+
+    response = client.get(f"/images/{image_id}", headers={"Range": "bytes=-5"})
+    assert response.headers["content-range"] == f"bytes {length - 5}-{length - 1}/{length}"
+    assert response.content == data[-5:]
+
+    response = client.get(f"/images/{image_id}", headers={"Range": f"bytes={length}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{length}"
+
+    # A validator that no longer matches gets the whole, current file
+    response = client.get(
+        f"/images/{image_id}", headers={"Range": "bytes=0-9", "If-Range": '"stale"'}
+    )
+    assert response.status_code == 200
+    assert response.content == data
+
+
+def test_images_deleted_by_another_worker_are_not_served(db, client, monkeypatch):
+    image_id, _ = stored_image(db)
+    assert client.get(f"/images/{image_id}").status_code == 200
+    assert image_cache.peek(str(image_id)) is not None
+
+    # Deleted elsewhere: this process' cache is never told
+    delete_images(db, Image._fields["image_src"].collection_name, [image_id])
+    monkeypatch.setattr(image_cache, "revalidate_seconds", 60)
+    assert client.get(f"/images/{image_id}").status_code == 200
+    monkeypatch.setattr(image_cache, "revalidate_seconds", 0)
+    assert client.get(f"/images/{image_id}").status_code == 404
+    assert image_cache.peek(str(image_id)) is None
+
+
+def test_variants_of_undecodable_files_serve_the_original(db, client):
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    data = b"not really a jpeg"
+    image_id = fs.put(data, contentType="image/jpeg", format="JPEG", width=2000)
+
+    for _ in range(2):
+        response = client.get(f"/images/{image_id}", params={"width": 256})
+        assert response.status_code == 200
+        assert response.content == data
+    files = db[f"{Image._fields['image_src'].collection_name}.files"]
+    assert files.count_documents({"metadata.variant_of": image_id}) == 0
+
+
+def insert_product(db, title):
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    thumbnail_id = fs.put(jpeg((16, 12)))
+    image_id = fs.put(jpeg(), thumbnail_id=thumbnail_id)
+    product_id = db.product.insert_one(
+        {
+            "title": title,
+            "title_lower": title.lower(),
+            "images": [{"id": "Image01", "image_src": image_id}],
+        }
+    ).inserted_id
+    return product_id, [image_id, thumbnail_id]
+
+
+def test_admin_bulk_delete_removes_files_and_storefront_docs(db):
+    products = [insert_product(db, title) for title in ("Chair", "Table", "Lamp")]
+    rebuild(db)
+    hooks = []
+
+    class RecordingView(ProductView):
+        async def before_delete(self, request, obj):
+            hooks.append(("before", obj.title))
+
+        async def after_delete(self, request, obj):
+            hooks.append(("after", obj.title))
+
+    request = SimpleNamespace(state=SimpleNamespace())
+    deleted = asyncio.run(
+        RecordingView(Product).delete(request, [products[0][0], products[1][0]])
+    )
+
+    assert deleted == 2
+    assert sorted(hooks) == sorted(
+        [("before", "Chair"), ("before", "Table"), ("after", "Chair"), ("after", "Table")]
+    )
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    for _, file_ids in products[:2]:
+        assert not any(fs.exists(file_id) for file_id in file_ids)
+    assert all(fs.exists(file_id) for file_id in products[2][1])
+    assert [doc["title"] for doc in db[STOREFRONT_COLLECTION].find()] == ["Lamp"]
+    assert request.state.read_your_writes
+
+
+def test_images_shared_by_imported_products_outlive_one_delete(db, tmp_path):
+    (tmp_path / "chair.jpg").write_bytes(jpeg())
+    path = tmp_path / "products.jsonl"
+    path.write_text(
+        "\n".join(
+            json.dumps({"title": title, "price": 10, "images": ["chair.jpg"]})
+            for title in ("Chair", "Armchair")
+        )
+        + "\n",
+        encoding="utf-8",
+    )
+    import_records(
+        db, "products", read_records(str(path), "products", "jsonl"), str(tmp_path)
+    )
+    chair, armchair = (
+        db.product.find_one({"title": title}) for title in ("Chair", "Armchair")
+    )
+    image_id = chair["images"][0]["image_src"]
+    assert armchair["images"][0]["image_src"] == image_id
+    fs = GridFS(db, Image._fields["image_src"].collection_name)
+    thumbnail_id = fs.get(image_id).thumbnail_id
+    request = SimpleNamespace(state=SimpleNamespace())
+
+    asyncio.run(ProductView(Product).delete(request, [chair["_id"]]))
+
+    assert fs.exists(image_id) and fs.exists(thumbnail_id)
+
+    asyncio.run(ProductView(Product).delete(request, [armchair["_id"]]))
+
+    assert not fs.exists(image_id) and not fs.exists(thumbnail_id)
@@ -0,0 +1,98 @@
+import mongoengine as me
+import mongomock
+import pytest
+from mongoengine.context_managers import switch_db
+
+from mongo_engine import read_model
+from mongo_engine.models import models
+from mongo_engine.models.models import Category, Product, ensure_indexes
+from tests.conftest import SERVER_ALIAS
+
+
+def plan_stages(plan: dict) -> list:
+    """
+    Stage names of an explain() plan tree, classic or slot based.
+    """
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages.extend(plan_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def winning_stages(collection, query: dict) -> list:
+    explain = collection.find(query).explain()
+    return plan_stages(explain["queryPlanner"]["winningPlan"])
+
+
+def test_normalized_lookups_use_an_index(server_db):
+    with switch_db(Product, SERVER_ALIAS), switch_db(Category, SERVER_ALIAS):
+        ensure_indexes()
+    read_model.ensure_indexes(server_db)
+    server_db.product.insert_many(
+        [{"title": f"Chair {i}", "title_lower": f"chair {i}"} for i in range(200)]
+    )
+    server_db.category.insert_many(
+        [{"name": f"Tables {i}", "name_lower": f"tables {i}"} for i in range(50)]
+    )
+    server_db[read_model.STOREFRONT_COLLECTION].insert_many(
+        [{"title": f"Chair {i}", "title_lower": f"chair {i}"} for i in range(200)]
+    )
+
+    for collection, query in (
+        (server_db.product, {"title_lower": "chair 7"}),
+        (server_db.category, {"name_lower": "tables 7"}),
+        # The lookup of get_product
+        (server_db[read_model.STOREFRONT_COLLECTION], {"title_lower": "chair 7"}),
+    ):
+        stages = winning_stages(collection, query)
+        assert "IXSCAN" in stages, (collection.name, stages)
+        assert "COLLSCAN" not in stages, (collection.name, stages)
+
+
+def test_backfill_writes_in_batches(db, monkeypatch):
+    monkeypatch.setattr(models, "BACKFILL_BATCH_SIZE", 10)
+    db.product.insert_many([{"title": f"Chair {i}"} for i in range(25)])
+    db.category.insert_many([{"name": "Tables"}, {"name": None}])
+
+    batches = []
+    bulk_write = mongomock.Collection.bulk_write
+
+    def record(collection, requests, *args, **kwargs):
+        batches.append(len(requests))
+        return bulk_write(collection, requests, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.Collection, "bulk_write", record)
+    ensure_indexes()
+
+    assert batches == [10, 10, 5, 1]
+    assert db.product.count_documents({"title_lower": {"$exists": False}}) == 0
+    assert db.category.find_one({"name": "Tables"})["name_lower"] == "tables"
+    assert "name_lower" not in db.category.find_one({"name": None})
+
+
+def test_category_names_are_unique_regardless_of_case(db):
+    db.category.insert_many(
+        [{"name": "Tables"}, {"name": "TABLES"}, {"name": "Chairs"}]
+    )
+    ensure_indexes()
+
+    # The oldest keeps the lookup name, the duplicate waits for a rename
+    assert db.category.find_one({"name": "Tables"})["name_lower"] == "tables"
+    assert "name_lower" not in db.category.find_one({"name": "TABLES"})
+    with pytest.raises(me.NotUniqueError):
+        Category(name="tables").save()
+    Category(name="Lamps").save()
+
+
+def test_backfill_skips_case_duplicates_of_indexed_names(db):
+    ensure_indexes()
+    Category(name="Tables").save()
+    # Saved by an older version, without the normalized name
+    db.category.insert_one({"name": "TABLES"})
+
+    ensure_indexes()
+
+    assert "name_lower" not in db.category.find_one({"name": "TABLES"})
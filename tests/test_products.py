@@ -0,0 +1,119 @@
+import asyncio
+import json
+
+import pytest
+
+from benchmarks.seed import seed
+from mongo_engine.read_model import rebuild
+from mongo_engine.Routes import productRoutes
+from mongo_engine.Routes.productRoutes import DEFAULT_PAGE_SIZE, PRICE_BUCKETS
+
+
+def test_products_without_limit_returns_every_product(db, client):
+    seed(db, categories=2, products=DEFAULT_PAGE_SIZE + 20, images_per_product=1, distinct_images=1)
+
+    response = client.get("/products")
+    assert response.status_code == 200
+    assert len(response.json()) == DEFAULT_PAGE_SIZE + 20
+    assert "x-next-cursor" not in response.headers
+
+    bestsellers = client.get("/bestsellers")
+    assert bestsellers.status_code == 200
+    assert len(bestsellers.json()) == db.product.count_documents({"best_seller": True})
+    assert "x-next-cursor" not in bestsellers.headers
+
+
+def test_products_with_limit_pages_with_a_cursor(db, client):
+    seed(db, categories=2, products=25, images_per_product=1, distinct_images=1)
+
+    seen = []
+    response = client.get("/products", params={"limit": 10})
+    while True:
+        assert response.status_code == 200
+        seen.extend(product["title"] for product in response.json())
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            break
+        response = client.get("/products", params={"limit": 10, "after": cursor})
+
+    assert len(seen) == 25
+    assert len(set(seen)) == 25
+
+
+def test_unpriced_products_get_their_own_price_bucket(db, client):
+    seed(db, categories=1, products=4, images_per_product=1, distinct_images=1)
+    db.product.update_many({}, {"$set": {"price": 2000.0}})
+    db.product.update_one({"title": "Benchmark product 0"}, {"$unset": {"price": ""}})
+    db.product.update_one({"title": "Benchmark product 1"}, {"$set": {"price": None}})
+    rebuild(db)
+
+    response = client.get("/products/facets")
+    assert response.status_code == 200
+    assert response.json()["facets"]["price"] == [
+        {"min": PRICE_BUCKETS[-1], "max": None, "count": 2},
+        {"min": None, "max": None, "count": 2},
+    ]
+
+
+def test_stream_writes_one_product_per_line(db, client, monkeypatch):
+    monkeypatch.setattr(productRoutes, "STREAM_BATCH_SIZE", 10)
+    seed(db, categories=2, products=25, images_per_product=1, distinct_images=1)
+
+    response = client.get("/products", params={"stream": "true"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text.endswith("\n")
+    titles = [json.loads(line)["title"] for line in response.text.splitlines()]
+    assert len(set(titles)) == 25
+
+    bestsellers = client.get("/bestsellers", params={"stream": "true"})
+    assert len(bestsellers.text.splitlines()) == db.product.count_documents(
+        {"best_seller": True}
+    )
+
+
+@pytest.mark.parametrize("path", ["/products", "/bestsellers"])
+def test_stream_cannot_be_paged(db, client, path):
+    assert client.get(path, params={"stream": "true", "limit": 10}).status_code == 400
+    assert client.get(path, params={"stream": "true", "after": "x"}).status_code == 400
+
+
+def test_stream_stops_when_the_client_disconnects(db, app, monkeypatch):
+    monkeypatch.setattr(productRoutes, "STREAM_BATCH_SIZE", 10)
+    seed(db, categories=2, products=100, images_per_product=1, distinct_images=1)
+    chunks = []
+    requested = []
+    first_chunk = asyncio.Event()
+
+    async def receive():
+        if not requested:
+            requested.append(True)
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await first_chunk.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.append(message["body"])
+            first_chunk.set()
+            # Give the disconnect a chance to land before the next batch
+            await asyncio.sleep(0.01)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/products",
+        "raw_path": b"/products",
+        "root_path": "",
+        "query_string": b"stream=true",
+        "headers": [(b"host", b"testserver")],
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 0),
+    }
+    asyncio.run(asyncio.wait_for(app(scope, receive, send), timeout=5))
+
+    lines = b"".join(chunks).splitlines()
+    assert 0 < len(lines) < 100
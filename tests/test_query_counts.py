@@ -0,0 +1,196 @@
+import asyncio
+import threading
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import quote
+
+import mongomock
+import pytest
+from gridfs import GridFS
+from starlette_admin.auth import AdminUser
+
+from benchmarks.seed import seed
+from mongo_engine.auth import MyAuthProvider
+from mongo_engine.db import MONGO_BUCKET_NAME, connection, get_async_db
+from mongo_engine.models.models import Category
+from mongo_engine.views import ADMIN_LIST_IMAGES, CategoryView
+
+
+class CountingCollection:
+    def __init__(self, collection, name: str, commands: Counter):
+        self._collection = collection
+        self._name = name
+        self._commands = commands
+
+    def _count(self, command: str) -> None:
+        self._commands[(command, self._name)] += 1
+
+    def find(self, *args, **kwargs):
+        self._count("find")
+        return self._collection.find(*args, **kwargs)
+
+    async def find_one(self, *args, **kwargs):
+        self._count("find")
+        return await self._collection.find_one(*args, **kwargs)
+
+    def aggregate(self, *args, **kwargs):
+        self._count("aggregate")
+        return self._collection.aggregate(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+class CountingDatabase:
+    """
+    Async database handed to the routes, counting the read commands sent to
+    each collection.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self.commands = Counter()
+
+    def __getitem__(self, name: str) -> CountingCollection:
+        return CountingCollection(self._db[name], name, self.commands)
+
+    def __getattr__(self, name: str) -> CountingCollection:
+        return self[name]
+
+
+LIST_PATHS = [
+    "/products",
+    f"/products?category_name={quote('Benchmark category 0')}",
+    "/products/facets",
+    "/bestsellers",
+    "/categories",
+]
+
+
+@pytest.mark.parametrize("path", LIST_PATHS)
+def test_list_queries_do_not_grow_with_results(db, app, client, path):
+    commands = []
+    for products in (5, 150):
+        seed(db, categories=3, products=products, images_per_product=2, distinct_images=2)
+        counting = CountingDatabase(connection.catalog_db())
+        app.dependency_overrides[get_async_db] = lambda: counting
+        separator = "&" if "?" in path else "?"
+        response = client.get(f"{path}{separator}limit=500")
+        assert response.status_code == 200
+        commands.append(counting.commands)
+
+    assert commands[0] == commands[1]
+    # Category names come from the cached category index, never per product
+    assert sum(commands[1].values()) <= 2
+    assert commands[1][("find", "category")] <= 1
+
+
+def test_category_routes_use_the_warm_category_cache(db, app, client):
+    seed(db, categories=3, products=0, images_per_product=0)
+    counting = CountingDatabase(connection.catalog_db())
+    app.dependency_overrides[get_async_db] = lambda: counting
+    name = quote("Benchmark category 1")
+
+    assert client.get("/categories").status_code == 200
+    counting.commands.clear()
+    assert client.get("/categories").status_code == 200
+    assert client.get(f"/categories/{name}").status_code == 200
+    assert client.get("/categories/Unknown").status_code == 404
+    assert counting.commands[("find", "category")] == 0
+
+    # An admin edit invalidates the cache, so the next lookup reloads it
+    # Seeded documents carry a flag the model lacks, so edit the stored one
+    category = db.category.find_one_and_update(
+        {"name": "Benchmark category 1"}, {"$set": {"description": "Edited"}}
+    )
+    request = SimpleNamespace(state=SimpleNamespace())
+    edited = SimpleNamespace(pk=category["_id"])
+    asyncio.run(CategoryView(Category).after_edit(request, edited))
+    response = client.get(f"/categories/{name}")
+    assert response.json()["description"] == "Edited"
+    assert counting.commands[("find", "category")] == 1
+
+
+@pytest.fixture
+def sync_commands(monkeypatch):
+    """
+    Count the commands the admin sends through mongomock per (command,
+    collection), including the projection of each find. Calls mongomock
+    makes internally, like count_documents under estimated_document_count,
+    are not counted.
+    """
+    commands = Counter()
+    projections = []
+    depth = threading.local()
+
+    def counting(name, original):
+        def wrapper(collection, *args, **kwargs):
+            if getattr(depth, "value", 0) == 0:
+                commands[(name, collection.name)] += 1
+                if name == "find" and collection.name == "product":
+                    projections.append(
+                        kwargs.get("projection") or (args[1] if len(args) > 1 else None)
+                    )
+            depth.value = getattr(depth, "value", 0) + 1
+            try:
+                return original(collection, *args, **kwargs)
+            finally:
+                depth.value -= 1
+
+        return wrapper
+
+    for name in ("find", "aggregate", "count_documents", "estimated_document_count"):
+        original = getattr(mongomock.Collection, name)
+        monkeypatch.setattr(mongomock.Collection, name, counting(name, original))
+    return SimpleNamespace(commands=commands, projections=projections)
+
+
+def test_admin_list_page_takes_three_queries(db, client, monkeypatch, sync_commands):
+    async def signed_in(self, request):
+        request.state.user = AdminUser(username="owner")
+        return True
+
+    monkeypatch.setattr(MyAuthProvider, "is_authenticated", signed_in)
+    fs = GridFS(db, MONGO_BUCKET_NAME)
+    categories = [
+        db.category.insert_one({"name": name, "name_lower": name.lower()}).inserted_id
+        for name in ("Chairs", "Tables")
+    ]
+    db.product.insert_many(
+        [
+            {
+                "title": f"Chair {index}",
+                "title_lower": f"chair {index}",
+                "description": ["Not listed"],
+                "price": 10 + index,
+                "category": categories[index % 2],
+                "images": [
+                    {"id": f"Image0{image + 1}", "image_src": fs.put(b"x")}
+                    for image in range(3)
+                ],
+            }
+            for index in range(30)
+        ]
+    )
+    sync_commands.commands.clear()
+
+    response = client.get(
+        "/api/product", params={"skip": 0, "limit": 20, "order_by": "price asc"}
+    )
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 20
+
+    commands = sync_commands.commands
+    # The page with its projection, the categories in one $in, the estimated
+    # count, plus the file documents of the listed images in one $in
+    assert commands == Counter(
+        {
+            ("find", "product"): 1,
+            ("find", "category"): 1,
+            ("estimated_document_count", "product"): 1,
+            ("find", f"{MONGO_BUCKET_NAME}.files"): 1,
+        }
+    )
+    (projection,) = sync_commands.projections
+    assert "description" not in projection
+    assert projection["images"] == {"$slice": ADMIN_LIST_IMAGES}
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from mongo_engine import read_model
+from mongo_engine.read_model import (
+    LEASE_COLLECTION,
+    SCRATCH_PREFIX,
+    STOREFRONT_COLLECTION,
+    rebuild,
+)
+
+
+def insert_products(db, count: int) -> list:
+    category = {"_id": ObjectId(), "name": "Chairs", "variants": []}
+    db.category.insert_one(category)
+    products = [
+        {"_id": ObjectId(), "title": f"Chair {i}", "category": category["_id"]}
+        for i in range(count)
+    ]
+    db.product.insert_many(products)
+    return products
+
+
+def test_rebuild_waits_for_the_lease_holder(db):
+    insert_products(db, 3)
+    db[LEASE_COLLECTION].insert_one(
+        {
+            "_id": STOREFRONT_COLLECTION,
+            "owner": "other-process",
+            "expires_at": datetime.utcnow() + timedelta(minutes=5),
+        }
+    )
+    assert rebuild(db) is None
+    assert db[STOREFRONT_COLLECTION].count_documents({}) == 0
+
+    # An expired lease is taken over
+    db[LEASE_COLLECTION].update_one(
+        {"_id": STOREFRONT_COLLECTION},
+        {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}},
+    )
+    assert rebuild(db) == 3
+    assert db[LEASE_COLLECTION].count_documents({}) == 0
+
+
+def test_rebuild_replays_changes_made_while_it_runs(db, monkeypatch):
+    first, second, third = insert_products(db, 3)
+    rebuild(db)
+    build = read_model.build_storefront_doc
+    edited = []
+
+    def build_during_edits(product, category):
+        if not edited:
+            # Admin edits landing on the live collection mid-rebuild
+            edited.append(True)
+            db.product.update_one({"_id": second["_id"]}, {"$set": {"title": "Stool"}})
+            read_model.sync_product(db, db.product.find_one({"_id": second["_id"]}))
+            db.product.delete_one({"_id": third["_id"]})
+            read_model.delete_products(db, [third["_id"]])
+        return build(product, category)
+
+    monkeypatch.setattr(read_model, "build_storefront_doc", build_during_edits)
+    rebuild(db)
+
+    storefront = db[STOREFRONT_COLLECTION]
+    assert storefront.find_one({"_id": second["_id"]})["title"] == "Stool"
+    assert storefront.find_one({"_id": third["_id"]}) is None
+    assert storefront.find_one({"_id": first["_id"]})["title"] == "Chair 0"
+    assert db[read_model.CHANGES_COLLECTION].count_documents({}) == 0
+
+
+def test_rebuild_uses_a_fresh_scratch_collection(db):
+    insert_products(db, 2)
+    # Left behind by a process that died mid-rebuild
+    db[f"{SCRATCH_PREFIX}dead"].insert_one({"_id": ObjectId(), "title": "Stale"})
+
+    assert rebuild(db) == 2
+    assert not [
+        name for name in db.list_collection_names() if name.startswith(SCRATCH_PREFIX)
+    ]
+    assert db[STOREFRONT_COLLECTION].count_documents({"title": "Stale"}) == 0
@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+import mongoengine
+import pytest
+from fastapi import Depends, FastAPI, Request
+from fastapi.testclient import TestClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReadPreference
+
+from mongo_engine import db as db_module
+from mongo_engine.config import settings
+from mongo_engine.db import (
+    READ_YOUR_WRITES_COOKIE,
+    MongoConnection,
+    ReadYourWritesMiddleware,
+    note_write,
+    reading_own_writes,
+)
+from mongo_engine.response_cache import (
+    MemoryBackend,
+    ResponseCache,
+    ResponseCacheMiddleware,
+)
+
+
+@pytest.fixture
+def replica_set(memory_db):
+    """
+    Connection routed like a replica set deployment. The Motor client is never
+    used for I/O, only its read preferences are checked.
+    """
+    connection = MongoConnection()
+    async_client = AsyncIOMotorClient(
+        "mongodb://rs0-a,rs0-b,rs0-c/?replicaSet=rs0", connect=False
+    )
+    connection.use_clients(mongoengine.get_connection(), async_client)
+    yield connection
+    async_client.close()
+
+
+def test_storefront_reads_go_to_secondaries_unless_asked(replica_set):
+    catalog = replica_set.catalog_db()
+    assert catalog.read_preference.mongos_mode == settings.catalog_read_preference
+    assert (
+        catalog.read_preference.max_staleness
+        == settings.storefront_max_staleness_seconds
+    )
+    primary = replica_set.catalog_db(primary=True)
+    assert primary.read_preference == ReadPreference.PRIMARY
+
+
+def test_image_reads_go_to_secondaries_unless_asked(replica_set):
+    async def run():
+        bucket = replica_set.storefront_bucket()
+        primary_bucket = replica_set.storefront_bucket(primary=True)
+        return (
+            bucket.collection.read_preference,
+            primary_bucket.collection.read_preference,
+        )
+
+    routed, primary = asyncio.run(run())
+    assert routed.mongos_mode == settings.image_read_preference
+    assert primary == ReadPreference.PRIMARY
+
+
+def routing_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(ReadYourWritesMiddleware)
+
+    @app.post("/admin/product/edit")
+    async def edit(request: Request):
+        note_write(request)
+        return {}
+
+    @app.get("/products")
+    async def products(primary: bool = Depends(reading_own_writes)):
+        return {"primary": primary}
+
+    return app
+
+
+def test_only_the_writer_reads_its_writes_from_the_primary():
+    app = routing_app()
+    admin, shopper = TestClient(app), TestClient(app)
+
+    assert admin.get("/products").json() == {"primary": False}
+    response = admin.post("/admin/product/edit")
+    assert READ_YOUR_WRITES_COOKIE in response.cookies
+
+    assert admin.get("/products").json() == {"primary": True}
+    assert shopper.get("/products").json() == {"primary": False}
+
+
+def test_forged_or_expired_cookies_are_ignored(monkeypatch):
+    client = TestClient(routing_app())
+    client.cookies.set(READ_YOUR_WRITES_COOKIE, "1.forged.signature")
+    assert client.get("/products").json() == {"primary": False}
+
+    window = int(settings.read_your_writes_seconds) + 1
+    monkeypatch.setattr(
+        db_module._write_signer, "get_timestamp", lambda: int(time.time()) - window
+    )
+    expired = db_module._write_signer.sign(b"1").decode()
+    monkeypatch.undo()
+    client.cookies.set(READ_YOUR_WRITES_COOKIE, expired)
+    assert client.get("/products").json() == {"primary": False}
+
+
+def test_cache_refills_read_the_primary_right_after_a_purge():
+    cache = ResponseCache(MemoryBackend())
+    app = FastAPI()
+    app.add_middleware(ResponseCacheMiddleware, cache=cache)
+
+    @app.get("/products")
+    async def products(request: Request, primary: bool = Depends(reading_own_writes)):
+        request.state.cache_tags = ["products"]
+        return {"primary": primary}
+
+    client = TestClient(app)
+    assert client.get("/products").json() == {"primary": False}
+    asyncio.run(cache.purge(["products"]))
+    assert client.get("/products").json() == {"primary": True}
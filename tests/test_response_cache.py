@@ -0,0 +1,112 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+from benchmarks.seed import seed
+from mongo_engine.models.models import Category, Product
+from mongo_engine.response_cache import (
+    MemoryBackend,
+    ResponseCache,
+    SharedGeneration,
+    response_cache,
+)
+from mongo_engine.views import CategoryView, ProductView
+
+
+def worker_cache() -> ResponseCache:
+    # One per simulated worker process, sharing only the database
+    return ResponseCache(MemoryBackend(shared=SharedGeneration(interval=0)))
+
+
+def test_purge_in_one_worker_empties_the_others(db):
+    async def run():
+        first, second = worker_cache(), worker_cache()
+        generation = await first.generation()
+        await first.set("/categories?", b"[]", [], ["categories"], generation)
+        assert await first.get("/categories?") is not None
+
+        await second.purge(["categories"])
+        assert await first.get("/categories?") is None
+
+    asyncio.run(run())
+
+
+def test_response_computed_before_a_purge_is_not_stored(db):
+    async def run():
+        first, second = worker_cache(), worker_cache()
+        # The first worker starts computing the response...
+        generation = await first.generation()
+        # ...while the admin's worker purges
+        await second.purge(["products"])
+        await first.set("/products?", b"[]", [], ["products"], generation)
+        assert await first.get("/products?") is None
+
+        generation = await first.generation()
+        await first.set("/products?", b"[]", [], ["products"], generation)
+        assert await first.get("/products?") is not None
+
+    asyncio.run(run())
+
+
+def test_own_purge_keeps_unrelated_entries(db):
+    async def run():
+        cache = worker_cache()
+        generation = await cache.generation()
+        await cache.set("/categories?", b"[]", [], ["categories"], generation)
+        await cache.purge(["products"])
+        assert await cache.get("/categories?") is not None
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def cached_app(db, monkeypatch):
+    # The instance the middleware and the admin hooks share, with a backend
+    backend = MemoryBackend(shared=SharedGeneration(interval=0))
+    monkeypatch.setattr(response_cache, "backend", backend)
+    return backend
+
+
+def test_cached_responses_are_hits_and_answer_if_none_match(db, cached_app, client):
+    seed(db, categories=2, products=3, images_per_product=1, distinct_images=1)
+
+    first = client.get("/categories")
+    assert first.headers["x-cache"] == "MISS"
+    second = client.get("/categories")
+    assert second.headers["x-cache"] == "HIT"
+    assert second.content == first.content
+
+    etag = second.headers["etag"]
+    response = client.get("/categories", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == second.headers["etag"]
+
+
+def test_admin_saves_purge_their_tags(db, cached_app, client):
+    seed(db, categories=2, products=3, images_per_product=1, distinct_images=1)
+    for path in ("/categories", "/products"):
+        client.get(path)
+        assert client.get(path).headers["x-cache"] == "HIT"
+    request = SimpleNamespace(state=SimpleNamespace())
+    category_id = db.category.find_one()["_id"]
+
+    # A product save purges the listings, not the categories
+    product = SimpleNamespace(pk=ObjectId(), category=None)
+    asyncio.run(ProductView(Product).after_create(request, product))
+    assert client.get("/products").headers["x-cache"] == "MISS"
+    assert client.get("/categories").headers["x-cache"] == "HIT"
+
+    category = SimpleNamespace(pk=category_id)
+    asyncio.run(CategoryView(Category).after_edit(request, category))
+    assert client.get("/categories").headers["x-cache"] == "MISS"
+
+
+def test_purge_in_another_worker_reaches_the_middleware(db, cached_app, client):
+    seed(db, categories=1, products=3, images_per_product=1, distinct_images=1)
+    client.get("/products")
+    assert client.get("/products").headers["x-cache"] == "HIT"
+
+    asyncio.run(worker_cache().purge(["products"]))
+    assert client.get("/products").headers["x-cache"] == "MISS"
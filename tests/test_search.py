@@ -0,0 +1,144 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import ExecutionTimeout
+
+from mongo_engine import read_model
+from mongo_engine.db import get_async_db
+from mongo_engine.read_model import MAX_PREFIX_LENGTH, rebuild
+from mongo_engine.Routes.productRoutes import SEARCH_MAX_TIME_MS
+from tests.conftest import TEST_MONGO_DB, TEST_MONGO_URL
+
+TITLES = {
+    "Stainless steel chair": "Chairs",
+    "Steel table": "Tables",
+    "Oak chair": "Chairs",
+    "Extraordinarilylong lamp": "Lamps",
+}
+
+
+def insert_catalog(db, descriptions=None):
+    categories = {
+        name: db.category.insert_one(
+            {"name": name, "name_lower": name.lower(), "variants": []}
+        ).inserted_id
+        for name in set(TITLES.values())
+    }
+    db.product.insert_many(
+        [
+            {
+                "title": title,
+                "title_lower": title.lower(),
+                "subtitle": "Furniture",
+                "description": (descriptions or {}).get(title, []),
+                "category": categories[category],
+                "images": [],
+            }
+            for title, category in TITLES.items()
+        ]
+    )
+    rebuild(db)
+
+
+def search(client, **params):
+    response = client.get("/products/search", params=params)
+    assert response.status_code == 200, response.text
+    return [product["title"] for product in response.json()]
+
+
+def test_prefix_search_matches_the_start_of_every_term(db, client):
+    insert_catalog(db)
+
+    assert search(client, q="ste", prefix=True) == [
+        "Stainless steel chair",
+        "Steel table",
+    ]
+    assert search(client, q="ste cha", prefix=True) == ["Stainless steel chair"]
+    assert search(client, q="chair oa", prefix=True) == ["Oak chair"]
+    assert search(client, q="table chair", prefix=True) == []
+
+
+def test_prefix_search_cuts_long_terms_to_the_stored_prefixes(db, client):
+    insert_catalog(db)
+    word = "extraordinarilylong"
+    assert len(word) > MAX_PREFIX_LENGTH
+
+    assert search(client, q=word, prefix=True) == ["Extraordinarilylong lamp"]
+    assert search(client, q=word[:MAX_PREFIX_LENGTH], prefix=True) == [
+        "Extraordinarilylong lamp"
+    ]
+
+
+def test_search_within_a_category(db, client):
+    insert_catalog(db)
+
+    assert search(client, q="chair", prefix=True, category_name="chairs") == [
+        "Oak chair",
+        "Stainless steel chair",
+    ]
+    assert search(client, q="steel", prefix=True, category_name="Tables") == [
+        "Steel table"
+    ]
+    response = client.get(
+        "/products/search", params={"q": "chair", "category_name": "Sofas"}
+    )
+    assert response.status_code == 404
+
+
+class TimingOutCursor:
+    def __init__(self):
+        self.max_time = None
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def max_time_ms(self, max_time):
+        self.max_time = max_time
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise ExecutionTimeout("operation exceeded time limit", code=50)
+
+
+class TimingOutDatabase:
+    def __init__(self, cursor: TimingOutCursor):
+        self.cursor = cursor
+
+    def __getitem__(self, name: str):
+        return self
+
+    def find(self, *args, **kwargs) -> TimingOutCursor:
+        return self.cursor
+
+
+def test_search_timeout_returns_503(app, client):
+    cursor = TimingOutCursor()
+    app.dependency_overrides[get_async_db] = lambda: TimingOutDatabase(cursor)
+
+    response = client.get("/products/search", params={"q": "chair"})
+    assert response.status_code == 503
+    assert cursor.max_time == SEARCH_MAX_TIME_MS
+
+
+def test_text_search_ranks_title_matches_first(server_db, app, client):
+    # mongomock has no $text, so this runs against TEST_MONGO_URL
+    insert_catalog(
+        server_db, descriptions={"Steel table": ["Pairs well with any oak chair"]}
+    )
+    read_model.ensure_indexes(server_db)
+
+    async def server_async_db():
+        motor = AsyncIOMotorClient(TEST_MONGO_URL)
+        try:
+            yield motor[TEST_MONGO_DB]
+        finally:
+            motor.close()
+
+    app.dependency_overrides[get_async_db] = server_async_db
+    titles = search(client, q="oak")
+    # The title is weighted over the description
+    assert titles == ["Oak chair", "Steel table"]
@@ -0,0 +1,71 @@
+import asyncio
+import dataclasses
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from mongo_engine import startup as startup_module
+from mongo_engine.config import settings
+from mongo_engine.startup import Startup
+
+
+def run(monkeypatch, prepare, warm_up=None):
+    monkeypatch.setattr(startup_module, "FIRST_RETRY_SECONDS", 0)
+    monkeypatch.setattr(
+        startup_module,
+        "settings",
+        dataclasses.replace(settings, warmup_enabled=warm_up is not None),
+    )
+    if warm_up is not None:
+        monkeypatch.setattr(startup_module, "warm_up", warm_up)
+    startup = Startup()
+    asyncio.run(startup.run(None, prepare, 0))
+    return startup
+
+
+def failing(*errors):
+    errors = list(errors)
+
+    def prepare():
+        if errors:
+            raise errors.pop(0)
+
+    return prepare
+
+
+def test_transient_operation_failures_are_retried(monkeypatch):
+    prepare = failing(
+        AutoReconnect("connection reset"),
+        OperationFailure("not primary", code=10107),
+    )
+    startup = run(monkeypatch, prepare)
+    assert startup.ready
+    assert startup.attempts == 3
+
+
+def test_permanent_operation_failures_fail_startup(monkeypatch):
+    startup = run(monkeypatch, failing(OperationFailure("bad index", code=85)))
+    assert not startup.ready
+    assert startup.phase == "failed"
+    assert startup.attempts == 1
+
+
+def test_warmup_is_retried_on_transient_errors(monkeypatch):
+    calls = []
+
+    async def warm_up(app):
+        calls.append(app)
+        if len(calls) == 1:
+            raise AutoReconnect("connection reset")
+
+    startup = run(monkeypatch, failing(), warm_up)
+    assert startup.ready
+    assert len(calls) == 2
+
+
+def test_warmup_errors_do_not_block_readiness(monkeypatch):
+    async def warm_up(app):
+        raise RuntimeError("image cache full")
+
+    startup = run(monkeypatch, failing(), warm_up)
+    assert startup.ready
+    assert startup.attempts == 1